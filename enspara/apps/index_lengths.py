@@ -0,0 +1,79 @@
+"""Build (or update) a length index for a set of trajectories, so that
+later runs of the other apps don't have to sound them.
+
+Trajectories are sounded in parallel, and only those that aren't in the
+index yet (or have changed since they were indexed) are opened. The
+apps use the index if its path is in the ENSPARA_LENGTH_INDEX
+environment variable, e.g.:
+
+    python index_lengths.py --trajectories trj/*.xtc --index lengths.db
+    export ENSPARA_LENGTH_INDEX=lengths.db
+"""
+
+import sys
+import argparse
+import logging
+import time
+
+import numpy as np
+
+from enspara.util.load import LengthIndex, sound_trajectories
+from enspara.util.parallel import auto_nprocs
+
+
+logging.basicConfig(
+    level=logging.INFO,
+    format=('%(asctime)s %(name)-8s %(levelname)-7s %(message)s'),
+    datefmt='%m-%d-%Y %H:%M:%S')
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def process_command_line(argv):
+    '''Parse the command line and do a first-pass on processing them into a
+    format appropriate for the rest of the script.'''
+
+    parser = argparse.ArgumentParser(formatter_class=argparse.
+                                     ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '--trajectories', required=True, nargs="+", action='append',
+        help="The trajectory files to index. This flag may be given "
+             "more than once.")
+    parser.add_argument(
+        '--index', required=True,
+        help="Path to the length index. If it exists, it is updated.")
+    parser.add_argument(
+        '--processes', default=auto_nprocs(), type=int,
+        help="Number of processes to sound trajectories with.")
+
+    args = parser.parse_args(argv[1:])
+
+    # flatten the trajectory lists from each --trajectories flag
+    args.trajectories = [t for trjs in args.trajectories for t in trjs]
+
+    return args
+
+
+def main(argv=None):
+    '''Run the driver script for this module. This code only runs if we're
+    being run as a script. Otherwise, it's silent and just exposes methods.'''
+    args = process_command_line(argv)
+
+    tick = time.perf_counter()
+
+    index = LengthIndex(args.index)
+    lengths = sound_trajectories(
+        args.trajectories, processes=args.processes, index=index)
+
+    logger.info("Indexed %s trajectories with %s frames (median length "
+                "%i frames) in %s in %.1f seconds.",
+                len(lengths), sum(lengths), np.median(lengths), args.index,
+                time.perf_counter() - tick)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
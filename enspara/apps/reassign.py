@@ -4,17 +4,14 @@ import argparse
 import logging
 import pickle
 import time
+import hashlib
 import resource
 
-from functools import partial
-
 import psutil
 
 import numpy as np
 import mdtraj as md
 
-from sklearn.externals.joblib import Parallel, delayed
-
 logging.basicConfig(
     level=logging.INFO,
     format=('%(asctime)s %(name)-8s %(levelname)-7s %(message)s'),
@@ -23,10 +20,12 @@ logging.basicConfig(
 import enspara
 
 from enspara.cluster.util import assign_to_nearest_center, partition_list
-from enspara.util.load import (concatenate_trjs, sound_trajectory,
+from enspara.cluster.index import VPTree
+from enspara.util.load import (concatenate_trjs, sound_trajectories,
                                load_as_concatenated)
 from enspara.util import array as ra
 from enspara.util.log import timed
+from enspara.geometry import libdist
 
 
 logger = logging.getLogger(__name__)
@@ -57,6 +56,12 @@ def process_command_line(argv):
         '--output-path', default=None,
         help="Output path for results (distances, assignments). "
              "Default is in the same directory as the input centers.")
+    parser.add_argument(
+        '--index', default=None,
+        help="Path to a pickled VP-tree index over the centers, used to "
+             "find each frame's nearest center without computing its "
+             "distance to every center. If the file doesn't exist, the "
+             "index is built and saved there for future runs.")
     parser.add_argument(
         '-m', '--mem-fraction', default=0.5, type=float,
         help="The fraction of total RAM to use in deciding the batch size. "
@@ -125,7 +130,8 @@ def determine_batch_size(n_atoms, dtype_bytes, frac_mem):
     return batch_size, batch_gb
 
 
-def batch_reassign(targets, centers, lengths, frac_mem, n_procs=None):
+def batch_reassign(targets, centers, lengths, frac_mem, n_procs=None,
+                   index=None):
 
     example_center = centers[0]
 
@@ -165,14 +171,15 @@ def batch_reassign(targets, centers, lengths, frac_mem, n_procs=None):
         # some platform-specific situation where double != float64?
         assert xyz.dtype.itemsize == DTYPE_BYTES
 
-        trj = md.Trajectory(xyz, topology=example_center.top)
-
         with timed("Precentered trajectories in %.1f seconds", logger.debug):
-            trj.center_coordinates()
+            trj = libdist.PreparedCoordinates(xyz, copy=False)
 
         with timed("Assigned trajectories in %.1f seconds", logger.debug):
-            batch_assignments, batch_distances = assign_to_nearest_center(
-                    trj, centers, partial(md.rmsd, precentered=True))
+            if index is not None:
+                batch_assignments, batch_distances = index.query(trj)
+            else:
+                batch_assignments, batch_distances = \
+                    assign_to_nearest_center(trj, centers, libdist.rmsd)
 
         # clear memory of xyz and trj to allow cleanup to deallocate
         # these large arrays; may help with memory high-water mark
@@ -195,7 +202,8 @@ def batch_reassign(targets, centers, lengths, frac_mem, n_procs=None):
     return assignments, distances
 
 
-def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
+def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5,
+             index=None):
     """Reassign a set of trajectories based on a subset of atoms and centers.
 
     Parameters
@@ -210,11 +218,15 @@ def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
         List of MDTraj atom query strings. Each string is applied to the
         corresponding topology to choose which atoms will be used for
         the reassignment.
-    centers : md.Trajectory or list of trajectories
+    centers : md.Trajectory, list of trajectories or PreparedCoordinates
         The atoms representing the centers to reassign to.
     frac_mem : float, default=0.5
         The fraction of main RAM to use for trajectories. A lower number
         will mean more batches.
+    index : VPTree, default=None
+        If given, an RMSD index over `centers` to find the nearest
+        center with, rather than computing the distance to every
+        center.
     """
 
     n_procs = enspara.util.parallel.auto_nprocs()
@@ -228,20 +240,17 @@ def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
         raise enspara.exception.ImproperlyConfigured(
             "Number of topologies (%s) didn't match number of atom selection "
             "strings (%s)." % (len(topologies), len(atoms)))
-
-    # iteration across md.Trajectory is insanely slow. Do it only once here.
-    if isinstance(centers, md.Trajectory):
-        tick = time.perf_counter()
-        logger.info('Centers are an md.Trajectory. Creating trj-list to '
-                    'avoid repeated iteration.')
-        # using in-place copies to reduce memory usage (and for speed)
-        centers = [centers.slice(i, copy=False) for i in range(len(centers))]
-        logger.info('Built trj list in %.1f seconds.',
-                    time.perf_counter() - tick)
-
-    # precenter centers (there will be many RMSD calcs here)
-    for c in centers:
-        c.center_coordinates()
+    if index is not None and len(index) != len(centers):
+        raise enspara.exception.DataInvalid(
+            "Index has %s centers, but %s centers were given." %
+            (len(index), len(centers)))
+
+    # precenter centers and compute their traces once (there will be
+    # many RMSD calcs here)
+    if not isinstance(centers, libdist.PreparedCoordinates):
+        if not hasattr(centers, 'xyz'):
+            centers = np.concatenate([c.xyz for c in centers])
+        centers = libdist.PreparedCoordinates(centers)
 
     with timed("Reassignment took %.1f seconds.", logger.info):
         # build flat list of targets
@@ -258,8 +267,8 @@ def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
         logger.info("Sounding dataset of %s trajectories and %s topologies.",
                     sum(len(t) for t in trajectories), len(topologies))
 
-        lengths = Parallel(n_jobs=n_procs)(
-            delayed(sound_trajectory)(f) for f, _, _ in targets)
+        lengths = sound_trajectories(
+            [f for f, _, _ in targets], processes=n_procs)
 
         logger.info("Sounded %s trajectories with %s frames (median length "
                     "%i frames) in %.1f seconds.",
@@ -267,7 +276,8 @@ def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
                     time.perf_counter() - tick_sounding)
 
         assignments, distances = batch_reassign(
-            targets, centers, lengths, frac_mem=frac_mem, n_procs=n_procs)
+            targets, centers, lengths, frac_mem=frac_mem, n_procs=n_procs,
+            index=index)
 
     if all([len(assignments[0]) == len(a) for a in assignments]):
         logger.info("Trajectory lengths are homogenous. Output will "
@@ -280,6 +290,55 @@ def reassign(topologies, trajectories, atoms, centers, frac_mem=0.5):
         return ra.RaggedArray(assignments), ra.RaggedArray(distances)
 
 
+def _centers_digest(centers):
+    """A digest of the coordinates of `centers`, to tell whether an
+    index was built over them.
+    """
+
+    xyz = np.ascontiguousarray(centers.xyz, dtype=np.float32)
+    digest = hashlib.sha1(str(xyz.shape).encode('ascii'))
+    digest.update(xyz.tobytes())
+
+    return digest.hexdigest()
+
+
+def load_index(filename, centers):
+    """Load the VP-tree index over `centers` pickled at `filename`, or
+    build it and pickle it there if the file doesn't exist.
+
+    The file also holds a digest of the coordinates of the centers the
+    index was built over, and loading it for any other centers raises
+    DataInvalid.
+    """
+
+    digest = _centers_digest(centers)
+
+    if os.path.isfile(filename):
+        with open(filename, 'rb') as f:
+            saved = pickle.load(f)
+
+        # indices saved before the digest was stored are bare VPTrees,
+        # and can't be checked.
+        if not isinstance(saved, dict) or \
+                saved.get('centers_digest') != digest:
+            raise enspara.exception.DataInvalid(
+                "Index at %s wasn't built over these %s centers. Was it "
+                "built for different centers or atoms? Delete it to "
+                "rebuild it." % (filename, len(centers)))
+
+        index = saved['index']
+        logger.info("Loaded index over %s centers from %s.",
+                    len(index), filename)
+    else:
+        with timed("Built index over centers in %.1f seconds.", logger.info):
+            index = VPTree(centers, metric='rmsd')
+        with open(filename, 'wb') as f:
+            pickle.dump({'index': index, 'centers_digest': digest}, f)
+        logger.info("Wrote index to %s.", filename)
+
+    return index
+
+
 def main(argv=None):
     '''Run the driver script for this module. This code only runs if we're
     being run as a script. Otherwise, it's silent and just exposes methods.'''
@@ -296,9 +355,13 @@ def main(argv=None):
                 len(centers), centers.n_atoms, args.atoms,
                 time.perf_counter() - tick)
 
+    index = None
+    if args.index is not None:
+        index = load_index(args.index, centers)
+
     assig, dist = reassign(
         args.topologies, args.trajectories, [args.atoms]*len(args.topologies),
-        centers=centers, frac_mem=args.mem_fraction)
+        centers=centers, frac_mem=args.mem_fraction, index=index)
 
     mem_highwater = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
     logger.info(
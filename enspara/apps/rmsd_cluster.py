@@ -32,6 +32,8 @@ from enspara.util import array as ra
 from enspara.util import load_as_concatenated
 from enspara.util.log import timed
 from enspara.cluster.util import load_frames
+from enspara.cluster.checkpoint import Checkpoint
+from enspara.geometry import libdist
 from enspara import exception
 
 
@@ -91,6 +93,16 @@ def process_command_line(argv):
         '--no-reassign', default=False, action='store_true',
         help="Do not do a reassigment step. Ignored if --subsample is "
              "not supplied or 1.")
+    parser.add_argument(
+        '--checkpoint', default=None, action=readable_dir,
+        help="Periodically save the clustering state to this HDF5 file. "
+             "If the file exists, clustering resumes from it.")
+    parser.add_argument(
+        '--checkpoint-every', default=None, type=int, metavar='N',
+        help="Save a checkpoint after every N new cluster centers.")
+    parser.add_argument(
+        '--checkpoint-interval', default=3600, type=float, metavar='SEC',
+        help="Save a checkpoint at least every SEC seconds.")
 
     # OUTPUT
     parser.add_argument(
@@ -188,11 +200,6 @@ def load(topologies, trajectories, selections, stride, processes):
         lengths, xyz = load_as_concatenated(
             flat_trjs, args=configs, processes=processes)
 
-    with timed("Turned over array in %.2f min", logging.info):
-        tmp_xyz = xyz.copy()
-        del xyz
-        xyz = tmp_xyz
-
     logger.info(
         "Loaded %s frames.", len(xyz))
 
@@ -244,14 +251,21 @@ def main(argv=None):
         "Loading finished in %.1f s. Clustering using %s atoms matching '%s'.",
         round(time.perf_counter() - tick, 2), xyz.shape[1], args.atoms)
 
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(
+            args.checkpoint, every_n=args.checkpoint_every,
+            every_seconds=args.checkpoint_interval)
+
     clustering = args.Clusterer(
-        metric=md.rmsd,
+        metric='rmsd',
         n_clusters=args.n_clusters,
-        cluster_radius=args.rmsd_cutoff)
+        cluster_radius=args.rmsd_cutoff,
+        checkpoint=checkpoint)
 
-    # md.rmsd requires an md.Trajectory object, so wrap `xyz` in
-    # the topology.
-    clustering.fit(md.Trajectory(xyz=xyz, topology=select_top))
+    # center `xyz` and compute traces once (in place), rather than on
+    # every one of the many RMSD calculations clustering does.
+    clustering.fit(libdist.PreparedCoordinates(xyz, copy=False))
 
     logger.info(
         "Clustered %s frames into %s clusters in %s seconds.",
@@ -1,3 +1,4 @@
+import os
 import sys
 import argparse
 import logging
@@ -28,10 +29,13 @@ from enspara.mpi import MPI_RANK, MPI_SIZE
 from enspara import mpi
 
 from enspara.cluster.util import load_frames, partition_indices
-from enspara.cluster.kcenters import kcenters_mpi
+from enspara.cluster.kcenters import kcenters_mpi, KCentersHistory
 from enspara.cluster.kmedoids import _kmedoids_pam_update
+from enspara.cluster import checkpoint as ckpt
 
 from enspara.apps.util import readable_dir
+from enspara.geometry import libdist
+from enspara import exception
 
 from enspara.util import array as ra
 from enspara.util.log import timed
@@ -60,12 +64,28 @@ def process_command_line(argv):
     parser.add_argument(
         "--cluster-radii", required=True, type=float, nargs="+",
         help="Minimum maximum distance between any point and a center. "
-             "More than one value can be supplied, and a kcenters set"
-             "will be saved at each value")
+             "More than one value can be supplied, and a kcenters set "
+             "will be saved at each value from a single kcenters run. "
+             "In this case, output paths must contain the string "
+             "'{cluster_radius}', which is replaced with each value.")
     parser.add_argument(
         "--kmedoids-iters", default=5, type=int,
         help="Number of iterations of kmedoids to run.")
+    parser.add_argument(
+        "--kmedoids-batch-size", default=None, type=int, metavar='N',
+        help="Propose new centers for N clusters at a time in each "
+             "kmedoids iteration, which needs far fewer collectives than "
+             "proposing them one at a time.")
 
+    parser.add_argument(
+        '--partition', default='striped',
+        choices=['striped', 'files', 'frames'],
+        help="How to divide the trajectories between MPI ranks: "
+             "'striped' deals whole files out in turn, 'files' assigns "
+             "whole files so that each rank gets about the same number "
+             "of frames, and 'frames' splits files so that each rank "
+             "gets the same number of frames. Checkpoints can only be "
+             "resumed with the partition they were written with.")
     parser.add_argument(
         '--processes', default=mp.cpu_count(), type=int,
         help="Number processes to use (on each node) for loading and "
@@ -74,6 +94,18 @@ def process_command_line(argv):
         '--random-state', default=None, type=int,
         help="Give a fixed random seed to ensure reproducible results")
 
+    parser.add_argument(
+        '--checkpoint', default=None, action=readable_dir,
+        help="Periodically save the clustering state to HDF5 files "
+             "named after this path (one per rank). If the files exist, "
+             "clustering resumes from them.")
+    parser.add_argument(
+        '--checkpoint-every', default=None, type=int, metavar='N',
+        help="Save a checkpoint after every N new cluster centers.")
+    parser.add_argument(
+        '--checkpoint-interval', default=3600, type=float, metavar='SEC',
+        help="Save a checkpoint at least every SEC seconds.")
+
     parser.add_argument(
         "--distances", action=readable_dir,
         help="Path to output distances h5.")
@@ -90,6 +122,16 @@ def process_command_line(argv):
     args = parser.parse_args(argv[1:])
 
     args.trajectories = glob(args.trajectories)
+
+    if len(args.cluster_radii) > 1:
+        for path in [args.distances, args.assignments, args.center_indices,
+                     args.center_structures]:
+            if path is not None and '{cluster_radius}' not in path:
+                raise exception.ImproperlyConfigured(
+                    "When more than one --cluster-radii value is given, "
+                    "every output path must contain '{cluster_radius}'; "
+                    "got '%s'." % path)
+
     args.radom_state = check_random_state(args.random_state)
 
     if args.subsample > 1 and args.distances:
@@ -115,24 +157,31 @@ def main(argv=None):
         "subsampling %s", MPI_RANK, MPI_SIZE, args.selection, args.subsample)
 
     with timed("load_as_concatenated took %.2f sec", logging.info):
-        global_lengths, my_xyz = mpi.io.load_as_striped(
-            filenames=args.trajectories,
-            top=top,
-            atom_indices=atom_ids,
-            stride=args.subsample,
-            processes=args.processes)
-
-    with timed("Turned over array in %.2f min", logging.info):
-        xyz = my_xyz.copy()
-        del my_xyz
-        my_xyz = xyz
+        if args.partition == 'striped':
+            layout = None
+            global_lengths, my_xyz = mpi.io.load_as_striped(
+                filenames=args.trajectories,
+                top=top,
+                atom_indices=atom_ids,
+                stride=args.subsample,
+                processes=args.processes)
+        else:
+            global_lengths, my_xyz, layout = mpi.io.load_as_balanced(
+                filenames=args.trajectories,
+                split=(args.partition == 'frames'),
+                top=top,
+                atom_indices=atom_ids,
+                stride=args.subsample,
+                processes=args.processes)
 
     logging.info(
         "Loaded %s frames in %s trjs (%.2fG).",
         len(my_xyz), len(args.trajectories) // MPI_SIZE,
         my_xyz.data.nbytes / 1024**3)
 
-    trjs = md.Trajectory(my_xyz, topology=top.subset(atom_ids))
+    # center coordinates and compute traces once, in place, rather than
+    # on every RMSD calculation.
+    trjs = libdist.PreparedCoordinates(my_xyz, copy=False)
 
     logging.info(
         "Beginning kcenters clustering with memory footprint of %.2fG "
@@ -141,13 +190,13 @@ def main(argv=None):
         trjs.xyz.nbytes / 1024**3,
         psutil.virtual_memory().total / 1024**3)
 
-    if len(args.cluster_radii) > 1:
-        raise NotImplementedError(
-            "Multiple cluster radii are not yet supported")
+    # kcenters is greedy, so a single run to the smallest radius passes
+    # through the clustering at each larger one; capture them on the way.
+    history = KCentersHistory(cluster_radii=args.cluster_radii)
 
     tick = time.perf_counter()
-    local_dists, local_assigs, local_ctr_inds = kcenters_mpi(
-        trjs, md.rmsd, dist_cutoff=args.cluster_radii[0])
+    kcenters_mpi(trjs, libdist.rmsd, dist_cutoff=min(args.cluster_radii),
+                 history=history, checkpoint=make_checkpoint(args))
     tock = time.perf_counter()
 
     logging.info(
@@ -157,38 +206,107 @@ def main(argv=None):
         trjs.xyz.nbytes / 1024**3,
         (tock - tick)/60)
 
-    for i in range(args.kmedoids_iters):
+    for radius in args.cluster_radii:
+        local_ctr_inds, local_assigs, local_dists = history.clustering(
+            cluster_radius=radius)
+
+        logging.info("Got %s centers at cluster radius %s.",
+                     len(local_ctr_inds), radius)
+
+        outputs = {
+            name: (path.replace('{cluster_radius}', str(radius))
+                   if path is not None else None)
+            for name, path in [('distances', args.distances),
+                               ('assignments', args.assignments),
+                               ('center_indices', args.center_indices),
+                               ('center_structures', args.center_structures)]}
+
+        finish_clustering(
+            trjs, args, outputs, global_lengths, local_ctr_inds,
+            local_assigs, local_dists,
+            checkpoint=make_checkpoint(args, cluster_radius=radius),
+            layout=layout)
+
+    return 0
+
+
+def make_checkpoint(args, cluster_radius=None):
+    """Build the checkpoint for the kcenters stage or, if
+    `cluster_radius` is given, the kmedoids stage at that radius.
+    """
+
+    if not args.checkpoint:
+        return None
+
+    filename = args.checkpoint
+    if cluster_radius is not None:
+        root, ext = os.path.splitext(filename)
+        filename = '%s.kmedoids-%s%s' % (root, cluster_radius, ext)
+
+    return ckpt.Checkpoint(
+        filename, every_n=args.checkpoint_every,
+        every_seconds=args.checkpoint_interval, mpi_mode=True)
+
+
+def finish_clustering(trjs, args, outputs, global_lengths, local_ctr_inds,
+                      local_assigs, local_dists, checkpoint=None,
+                      layout=None):
+    """Refine a kcenters clustering with kmedoids and write the center
+    indices, center structures, distances and assignments to the paths
+    in `outputs`. The state is saved to `checkpoint` after each kmedoids
+    iteration, and resumed from it if it exists. `layout` is the layout
+    of frames across ranks from `mpi.io.load_as_balanced`, or None if
+    the trajectories are striped.
+    """
+
+    first_iter = 0
+    state = checkpoint.load() if checkpoint is not None else None
+    if state is not None:
+        local_ctr_inds, local_assigs, local_dists = \
+            ckpt.restore_clustering(state, len(trjs), ckpt.KMEDOIDS_STAGE)
+        first_iter = int(ckpt.scalar(state, 'kmedoids_iters'))
+        logging.info("Resuming after %s kmedoids iterations.", first_iter)
+
+    for i in range(first_iter, args.kmedoids_iters):
         with timed("KMedoids iteration {i} took %.2f sec".format(i=i),
                    logging.info):
             local_ctr_inds, local_dists, local_assigs = _kmedoids_pam_update(
-                X=trjs, metric=md.rmsd,
+                X=trjs, metric=libdist.rmsd,
                 medoid_inds=local_ctr_inds,
                 assignments=local_assigs,
                 distances=local_dists,
-                random_state=args.random_state)
+                random_state=args.random_state,
+                batch_size=args.kmedoids_batch_size)
+
+        if checkpoint is not None:
+            checkpoint.save(**ckpt.clustering_state(
+                ckpt.KMEDOIDS_STAGE, local_ctr_inds, local_assigs,
+                local_dists, kmedoids_iters=i+1))
 
     with timed("Reassembled dist and assign arrays in %.2f sec", logging.info):
+        # only rank 0 writes the outputs, so only it needs them.
         all_dists = mpi.ops.assemble_striped_ragged_array(
-            local_dists, global_lengths)
+            local_dists, global_lengths, layout=layout, root=0)
         all_assigs = mpi.ops.assemble_striped_ragged_array(
-            local_assigs, global_lengths)
+            local_assigs, global_lengths, layout=layout, root=0)
 
         ctr_inds = mpi.ops.convert_local_indices(
-            local_ctr_inds, global_lengths)
+            local_ctr_inds, global_lengths, layout=layout)
         ctr_inds = partition_indices(ctr_inds, global_lengths)
 
     if MPI_RANK == 0:
-        logging.info("Dumping center indices to %s", args.center_indices)
+        logging.info("Dumping center indices to %s",
+                     outputs['center_indices'])
 
-        with open(args.center_indices, 'wb') as f:
+        with open(outputs['center_indices'], 'wb') as f:
             pickle.dump(
                 [(trj, frame*args.subsample) for trj, frame in ctr_inds], f)
 
-        if args.distances:
-            ra.save(args.distances,
+        if outputs['distances']:
+            ra.save(outputs['distances'],
                     ra.RaggedArray(all_dists, lengths=global_lengths))
-        if args.assignments:
-            ra.save(args.assignments,
+        if outputs['assignments']:
+            ra.save(outputs['assignments'],
                     ra.RaggedArray(all_assigs, lengths=global_lengths))
 
         centers = load_frames(
@@ -197,12 +315,11 @@ def main(argv=None):
             stride=args.subsample,
             top=md.load(args.topology).top)
 
-        with open(args.center_structures, 'wb') as f:
+        with open(outputs['center_structures'], 'wb') as f:
             pickle.dump(centers, f)
         logging.info("Wrote %s centers to %s", len(centers),
-                     args.center_structures)
+                     outputs['center_structures'])
 
-    return 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -1,9 +1,11 @@
 
 from __future__ import print_function, division, absolute_import
 
+from . import hierarchical
 from . import hybrid
 from . import kcenters
 from . import kmedoids
 
+from .hierarchical import HierarchicalKCenters
 from .hybrid import KHybrid
 from .kcenters import KCenters
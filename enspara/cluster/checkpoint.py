@@ -0,0 +1,328 @@
+"""Checkpointing for long-running clustering jobs.
+
+A `Checkpoint` periodically writes the state of a clustering run
+(distances, assignments, center indices and the like) to a compressed
+HDF5 file. When a run is started with a checkpoint whose file already
+exists, the clustering functions that accept one resume from the
+saved state rather than starting over.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import os
+import time
+import logging
+
+import numpy as np
+import tables
+
+from mdtraj import io
+
+from ..exception import ImproperlyConfigured, DataInvalid
+from ..util.log import timed
+from .. import mpi
+
+logger = logging.getLogger(__name__)
+
+# the phase of a run a checkpoint was saved in
+KCENTERS_STAGE = 0
+KMEDOIDS_STAGE = 1
+
+
+class Checkpoint(object):
+    """Periodically save the state of a clustering run to an HDF5 file.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the checkpoint file. If the file exists, runs given this
+        checkpoint resume from it.
+    every_n : int, default=None
+        Save after this many steps (e.g. new kcenters centers) since the
+        last save.
+    every_seconds : float, default=None
+        Save after this many seconds since the last save.
+    mpi_mode : bool, default=False
+        Each MPI rank writes its own file, named by inserting the rank
+        before the extension of `filename` (e.g. `ckpt.h5` becomes
+        `ckpt.rank0.h5`). The decision to save is made on rank 0, so
+        that every rank saves the same step.
+    """
+
+    def __init__(self, filename, every_n=None, every_seconds=None,
+                 mpi_mode=False):
+
+        if every_n is None and every_seconds is None:
+            raise ImproperlyConfigured(
+                "A checkpoint requires at least one of every_n and "
+                "every_seconds.")
+
+        if mpi_mode:
+            root, ext = os.path.splitext(filename)
+            filename = '%s.rank%s%s' % (root, mpi.MPI_RANK, ext)
+
+        self.filename = filename
+        self.every_n = every_n
+        self.every_seconds = every_seconds
+        self.mpi_mode = mpi_mode
+
+        self._steps = 0
+        self._last_save = time.perf_counter()
+
+    def exists(self):
+        return os.path.isfile(self.filename)
+
+    def step(self, get_state, force=False):
+        """Count a step of progress, and save the state if a save is due.
+
+        Parameters
+        ----------
+        get_state : callable
+            Function returning a dict of arrays to save. It is only
+            called if a save is due.
+        force : bool, default=False
+            Save regardless of how long it has been since the last save.
+
+        Returns
+        -------
+        saved : bool
+            Whether or not the state was saved.
+        """
+
+        self._steps += 1
+
+        due = force or (self.every_n is not None and
+                        self._steps >= self.every_n)
+        if self.every_seconds is not None:
+            due = due or (time.perf_counter() - self._last_save >=
+                          self.every_seconds)
+            if self.mpi_mode:
+                due = mpi.MPI.COMM_WORLD.bcast(due, root=0)
+
+        if due:
+            self.save(**get_state())
+
+        return due
+
+    def save(self, **arrays):
+        """Write `arrays` to the checkpoint file, replacing its contents.
+
+        The file is written in full under a temporary name and then
+        moved into place, so a failure while saving leaves the previous
+        checkpoint intact. Empty arrays (which HDF5 can't store) are
+        omitted and must be treated as such by the caller on load.
+        """
+
+        tmp_filename = self.filename + '.tmp'
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+        with timed("Wrote checkpoint in %.2f sec", logger.debug):
+            io.saveh(tmp_filename, **{k: np.asarray(v) for k, v
+                                      in arrays.items() if np.size(v) > 0})
+            os.replace(tmp_filename, self.filename)
+
+        self._steps = 0
+        self._last_save = time.perf_counter()
+
+        logger.info("Saved checkpoint to %s", self.filename)
+
+    def load(self):
+        """Read the arrays in the checkpoint file.
+
+        Returns
+        -------
+        state : dict or None
+            The arrays in the checkpoint, by name, or None if the
+            checkpoint file doesn't exist.
+
+        Raises
+        ------
+        DataInvalid
+            In `mpi_mode`, if the ranks' checkpoints weren't all saved
+            at the same point (e.g. a job failed while saving).
+        """
+
+        state = None
+        if self.exists():
+            with tables.open_file(self.filename) as handle:
+                state = {node.name: node[:]
+                         for node in handle.list_nodes('/')}
+            logger.info("Loaded checkpoint from %s", self.filename)
+
+        if self.mpi_mode:
+            progress = mpi.MPI.COMM_WORLD.allgather(_progress(state))
+            if any(p != progress[0] for p in progress):
+                raise DataInvalid(
+                    "Checkpoints disagree across ranks; (stage, centers, "
+                    "kmedoids sweeps) by rank is %s." % progress)
+
+        return state
+
+
+def clustering_state(stage, center_indices, assignments, distances,
+                     **scalars):
+    """Build the dict of arrays describing a clustering run to save in
+    a checkpoint.
+
+    Parameters
+    ----------
+    stage : int
+        The phase of the run (KCENTERS_STAGE or KMEDOIDS_STAGE).
+    center_indices : list, [index, ...] or [(rank, index), ...]
+        The indices of the current centers.
+    assignments : array, shape=(n_frames,)
+        The current assignment of each frame.
+    distances : array, shape=(n_frames,)
+        The current distance between each frame and its center.
+
+    Any additional keyword arguments are saved as scalars.
+    """
+
+    state = {
+        'stage': np.array([stage]),
+        'center_indices': np.array(center_indices),
+        'assignments': assignments,
+        'distances': distances,
+    }
+    state.update({k: np.array([v]) for k, v in scalars.items()})
+
+    return state
+
+
+def restore_clustering(state, n_frames, stage=None):
+    """Get the center indices, assignments and distances saved in a
+    checkpoint by `clustering_state`.
+
+    Parameters
+    ----------
+    state : dict
+        The arrays loaded from a checkpoint.
+    n_frames : int
+        The number of frames being clustered, which must match the
+        number of frames in the checkpoint.
+    stage : int, default=None
+        If given, require that the checkpoint was saved in this stage.
+
+    Returns
+    -------
+    center_indices : list, [index, ...] or [(rank, index), ...]
+        The indices of the centers.
+    assignments : array, shape=(n_frames,)
+        The assignment of each frame.
+    distances : array, shape=(n_frames,)
+        The distance between each frame and its center.
+    """
+
+    if len(state['distances']) != n_frames:
+        raise DataInvalid(
+            "Checkpoint has %s frames, but data has %s frames. Was it "
+            "saved for a different data set?" %
+            (len(state['distances']), n_frames))
+
+    if stage is not None and scalar(state, 'stage') != stage:
+        raise DataInvalid(
+            "Checkpoint was saved in stage %s, expected stage %s." %
+            (scalar(state, 'stage'), stage))
+
+    center_indices = state.get('center_indices', np.zeros(0, dtype=int))
+    if len(center_indices.shape) == 2:
+        center_indices = [(int(r), int(i)) for r, i in center_indices]
+    else:
+        center_indices = [int(i) for i in center_indices]
+
+    return center_indices, state['assignments'], state['distances']
+
+
+def check_criteria(state, n_clusters, dist_cutoff, n_iters=None):
+    """Check that a run with the given stopping criteria can resume from
+    a checkpoint.
+
+    A run can resume only if it would have reached the saved state
+    itself, i.e. if it needs more work from it. In the kcenters stage,
+    this means it must not have stopped at fewer centers or at a larger
+    max distance; a larger `n_clusters` or smaller `dist_cutoff` is
+    fine. In the kmedoids stage, the kcenters stage is over, so both
+    must be unchanged and `n_iters` must be at least the number of
+    updates already done.
+
+    Parameters
+    ----------
+    state : dict
+        The arrays loaded from a checkpoint.
+    n_clusters : int or np.inf
+        The maximum number of centers of the run.
+    dist_cutoff : float
+        The max distance at which the run's kcenters stage stops.
+    n_iters : int, default=None
+        The number of kmedoids updates of the run, if it has any.
+
+    Raises
+    ------
+    DataInvalid
+        If the checkpoint was saved by a run with stopping criteria the
+        new run can't continue from.
+    """
+
+    saved_clusters = scalar(state, 'n_clusters')
+    saved_cutoff = scalar(state, 'dist_cutoff')
+
+    if saved_clusters is None or saved_cutoff is None:
+        logger.warning(
+            "Checkpoint doesn't record the stopping criteria of the run "
+            "that saved it; assuming it is compatible.")
+        return
+
+    stage = scalar(state, 'stage')
+    n_centers = len(state.get('center_indices', []))
+
+    if stage == KCENTERS_STAGE:
+        if n_centers > n_clusters:
+            raise DataInvalid(
+                "Checkpoint already has %s centers, more than the %s "
+                "requested." % (n_centers, n_clusters))
+
+        # the saved run only added centers while the max distance was
+        # above its cutoff, so a smaller cutoff would have too; a larger
+        # one would have too only if it is still below the max distance.
+        max_distance = scalar(state, 'max_distance')
+        if dist_cutoff > saved_cutoff and max_distance <= dist_cutoff:
+            raise DataInvalid(
+                "Checkpoint was saved with a distance cutoff of %s, and a "
+                "run with a cutoff of %s would have stopped before it." %
+                (saved_cutoff, dist_cutoff))
+    else:
+        if n_clusters != saved_clusters or dist_cutoff != saved_cutoff:
+            raise DataInvalid(
+                "Checkpoint was saved after kcenters with n_clusters=%s "
+                "and dist_cutoff=%s, but the run has n_clusters=%s and "
+                "dist_cutoff=%s." %
+                (saved_clusters, saved_cutoff, n_clusters, dist_cutoff))
+
+        n_done = int(scalar(state, 'kmedoids_iters', 0))
+        if n_iters is not None and n_iters < n_done:
+            raise DataInvalid(
+                "Checkpoint was saved after %s kmedoids updates, more than "
+                "the %s requested." % (n_done, n_iters))
+
+
+def _progress(state):
+    """How far along the run a checkpoint was saved, to compare across
+    MPI ranks.
+    """
+
+    if state is None:
+        return None
+
+    return (int(scalar(state, 'stage')),
+            len(state.get('center_indices', [])),
+            int(scalar(state, 'kmedoids_iters', 0)))
+
+
+def scalar(state, name, default=None):
+    """Get a scalar saved by `clustering_state`.
+    """
+
+    if name in state:
+        return state[name][0]
+    return default
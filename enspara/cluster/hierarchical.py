@@ -0,0 +1,334 @@
+"""Two-level clustering for data sets too large to cluster directly.
+
+A coarse kcenters clustering of a subsample of the data splits the
+frames into a few large clusters, and each of those is then clustered
+independently (and in parallel) with kcenters, or khybrid if kmedoids
+updates are requested. Each fine clustering only compares its frames to
+its own centers, so the total work scales with the size of the coarse
+clusters rather than with n_frames * n_clusters.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import time
+import logging
+import multiprocessing as mp
+
+from contextlib import closing
+
+import numpy as np
+
+from sklearn.utils import check_random_state
+
+from . import kcenters
+from .hybrid import hybrid
+from .util import (assign_to_nearest_center, ClusterResult, Clusterer,
+                   ClusterMembership)
+
+from ..exception import ImproperlyConfigured
+
+logger = logging.getLogger(__name__)
+
+
+class HierarchicalKCenters(Clusterer):
+    """Sklearn-style object for two-level (coarse, then fine) kcenters
+    clustering.
+
+    Kcenters is first run on a random subsample of the data to find
+    `n_coarse_clusters` coarse centers (or as many as are needed to
+    reach `coarse_cluster_radius`), and every frame is assigned to its
+    nearest coarse center. Each coarse cluster is then clustered on its
+    own, in a pool of `n_procs` processes, and the fine clusters of all
+    coarse clusters are merged into a single clustering.
+
+    The result is an approximation: a frame is only ever assigned to a
+    fine center within its own coarse cluster, even if a fine center in
+    a neighboring coarse cluster is closer.
+
+    Parameters
+    ----------
+    metric : required
+        Distance metric used while comparing data points. Must be
+        picklable when `n_procs` > 1.
+    n_clusters : int, default=None
+        The total number of fine clusters. Each coarse cluster gets a
+        share proportional to its number of frames (and at least one).
+    cluster_radius : float, default=None
+        Add fine centers to each coarse cluster until all its frames
+        are at most this far from one.
+    n_coarse_clusters : int, default=None
+        The number of coarse clusters.
+    coarse_cluster_radius : float, default=None
+        Add coarse centers until every frame of the subsample is at
+        most this far from one.
+    subsample : int, default=None
+        The number of frames, chosen at random, to find the coarse
+        centers among. When `None`, every frame is used.
+    kmedoids_updates : int, default=0
+        Number of rounds of kmedoids to refine each fine clustering
+        with.
+    n_procs : int, default=1
+        Number of processes in which to cluster the coarse clusters.
+    random_state : int or np.RandomState
+        Random state to use to seed the random number generator.
+
+    Attributes
+    ----------
+    coarse_result_ : ClusterResult
+        The coarse clustering of all the frames.
+    """
+
+    def __init__(self, n_clusters=None, cluster_radius=None,
+                 n_coarse_clusters=None, coarse_cluster_radius=None,
+                 subsample=None, kmedoids_updates=0, n_procs=1,
+                 *args, **kwargs):
+
+        super(HierarchicalKCenters, self).__init__(self, *args, **kwargs)
+
+        if n_clusters is None and cluster_radius is None:
+            raise ImproperlyConfigured(
+                "Either n_clusters or cluster_radius is required for "
+                "HierarchicalKCenters clustering")
+        if n_coarse_clusters is None and coarse_cluster_radius is None:
+            raise ImproperlyConfigured(
+                "Either n_coarse_clusters or coarse_cluster_radius is "
+                "required for HierarchicalKCenters clustering")
+
+        self.n_clusters = n_clusters
+        self.cluster_radius = cluster_radius
+        self.n_coarse_clusters = n_coarse_clusters
+        self.coarse_cluster_radius = coarse_cluster_radius
+        self.subsample = subsample
+        self.kmedoids_updates = kmedoids_updates
+        self.n_procs = n_procs
+
+    def fit(self, X):
+        """Takes trajectories, X, and performs hierarchical KCenters
+        clustering.
+
+        Parameters
+        ----------
+        X : array-like, shape=(n_observations, n_features(, n_atoms))
+            Data to cluster.
+        """
+
+        t0 = time.perf_counter()
+
+        self.coarse_result_ = coarse_clustering(
+            X, self.metric,
+            n_clusters=self.n_coarse_clusters,
+            dist_cutoff=self.coarse_cluster_radius,
+            subsample=self.subsample,
+            random_state=self.random_state)
+
+        self.result_ = refine_clustering(
+            X, self.metric, self.coarse_result_.assignments,
+            n_clusters=self.n_clusters,
+            dist_cutoff=self.cluster_radius,
+            n_iters=self.kmedoids_updates,
+            n_procs=self.n_procs,
+            random_state=self.random_state)
+
+        self.runtime_ = time.perf_counter() - t0
+
+        return self
+
+
+def coarse_clustering(X, distance_method, n_clusters=None, dist_cutoff=None,
+                      subsample=None, random_state=None):
+    """Find coarse kcenters centers among a random subsample of `X`, and
+    assign all of `X` to them.
+
+    Parameters
+    ----------
+    X : array-like, shape=(n_observations, n_features(, n_atoms))
+        Data to cluster.
+    distance_method : callable
+        Distance metric, as for `kcenters`.
+    n_clusters : int, default=None
+        The number of coarse clusters.
+    dist_cutoff : float, default=None
+        Add coarse centers until every frame in the subsample is at
+        most this far from one.
+    subsample : int, default=None
+        The number of frames to find the centers among. When `None` (or
+        at least `len(X)`), every frame is used.
+    random_state : int or np.RandomState, default=None
+        Random state used to choose the subsample.
+
+    Returns
+    -------
+    result : ClusterResult
+        The coarse clustering of `X`. Center indices index `X`.
+    """
+
+    random_state = check_random_state(random_state)
+
+    if subsample is None or subsample >= len(X):
+        sample_inds = np.arange(len(X))
+    else:
+        sample_inds = np.sort(
+            random_state.choice(len(X), size=subsample, replace=False))
+
+    result = kcenters.kcenters(
+        X[sample_inds], distance_method, n_clusters=n_clusters,
+        dist_cutoff=dist_cutoff)
+
+    center_inds = sample_inds[result.center_indices]
+    logger.info("Found %s coarse centers among %s frames.",
+                len(center_inds), len(sample_inds))
+
+    assignments, distances = assign_to_nearest_center(
+        X, result.centers, distance_method)
+
+    return ClusterResult(
+        center_indices=center_inds,
+        assignments=assignments,
+        distances=distances,
+        centers=result.centers)
+
+
+def refine_clustering(X, distance_method, coarse_assignments,
+                      n_clusters=None, dist_cutoff=None, n_iters=0,
+                      n_procs=1, random_state=None):
+    """Cluster the frames of each coarse cluster independently, and
+    merge the results into one clustering of `X`.
+
+    Parameters
+    ----------
+    X : array-like, shape=(n_observations, n_features(, n_atoms))
+        Data to cluster.
+    distance_method : callable
+        Distance metric, as for `kcenters`.
+    coarse_assignments : array-like, shape=(n_observations,)
+        The coarse cluster of each frame.
+    n_clusters : int, default=None
+        The total number of fine clusters, divided among the coarse
+        clusters by `allocate_clusters`.
+    dist_cutoff : float, default=None
+        Add fine centers until every frame is at most this far from
+        one.
+    n_iters : int, default=0
+        Number of kmedoids updates to refine each fine clustering with.
+    n_procs : int, default=1
+        Number of processes to cluster the coarse clusters in.
+    random_state : int or np.RandomState, default=None
+        Random state used to seed each fine clustering's kmedoids.
+
+    Returns
+    -------
+    result : ClusterResult
+        The merged clustering. Fine clusters are numbered in order of
+        their coarse cluster, and center indices index `X`.
+    """
+
+    random_state = check_random_state(random_state)
+
+    coarse_assignments = np.asarray(coarse_assignments)
+    members = ClusterMembership(coarse_assignments)
+    members = [members[c] for c in range(len(members))
+               if len(members[c]) > 0]
+
+    if n_clusters is None:
+        fine_n_clusters = [np.inf] * len(members)
+    else:
+        fine_n_clusters = allocate_clusters(
+            [len(m) for m in members], n_clusters)
+
+    # seeds are drawn up front so the result doesn't depend on n_procs.
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=len(members))
+
+    tasks = [(X[m], distance_method, k, dist_cutoff, n_iters, seed)
+             for m, k, seed in zip(members, fine_n_clusters, seeds)]
+
+    if n_procs == 1:
+        fine_results = [_refine_cluster(task) for task in tasks]
+    else:
+        with closing(mp.Pool(processes=n_procs)) as p:
+            fine_results = p.map(_refine_cluster, tasks, chunksize=1)
+        p.join()
+
+    center_inds = []
+    assignments = np.zeros(len(coarse_assignments), dtype=int)
+    distances = np.zeros(len(coarse_assignments), dtype=np.float64)
+
+    for frames, (local_ctr_inds, local_assigs, local_dists) in zip(
+            members, fine_results):
+        assignments[frames] = np.asarray(local_assigs) + len(center_inds)
+        distances[frames] = local_dists
+        center_inds.extend(frames[local_ctr_inds])
+
+    logger.info("Refined %s coarse clusters into %s clusters.",
+                len(members), len(center_inds))
+
+    center_inds = np.array(center_inds, dtype=int)
+
+    return ClusterResult(
+        center_indices=center_inds,
+        assignments=assignments,
+        distances=distances,
+        centers=X[center_inds])
+
+
+def allocate_clusters(sizes, n_clusters):
+    """Divide `n_clusters` among clusters of the given sizes, in
+    proportion to their size.
+
+    Every cluster gets at least one and at most `size` clusters, and
+    the rest are given out by largest remainder. The shares sum to
+    `n_clusters` unless that's fewer than `len(sizes)` or more than
+    `sum(sizes)`.
+
+    Parameters
+    ----------
+    sizes : array-like, shape=(n_coarse_clusters,)
+        The number of frames in each coarse cluster.
+    n_clusters : int
+        The total number of fine clusters.
+
+    Returns
+    -------
+    shares : np.ndarray, shape=(n_coarse_clusters,)
+        The number of fine clusters for each coarse cluster.
+    """
+
+    sizes = np.asarray(sizes, dtype=int)
+
+    # every cluster gets one, and the rest are divided in proportion.
+    n_extra = min(n_clusters, sizes.sum()) - len(sizes)
+    quotas = max(n_extra, 0) * sizes / sizes.sum()
+    extra = np.minimum(np.floor(quotas).astype(int), sizes - 1)
+
+    # hand out what's left, largest remainder first, to clusters that
+    # can still take one.
+    order = np.argsort(-(quotas - np.floor(quotas)), kind='mergesort')
+    remaining = n_extra - extra.sum()
+    while remaining > 0:
+        for i in order[extra[order] < sizes[order] - 1][:remaining]:
+            extra[i] += 1
+            remaining -= 1
+
+    shares = 1 + extra
+
+    return shares
+
+
+def _refine_cluster(task):
+    """Cluster the frames of one coarse cluster. Runs in a worker
+    process.
+    """
+
+    X, distance_method, n_clusters, dist_cutoff, n_iters, seed = task
+
+    if n_iters > 0:
+        result = hybrid(
+            X, distance_method, n_iters=n_iters, n_clusters=n_clusters,
+            dist_cutoff=dist_cutoff if dist_cutoff is not None else 0,
+            random_state=np.random.RandomState(seed))
+    else:
+        result = kcenters.kcenters(
+            X, distance_method, n_clusters=n_clusters,
+            dist_cutoff=dist_cutoff)
+
+    return (np.asarray(result.center_indices, dtype=int),
+            result.assignments, result.distances)
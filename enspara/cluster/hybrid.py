@@ -14,9 +14,13 @@ import numpy as np
 
 from . import kcenters
 from . import kmedoids
-from .util import _get_distance_method, ClusterResult, Clusterer
+from . import checkpoint as ckpt
+from .util import (_get_distance_method, AssignmentBounds, ClusterResult,
+                   Clusterer)
 
 from ..exception import ImproperlyConfigured
+from ..geometry import libdist
+from ..util.store import CoordinateStore, SharedCoordinates
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +49,23 @@ class KHybrid(Clusterer):
         choosing the zeroth element (default)
     random_state : int or np.RandomState
         Random state to use to seed the random number generator.
+    checkpoint : Checkpoint, default=None
+        Periodically save the state of the run to this checkpoint and,
+        if its file exists, resume from it.
+    kmedoids_batch_size : int, default=None
+        If given, each round of kmedoids proposes new centers for this
+        many clusters at a time, rather than one at a time.
+    distance_cache : DistanceCache, default=None
+        If given, the distances from kcenters' centers (and accepted
+        kmedoids proposals) to every frame are kept in this cache and
+        reused by the kmedoids updates. Entries are keyed by frame
+        index, so a cache must not be shared between data sets;
+        `partial_fit` doesn't use it.
+    n_procs : int, default=1
+        Number of processes to compute distances in. The data is copied
+        once into shared memory, and each process computes the
+        distances for its share of the frames. The metric must be
+        picklable.
 
     References
     ----------
@@ -52,8 +73,9 @@ class KHybrid(Clusterer):
     """
 
     def __init__(self, n_clusters=None, cluster_radius=None,
-                 kmedoids_updates=5, random_first_center=False, *args,
-                 **kwargs):
+                 kmedoids_updates=5, random_first_center=False,
+                 checkpoint=None, kmedoids_batch_size=None,
+                 distance_cache=None, n_procs=1, *args, **kwargs):
 
         super(KHybrid, self).__init__(self, *args, **kwargs)
 
@@ -65,6 +87,10 @@ class KHybrid(Clusterer):
         self.n_clusters = n_clusters
         self.cluster_radius = cluster_radius
         self.random_first_center = random_first_center
+        self.checkpoint = checkpoint
+        self.kmedoids_batch_size = kmedoids_batch_size
+        self.distance_cache = distance_cache
+        self.n_procs = n_procs
 
     def fit(self, X, init_centers=None):
         """Takes trajectories, X, and performs KHybrid clustering.
@@ -86,7 +112,72 @@ class KHybrid(Clusterer):
             dist_cutoff=self.cluster_radius,
             random_first_center=self.random_first_center,
             init_centers=init_centers,
-            random_state=self.random_state)
+            random_state=self.random_state,
+            checkpoint=self.checkpoint,
+            batch_size=self.kmedoids_batch_size,
+            distance_cache=self.distance_cache,
+            n_procs=self.n_procs)
+
+        self.runtime_ = time.perf_counter() - t0
+
+        return self
+
+    def partial_fit(self, X):
+        """Update the clustering after new observations are appended to
+        the data, without reclustering the data already fit.
+
+        The new observations are assigned to the existing centers, and
+        kcenters continues from the resulting clustering only until
+        `cluster_radius` (or `n_clusters`) is satisfied again. The
+        kmedoids updates then only propose new centers for the clusters
+        that gained or lost observations. If nothing has been fit yet,
+        this is `fit`.
+
+        Parameters
+        ----------
+        X : array-like, shape=(n_observations, n_features(, n_atoms))
+            The data previously fit, followed by the new observations.
+        """
+
+        if not hasattr(self, 'result_'):
+            return self.fit(X)
+
+        t0 = time.perf_counter()
+
+        n_fit, clustering = self._extend_clustering(X)
+        result = kcenters.kcenters(
+            X, self.metric, n_clusters=self.n_clusters,
+            dist_cutoff=self.cluster_radius, init_clustering=clustering)
+
+        cluster_center_inds, assignments, distances = (
+            result.center_indices, result.assignments, result.distances)
+
+        # clusters whose membership changed: those new observations were
+        # assigned to, and those old observations moved between.
+        moved = np.flatnonzero(assignments[:n_fit] != self.labels_)
+        affected = np.unique(np.concatenate([
+            assignments[n_fit:], assignments[moved], self.labels_[moved]]))
+
+        logger.info("Updating %s of %s clusters for %s new observations.",
+                    len(affected), len(cluster_center_inds), len(X) - n_fit)
+
+        bounds = AssignmentBounds(assignments, distances)
+        for i in range(self.kmedoids_updates):
+            cluster_center_inds, distances, assignments = \
+                kmedoids._kmedoids_pam_update(
+                    X, self.metric,
+                    cluster_center_inds, assignments, distances,
+                    cost=np.max,
+                    random_state=self.random_state,
+                    batch_size=self.kmedoids_batch_size,
+                    cluster_ids=affected,
+                    bounds=bounds)
+
+        self.result_ = ClusterResult(
+            center_indices=cluster_center_inds,
+            assignments=assignments,
+            distances=distances,
+            centers=X[cluster_center_inds])
 
         self.runtime_ = time.perf_counter() - t0
 
@@ -144,27 +235,89 @@ class KHybridMPI(Clusterer):
 def hybrid(
         X, distance_method, n_iters=5, n_clusters=np.inf,
         dist_cutoff=0, random_first_center=False,
-        init_centers=None, random_state=None):
+        init_centers=None, random_state=None, checkpoint=None,
+        batch_size=None, distance_cache=None, n_procs=1):
+    """KHybrid clustering: kcenters followed by `n_iters` kmedoids
+    sweeps.
+
+    If `checkpoint` is given, the kcenters stage is checkpointed as in
+    `kcenters`, and the state is saved after every kmedoids sweep. If
+    its file exists, the run resumes from the saved state in either
+    stage. If `batch_size` is given, each kmedoids sweep proposes new
+    centers for that many clusters at a time. If `distance_cache` (a
+    DistanceCache) is given, kcenters stores each center's distances to
+    every frame in it, and kmedoids reads them back rather than
+    recomputing them. If `n_procs` > 1, `X` is copied into a
+    SharedCoordinates store and distances are computed in that many
+    processes.
+    """
 
     distance_method = _get_distance_method(distance_method)
 
-    result = kcenters.kcenters(
-        X, distance_method, n_clusters=n_clusters, dist_cutoff=dist_cutoff,
-        init_centers=init_centers, random_first_center=random_first_center)
-
-    cluster_center_inds, assignments, distances = (
-        result.center_indices, result.assignments, result.distances)
-
-    for i in range(n_iters):
+    if n_procs > 1 and not isinstance(X, CoordinateStore):
+        with SharedCoordinates(
+                X, n_procs=n_procs,
+                prepare=distance_method is libdist.rmsd) as shared:
+            result = hybrid(
+                shared, distance_method, n_iters=n_iters,
+                n_clusters=n_clusters, dist_cutoff=dist_cutoff,
+                random_first_center=random_first_center,
+                init_centers=init_centers, random_state=random_state,
+                checkpoint=checkpoint, batch_size=batch_size,
+                distance_cache=distance_cache)
+        return result._replace(centers=X[result.center_indices])
+
+    # as in kcenters, so that the criteria saved in checkpoints compare.
+    if n_clusters is None and dist_cutoff is not None:
+        n_clusters = np.inf
+    elif n_clusters is not None and dist_cutoff is None:
+        dist_cutoff = 0
+
+    state = checkpoint.load() if checkpoint is not None else None
+
+    if state is not None and \
+            ckpt.scalar(state, 'stage') == ckpt.KMEDOIDS_STAGE:
+        cluster_center_inds, assignments, distances = \
+            ckpt.restore_clustering(state, len(X))
+        ckpt.check_criteria(state, n_clusters, dist_cutoff, n_iters)
+        first_iter = int(ckpt.scalar(state, 'kmedoids_iters'))
+        logger.info("Resuming from checkpoint after %s kmedoids updates.",
+                    first_iter)
+    else:
+        result = kcenters.kcenters(
+            X, distance_method, n_clusters=n_clusters,
+            dist_cutoff=dist_cutoff, init_centers=init_centers,
+            random_first_center=random_first_center, checkpoint=checkpoint,
+            distance_cache=distance_cache)
+
+        cluster_center_inds, assignments, distances = (
+            result.center_indices, result.assignments, result.distances)
+        first_iter = 0
+
+    # bounds tightened by each sweep make the following sweeps cheaper.
+    bounds = AssignmentBounds(assignments, distances)
+
+    for i in range(first_iter, n_iters):
         cluster_center_inds, distances, assignments = \
             kmedoids._kmedoids_pam_update(
                 X, distance_method,
                 cluster_center_inds, assignments, distances,
                 cost=np.max,
-                random_state=random_state)
+                random_state=random_state,
+                batch_size=batch_size,
+                bounds=bounds,
+                distance_cache=distance_cache)
 
         logger.info("KMedoids update %s of %s", i, n_iters)
 
+        # a sweep costs about as much as a whole kcenters run, so
+        # always save after one.
+        if checkpoint is not None:
+            checkpoint.save(**ckpt.clustering_state(
+                ckpt.KMEDOIDS_STAGE, cluster_center_inds, assignments,
+                distances, kmedoids_iters=i+1, n_clusters=n_clusters,
+                dist_cutoff=dist_cutoff))
+
     return ClusterResult(
         center_indices=cluster_center_inds,
         assignments=assignments,
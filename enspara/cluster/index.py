@@ -0,0 +1,219 @@
+"""Metric-tree indices over cluster centers for fast assignment.
+
+Assigning frames to their nearest center by brute force costs one
+distance computation per frame per center. A `VPTree` (vantage-point
+tree) over the centers uses the triangle inequality to skip most of
+those computations while still finding the exact nearest center.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import logging
+import functools
+
+import numpy as np
+
+from sklearn.utils import check_random_state
+
+from ..exception import DataInvalid, ImproperlyConfigured
+from ..geometry import libdist
+from .util import _get_distance_method
+from .kcenters import _in_place_metric
+
+logger = logging.getLogger(__name__)
+
+
+class VPTree(object):
+    """Vantage-point tree over a set of cluster centers, supporting
+    exact nearest-center queries.
+
+    Each internal node of the tree holds a vantage point (one of the
+    centers) and splits the rest of its centers into those closer to it
+    than the median distance and those farther away. A query computes
+    its distance to the vantage point, and skips either half if the
+    triangle inequality guarantees that it holds no center closer than
+    the best found so far. Queries are answered for many frames at
+    once, so each visited node costs a single vectorized distance
+    computation.
+
+    Trees are picklable, and so can be saved alongside the centers and
+    reused for many assignments.
+
+    Parameters
+    ----------
+    centers : array-like, shape=(n_centers, n_features(, n_atoms))
+        The cluster centers to index.
+    metric : str or callable, default='rmsd'
+        Distance metric, as accepted by `Clusterer`. It must obey the
+        triangle inequality, or queries may return a center that isn't
+        the nearest. A callable must be picklable for the tree to be.
+    leaf_size : int, default=8
+        Nodes with at most this many centers aren't split further, and
+        queries compute the distance to each of their centers.
+    random_state : int or np.RandomState, default=None
+        Random state used to choose vantage points.
+    """
+
+    def __init__(self, centers, metric='rmsd', leaf_size=8,
+                 random_state=None):
+
+        if leaf_size < 1:
+            raise ImproperlyConfigured(
+                "Leaf size must be positive, got %s." % leaf_size)
+        if len(centers) == 0:
+            raise DataInvalid("Can't build a VPTree with no centers.")
+
+        self.metric = metric
+        self.leaf_size = leaf_size
+
+        distance_method = _get_distance_method(metric)
+        if distance_method is libdist.rmsd and \
+                not isinstance(centers, libdist.PreparedCoordinates):
+            centers = libdist.PreparedCoordinates(centers)
+        self.centers = centers
+
+        random_state = check_random_state(random_state)
+        self._root = self._build(
+            np.arange(len(centers)), distance_method, random_state)
+
+    def __len__(self):
+        return len(self.centers)
+
+    def _build(self, center_inds, distance_method, random_state):
+        """Build the tree over `center_inds`.
+
+        Leaves are arrays of center indices. Internal nodes are tuples
+        (vantage point, median distance, inside subtree, outside
+        subtree), where the centers inside are no farther from the
+        vantage point than the median distance and those outside no
+        closer. Centers are split evenly even when many are tied at the
+        median (e.g. duplicate frames), so the tree has logarithmic
+        depth. It is built without recursion, top down, and its nodes
+        are then assembled bottom up.
+        """
+
+        nodes = [center_inds]
+        i = 0
+        while i < len(nodes):
+            inds = nodes[i]
+            if len(inds) > self.leaf_size:
+                j = random_state.randint(len(inds))
+                vantage = inds[j]
+                rest = np.delete(inds, j)
+
+                d = distance_method(self.centers[rest], self.centers[vantage])
+                order = np.argsort(d, kind='mergesort')
+                half = len(rest) // 2
+
+                nodes[i] = (vantage, np.median(d), len(nodes), len(nodes)+1)
+                nodes.append(rest[order[:half]])
+                nodes.append(rest[order[half:]])
+            i += 1
+
+        # children always come after their parents.
+        for i in reversed(range(len(nodes))):
+            if isinstance(nodes[i], tuple):
+                vantage, radius, inside, outside = nodes[i]
+                nodes[i] = (vantage, radius, nodes[inside], nodes[outside])
+
+        return nodes[0]
+
+    def query(self, X):
+        """Find the nearest center to each frame in `X`.
+
+        Parameters
+        ----------
+        X : array-like, shape=(n_frames, n_features(, n_atoms))
+            The frames to assign. For RMSD, `PreparedCoordinates` avoid
+            re-centering the frames at each visited node.
+
+        Returns
+        -------
+        assignments : ndarray, shape=(n_frames,)
+            The index of the nearest center to each frame. Ties go to
+            the lowest index, as in `assign_to_nearest_center`.
+        distances : ndarray, shape=(n_frames,)
+            The distance from each frame to its nearest center.
+        """
+
+        distance_method = _get_distance_method(self.metric)
+        if distance_method is libdist.rmsd and \
+                not isinstance(X, libdist.PreparedCoordinates):
+            X = libdist.PreparedCoordinates(X)
+
+        assignments = np.full(len(X), -1, dtype=int)
+        distances = np.full(len(X), np.inf, dtype=np.float64)
+        self._n_computed = 0
+
+        self._search(self._root, X, np.arange(len(X)), distance_method,
+                     assignments, distances)
+
+        logger.debug(
+            "VPTree computed %s distances (%.1f%% of brute force).",
+            self._n_computed,
+            100 * self._n_computed / max(len(X) * len(self), 1))
+
+        return assignments, distances
+
+    def _search(self, node, X, frames, distance_method, assignments,
+                distances):
+        """Update the best `assignments` and `distances` of `frames`
+        (indices into `X`) with the centers in the subtree `node`.
+        """
+
+        if len(frames) == 0:
+            return
+
+        # libdist metrics compute the distances of a subset of frames
+        # in place; otherwise, the subset is copied once per node (and
+        # not at all at the root, where it is all of X).
+        if _in_place_metric(X, distance_method) is not None:
+            dist = functools.partial(distance_method, X, frames=frames)
+        elif len(frames) == len(X):
+            dist = functools.partial(distance_method, X)
+        else:
+            dist = functools.partial(distance_method, X[frames])
+
+        if not isinstance(node, tuple):
+            for center_ind in node:
+                self._update(frames, center_ind,
+                             dist(self.centers[center_ind]),
+                             assignments, distances)
+            return
+
+        vantage, radius, inside, outside = node
+        d = dist(self.centers[vantage])
+        self._update(frames, vantage, d, assignments, distances)
+
+        # a center c inside (d(v, c) < radius) is at least
+        # d(x, v) - radius from x, and a center outside at least
+        # radius - d(x, v); a side is searched only if that could beat
+        # the best distance so far. Each frame searches its own side of
+        # the split first, which makes the other side more likely to be
+        # pruned.
+        near = d < radius
+        for first_side in [True, False]:
+            for side in [first_side, not first_side]:
+                mask = near == first_side
+                if side:
+                    mask &= (d - radius <= distances[frames])
+                    self._search(inside, X, frames[mask], distance_method,
+                                 assignments, distances)
+                else:
+                    mask &= (radius - d <= distances[frames])
+                    self._search(outside, X, frames[mask], distance_method,
+                                 assignments, distances)
+
+    def _update(self, frames, center_ind, d, assignments, distances):
+        self._n_computed += len(frames)
+
+        best = distances[frames]
+        closer = (d < best) | ((d == best) &
+                               (center_ind < assignments[frames]))
+        distances[frames[closer]] = d[closer]
+        assignments[frames[closer]] = center_ind
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_n_computed', None)
+        return state
@@ -14,10 +14,13 @@ import logging
 import numpy as np
 
 from ..util import log
-from ..exception import ImproperlyConfigured
+from ..exception import ImproperlyConfigured, DataInvalid
+from ..geometry import libdist
+from ..util.store import CoordinateStore
 from .. import mpi
 
 from . import util
+from . import checkpoint as ckpt
 
 logger = logging.getLogger(__name__)
 
@@ -47,6 +50,17 @@ class KCenters(util.Clusterer):
         choosing the zeroth element (default)
     random_state : int or np.RandomState
         Random state to use to seed the random number generator.
+    use_triangle_inequality : bool, default=False
+        Skip distance computations for observations that the triangle
+        inequality guarantees cannot be reassigned to a new center.
+        Only valid for metrics that obey the triangle inequality (e.g.
+        RMSD, euclidean distance).
+    distance_dtype : np.dtype, default=np.float64
+        Data type in which to store the distance from each observation
+        to its center. np.float32 halves the memory footprint.
+    checkpoint : Checkpoint, default=None
+        Periodically save the state of the run to this checkpoint and,
+        if its file exists, resume from it.
 
     References
     ----------
@@ -55,7 +69,8 @@ class KCenters(util.Clusterer):
 
     def __init__(
             self, n_clusters=None, cluster_radius=None,
-            random_first_center=False, *args, **kwargs):
+            random_first_center=False, use_triangle_inequality=False,
+            distance_dtype=np.float64, checkpoint=None, *args, **kwargs):
 
         if n_clusters is None and cluster_radius is None:
             raise ImproperlyConfigured("Either n_clusters or cluster_radius "
@@ -64,6 +79,9 @@ class KCenters(util.Clusterer):
         self.n_clusters = n_clusters
         self.cluster_radius = cluster_radius
         self.random_first_center = random_first_center
+        self.use_triangle_inequality = use_triangle_inequality
+        self.distance_dtype = distance_dtype
+        self.checkpoint = checkpoint
 
         super().__init__(self, *args, **kwargs)
 
@@ -81,23 +99,220 @@ class KCenters(util.Clusterer):
             Begin clustring with these centers as cluster centers.
         """
 
-        t0 = time.clock()
+        t0 = time.perf_counter()
 
+        self.history_ = KCentersHistory()
         self.result_ = kcenters(
             X,
             distance_method=self.metric,
             n_clusters=self.n_clusters,
             dist_cutoff=self.cluster_radius,
             init_centers=init_centers,
-            random_first_center=self.random_first_center)
+            random_first_center=self.random_first_center,
+            use_triangle_inequality=self.use_triangle_inequality,
+            distance_dtype=self.distance_dtype,
+            history=self.history_,
+            checkpoint=self.checkpoint)
 
-        self.runtime_ = time.clock() - t0
+        self.runtime_ = time.perf_counter() - t0
         return self
 
+    def partial_fit(self, X):
+        """Update the clustering after new observations are appended to
+        the data, without reclustering the data already fit.
+
+        The new observations are assigned to the existing centers, and
+        kcenters then continues from the resulting clustering, adding
+        centers only until `cluster_radius` (or `n_clusters`) is
+        satisfied again. If nothing has been fit yet, this is `fit`.
+
+        Parameters
+        ----------
+        X : array-like, shape=(n_observations, n_features(, n_atoms))
+            The data previously fit, followed by the new observations.
+        """
+
+        if not hasattr(self, 'result_'):
+            return self.fit(X)
+
+        t0 = time.perf_counter()
+
+        n_fit, clustering = self._extend_clustering(X)
+        self.result_ = kcenters(
+            X,
+            distance_method=self.metric,
+            n_clusters=self.n_clusters,
+            dist_cutoff=self.cluster_radius,
+            use_triangle_inequality=self.use_triangle_inequality,
+            distance_dtype=self.distance_dtype,
+            init_clustering=clustering)
+
+        logger.info("Added %s centers for %s new observations.",
+                    len(self.center_indices_) - len(clustering[0]),
+                    len(X) - n_fit)
+
+        self.runtime_ = time.perf_counter() - t0
+        return self
+
+
+class KCentersHistory(object):
+    """Record of a kcenters run: the order in which centers were
+    chosen and the maximum distance between any observation and its
+    center after each choice.
+
+    Because kcenters is greedy, the first k centers of a run are exactly
+    the centers a run stopped at k would have found. Consequently, a
+    single run to the finest of several clusterings contains all of the
+    coarser ones. If `n_clusters` or `cluster_radii` are given, the
+    assignments and distances are captured as the run passes each of
+    those stopping points, so that no distance is computed more than
+    once.
+
+    Parameters
+    ----------
+    n_clusters : list of int, default=None
+        Capture the clustering at each of these numbers of centers.
+    cluster_radii : list of float, default=None
+        Capture the clustering at the point a run with each of these
+        values of `dist_cutoff` would have stopped.
+
+    Attributes
+    ----------
+    center_indices : list
+        The index of each center, in the order it was chosen. Centers
+        from a hot start (`init_centers`) come first.
+    max_distances : list of float
+        `max_distances[k-1]` is the largest distance between any
+        observation and its nearest center among the first `k`. This
+        is nan for centers of a hot start, except the last.
+    """
+
+    def __init__(self, n_clusters=None, cluster_radii=None):
+        self.n_clusters = [] if n_clusters is None else list(n_clusters)
+        self.cluster_radii = [] if cluster_radii is None else \
+            list(cluster_radii)
+
+        self.center_indices = []
+        self.max_distances = []
+
+        self._n_clusters_snapshots = {}
+        self._radius_snapshots = {}
+
+    def add_center(self, center_index):
+        self.center_indices.append(center_index)
+
+    def add_max_distance(self, max_distance):
+        self.max_distances.append(max_distance)
+
+    def checkpoint(self, max_distance, assignments, distances):
+        """Capture the current assignments and distances for every
+        stopping point that, given `max_distance` and the number of
+        centers so far, the run would have stopped at.
+        """
+
+        n_centers = len(self.center_indices)
+        snapshot = None
+
+        for k in self.n_clusters:
+            if k == n_centers and k not in self._n_clusters_snapshots:
+                snapshot = snapshot or self._snapshot(assignments, distances)
+                self._n_clusters_snapshots[k] = snapshot
+
+        for r in self.cluster_radii:
+            if max_distance <= r and r not in self._radius_snapshots:
+                snapshot = snapshot or self._snapshot(assignments, distances)
+                self._radius_snapshots[r] = snapshot
+
+    def _snapshot(self, assignments, distances):
+        return (len(self.center_indices), assignments.copy(),
+                distances.copy())
+
+    def clustering(self, n_clusters=None, cluster_radius=None):
+        """Get a clustering captured during the run.
+
+        Parameters
+        ----------
+        n_clusters : int, default=None
+            Get the clustering with this number of centers.
+        cluster_radius : float, default=None
+            Get the clustering at which a run with this `dist_cutoff`
+            would have stopped.
+
+        Returns
+        -------
+        center_indices : list
+            Indices of the centers of this clustering.
+        assignments : array, shape=(n_observations,)
+            Assignment of each observation to one of the centers.
+        distances : array, shape=(n_observations,)
+            Distance between each observation and its center.
+        """
+
+        if (n_clusters is None) == (cluster_radius is None):
+            raise ImproperlyConfigured(
+                "Exactly one of n_clusters and cluster_radius is required.")
+
+        if n_clusters is not None:
+            snapshots, key, name = (
+                self._n_clusters_snapshots, n_clusters, 'n_clusters')
+        else:
+            snapshots, key, name = (
+                self._radius_snapshots, cluster_radius, 'cluster_radius')
+
+        if key not in snapshots:
+            raise DataInvalid(
+                "No clustering was captured for %s=%s. Either it wasn't "
+                "requested, or the run stopped before reaching it." %
+                (name, key))
+
+        n_centers, assignments, distances = snapshots[key]
+        return self.center_indices[:n_centers], assignments, distances
+
+    def _arrays(self):
+        """The recorded max distances and captured clusterings as a
+        dict of arrays, for checkpointing.
+        """
+
+        arrays = {'history_max_distances': np.array(self.max_distances)}
+
+        for name, snapshots in [('n_clusters', self._n_clusters_snapshots),
+                                ('radius', self._radius_snapshots)]:
+            for i, (value, snapshot) in enumerate(sorted(snapshots.items())):
+                n_centers, assignments, distances = snapshot
+                prefix = 'history_%s_%s_' % (name, i)
+                arrays[prefix + 'value'] = np.array([value])
+                arrays[prefix + 'n_centers'] = np.array([n_centers])
+                arrays[prefix + 'assignments'] = assignments
+                arrays[prefix + 'distances'] = distances
+
+        return arrays
+
+    def _restore(self, center_indices, arrays):
+        """Restore the state of this history from the centers and
+        arrays saved in a checkpoint.
+        """
+
+        self.center_indices = list(center_indices)
+        self.max_distances = list(arrays.get('history_max_distances', []))
+
+        for name, snapshots in [('n_clusters', self._n_clusters_snapshots),
+                                ('radius', self._radius_snapshots)]:
+            i = 0
+            while 'history_%s_%s_value' % (name, i) in arrays:
+                prefix = 'history_%s_%s_' % (name, i)
+                snapshots[arrays[prefix + 'value'][0]] = (
+                    int(arrays[prefix + 'n_centers'][0]),
+                    arrays[prefix + 'assignments'],
+                    arrays[prefix + 'distances'])
+                i += 1
+
 
 def kcenters(
         traj, distance_method, n_clusters=np.inf, dist_cutoff=0,
-        init_centers=None, random_first_center=False):
+        init_centers=None, random_first_center=False,
+        use_triangle_inequality=False, distance_dtype=np.float64,
+        history=None, checkpoint=None, init_clustering=None,
+        distance_cache=None):
     """The functional (rather than object-oriented) implementation of
     the k-centers clustering algorithm.
 
@@ -130,6 +345,37 @@ def kcenters(
         random_first_center : bool, default=False
             When false, center 0 is always frame 0. If True, this value
             is chosen randomly.
+        use_triangle_inequality : bool, default=False
+            Keep the distance between the newest center and every other
+            center, and skip computing the distance to any observation
+            that is at most half that distance from its own center,
+            since it cannot be reassigned. The result is identical, but
+            `distance_method` must obey the triangle inequality.
+        distance_dtype : np.dtype, default=np.float64
+            Data type in which to store the distance from each
+            observation to its center. np.float32 halves the memory
+            footprint.
+        history : KCentersHistory, default=None
+            If given, record the order of the centers and the maximum
+            distance after each into this object, and capture the
+            clusterings it requests.
+        checkpoint : Checkpoint, default=None
+            Periodically save the centers, assignments and distances
+            found so far to this checkpoint. If its file already exists,
+            resume from the saved state instead of starting over.
+        init_clustering : tuple, default=None
+            A clustering of `traj`, as (center_indices, assignments,
+            distances), to continue adding centers to rather than
+            starting over (e.g. after new data is appended to `traj`
+            and assigned to the existing centers).
+        distance_cache : DistanceCache, default=None
+            If given, store the distance from each new center to every
+            observation in this cache, keyed by the center's index, for
+            later use (e.g. by kmedoids). This forgoes libdist's fused
+            update, and isn't done for centers found with
+            `use_triangle_inequality`, which doesn't compute the
+            distance to every observation.
+
     Returns
     -------
         result : ClusterResult
@@ -157,7 +403,11 @@ def kcenters(
 
     cluster_center_inds, assignments, distances = _kcenters_helper(
         traj, distance_method, n_clusters=n_clusters, dist_cutoff=dist_cutoff,
-        cluster_centers=init_centers, random_first_center=random_first_center)
+        cluster_centers=init_centers, random_first_center=random_first_center,
+        use_triangle_inequality=use_triangle_inequality,
+        distance_dtype=distance_dtype, history=history,
+        checkpoint=checkpoint, init_clustering=init_clustering,
+        distance_cache=distance_cache)
 
     return util.ClusterResult(
         center_indices=cluster_center_inds,
@@ -166,9 +416,67 @@ def kcenters(
         centers=traj[cluster_center_inds])
 
 
+def kcenters_sweep(traj, distance_method, n_clusters=None,
+                   cluster_radii=None, **kwargs):
+    """Compute the kcenters clustering at each of several numbers of
+    clusters or cluster radii with a single kcenters run.
+
+    Kcenters is greedy, so the run to the largest `n_clusters` (or
+    smallest radius) passes through each of the other clusterings; they
+    are captured along the way, so this costs one run rather than one
+    run per clustering.
+
+    Parameters
+    ----------
+        traj : array-like
+            The data to cluster with kcenters.
+        distance_method : callable
+            The distance metric, as for `kcenters`.
+        n_clusters : list of int, default=None
+            Numbers of clusters at which to report clusterings.
+        cluster_radii : list of float, default=None
+            Cluster radii (`dist_cutoff` values) at which to report
+            clusterings.
+
+    All other keyword arguments are passed on to `kcenters`.
+
+    Returns
+    -------
+        results : list of ClusterResult
+            One clustering for each element of `n_clusters` or
+            `cluster_radii`, in the order given.
+    """
+
+    if (n_clusters is None) == (cluster_radii is None):
+        raise ImproperlyConfigured(
+            "Exactly one of n_clusters and cluster_radii is required.")
+
+    history = KCentersHistory(
+        n_clusters=n_clusters, cluster_radii=cluster_radii)
+
+    if n_clusters is not None:
+        kcenters(traj, distance_method, n_clusters=max(n_clusters),
+                 dist_cutoff=None, history=history, **kwargs)
+        clusterings = [history.clustering(n_clusters=k) for k in n_clusters]
+    else:
+        kcenters(traj, distance_method, n_clusters=None,
+                 dist_cutoff=min(cluster_radii), history=history, **kwargs)
+        clusterings = [history.clustering(cluster_radius=r)
+                       for r in cluster_radii]
+
+    return [util.ClusterResult(
+                center_indices=center_inds,
+                assignments=assignments,
+                distances=distances,
+                centers=traj[center_inds])
+            for center_inds, assignments, distances in clusterings]
+
+
 def _kcenters_helper(
         traj, distance_method, n_clusters, dist_cutoff,
-        cluster_centers, random_first_center):
+        cluster_centers, random_first_center, use_triangle_inequality=False,
+        distance_dtype=np.float64, history=None, checkpoint=None,
+        init_clustering=None, distance_cache=None):
 
     if random_first_center:
         raise NotImplementedError(
@@ -177,16 +485,66 @@ def _kcenters_helper(
     new_center_index = 0
     n_frames = len(traj)
     assignments = np.zeros(n_frames, dtype=int)
-    distances = np.empty(n_frames, dtype=float)
+    distances = np.empty(n_frames, dtype=distance_dtype)
     distances.fill(np.inf)
     cluster_center_inds = []
     max_distance = np.inf
     cluster_num = 0
 
-    if cluster_centers is not None:
+    # number of leading labels in `assignments` that refer to elements of
+    # `cluster_centers` rather than to frames of `traj`.
+    n_init_centers = 0
+
+    state = checkpoint.load() if checkpoint is not None else None
+
+    if state is not None:
+        cluster_center_inds, assignments, distances = \
+            ckpt.restore_clustering(state, n_frames, ckpt.KCENTERS_STAGE)
+        ckpt.check_criteria(state, n_clusters, dist_cutoff)
+        distances = distances.astype(distance_dtype, copy=False)
+
+        cluster_num = len(cluster_center_inds)
+        new_center_index = np.argmax(distances)
+        max_distance = distances[new_center_index]
+        n_init_centers = int(ckpt.scalar(state, 'n_init_centers', 0))
+
+        logger.info("Resuming kcenters from checkpoint with %s centers "
+                    "(max distance %.6f)", cluster_num, max_distance)
+
+        if history is not None:
+            history._restore(cluster_center_inds, state)
+
+        if use_triangle_inequality and n_init_centers > 0 and (
+                cluster_centers is None or
+                len(cluster_centers) != n_init_centers):
+            logger.warning(
+                "Checkpoint was started from %s initial centers, which "
+                "weren't given; triangle inequality pruning is disabled.",
+                n_init_centers)
+            use_triangle_inequality = False
+    elif init_clustering is not None:
+        cluster_center_inds, assignments, distances = init_clustering
+        cluster_center_inds = list(cluster_center_inds)
+        assignments = np.array(assignments)
+        distances = np.array(distances, dtype=distance_dtype)
+
+        if len(assignments) != n_frames or len(distances) != n_frames:
+            raise DataInvalid(
+                "Initial clustering has %s assignments and %s distances, "
+                "but data has %s frames." %
+                (len(assignments), len(distances), n_frames))
+
+        cluster_num = len(cluster_center_inds)
+        new_center_index = np.argmax(distances)
+        max_distance = distances[new_center_index]
+
+        logger.info("Continuing kcenters from %s centers (max distance "
+                    "%.6f)", cluster_num, max_distance)
+    elif cluster_centers is not None:
         logger.info("Updating assignments to previous cluster centers")
         assignments, distances = util.assign_to_nearest_center(
             traj, cluster_centers, distance_method)
+        distances = distances.astype(distance_dtype, copy=False)
         cluster_center_inds = list(
             util.find_cluster_centers(assignments, distances))
 
@@ -194,19 +552,69 @@ def _kcenters_helper(
         new_center_index = np.argmax(distances)
         max_distance = np.max(distances)
 
+        if history is not None:
+            for center_index in cluster_center_inds:
+                history.add_center(center_index)
+            history.max_distances.extend([np.nan] * (cluster_num - 1))
+            history.add_max_distance(max_distance)
+            history.checkpoint(max_distance, assignments, distances)
+
+        n_init_centers = cluster_num
+        if use_triangle_inequality and n_init_centers != len(cluster_centers):
+            logger.warning(
+                "Only %s of %s initial centers were assigned frames; "
+                "triangle inequality pruning is disabled.",
+                n_init_centers, len(cluster_centers))
+            use_triangle_inequality = False
+
+    if isinstance(traj, CoordinateStore):
+        # keep the distances and assignments where the store's workers
+        # can update them in place.
+        out, labels = traj.empty_outputs(1, distances.dtype)
+        out[0], labels[:] = distances, assignments
+        distances, assignments = out[0], labels
+
     while (cluster_num < n_clusters) and (max_distance > dist_cutoff):
-        dist = distance_method(traj, traj[new_center_index])
+        new_center = traj[new_center_index]
+        cluster_center_inds.append(new_center_index)
 
-        # scipy distance metrics return shape (n, 1) instead of (n), which
-        # causes breakage here.
-        assert len(dist.shape) == len(distances.shape)
+        if use_triangle_inequality and cluster_num > 0:
+            ctr_dists = _center_to_center_distances(
+                traj, distance_method, new_center, cluster_center_inds[:-1],
+                cluster_centers, n_init_centers)
+
+            # if d(x, c) <= d(c, c_new) / 2 for the center c that x is
+            # assigned to, d(x, c_new) >= d(x, c), so x can't be moved.
+            candidates = np.flatnonzero(
+                distances > ctr_dists[assignments] / 2)
+            logger.debug(
+                "Triangle inequality pruned %s of %s distance computations",
+                n_frames - len(candidates), n_frames)
+
+            if len(candidates) < n_frames:
+                new_center_index, max_distance = _update_nearest(
+                    traj, distance_method, new_center, cluster_num,
+                    distances, assignments, frames=candidates)
+            else:
+                new_center_index, max_distance = _update_nearest(
+                    traj, distance_method, new_center, cluster_num,
+                    distances, assignments)
+        else:
+            new_center_index, max_distance = _update_nearest(
+                traj, distance_method, new_center, cluster_num,
+                distances, assignments, cache=distance_cache,
+                cache_key=cluster_center_inds[-1])
+
+        if history is not None:
+            history.add_center(cluster_center_inds[-1])
+            history.add_max_distance(max_distance)
+            history.checkpoint(max_distance, assignments, distances)
+
+        if checkpoint is not None:
+            checkpoint.step(lambda: _kcenters_state(
+                cluster_center_inds, assignments, distances, max_distance,
+                n_init_centers, history, n_clusters, dist_cutoff))
 
-        inds = (dist < distances)
-        distances[inds] = dist[inds]
-        assignments[inds] = cluster_num
-        cluster_center_inds.append(new_center_index)
-        new_center_index = np.argmax(distances)
-        max_distance = np.max(distances)
         logger.info(
             "kCenters cluster "+str(cluster_num) +
             " will continue until max-distance, " +
@@ -216,10 +624,185 @@ def _kcenters_helper(
         cluster_num += 1
     cluster_centers = traj[cluster_center_inds]
 
+    if checkpoint is not None:
+        checkpoint.save(**_kcenters_state(
+            cluster_center_inds, assignments, distances, max_distance,
+            n_init_centers, history, n_clusters, dist_cutoff))
+
+    if isinstance(traj, CoordinateStore):
+        # the store's outputs are reused by whatever it computes next.
+        assignments, distances = np.array(assignments), np.array(distances)
+
     return cluster_center_inds, assignments, distances
 
 
-def kcenters_mpi(traj, distance_method, n_clusters=np.inf, dist_cutoff=0):
+def _kcenters_state(center_inds, assignments, distances, max_distance,
+                    n_init_centers, history, n_clusters, dist_cutoff):
+    """The state of a kcenters run, as a dict of arrays to checkpoint.
+    """
+
+    state = ckpt.clustering_state(
+        ckpt.KCENTERS_STAGE, center_inds, assignments, distances,
+        max_distance=max_distance, n_init_centers=n_init_centers,
+        n_clusters=n_clusters, dist_cutoff=dist_cutoff)
+    if history is not None:
+        state.update(history._arrays())
+
+    return state
+
+
+def _update_nearest(
+        traj, distance_method, new_center, label, distances, assignments,
+        cache=None, cache_key=None, frames=None):
+    """Reassign, in place, every observation in `traj` that is closer
+    to `new_center` than to its current center to `label`, and return
+    the index of and distance to the new farthest observation.
+
+    Metrics that libdist can compute in place (euclidean on float arrays
+    and rmsd on PreparedCoordinates) do this in a single fused pass; any
+    other metric falls back to computing a full distance vector, as does
+    any metric if `cache` is given, so that the vector can be stored in
+    it under `cache_key`. CoordinateStores are updated a block at a
+    time, and aren't cached. If `frames` is given, only those
+    observations are compared to `new_center` (and nothing is cached).
+    """
+
+    if frames is not None:
+        return _update_nearest_subset(
+            traj, distance_method, new_center, label, distances,
+            assignments, frames)
+
+    if isinstance(traj, CoordinateStore):
+        return _update_nearest_blocks(
+            traj, distance_method, new_center, label, distances, assignments)
+
+    metric = _in_place_metric(traj, distance_method)
+    if metric is not None and cache is None:
+        return libdist.update_nearest(
+            traj, new_center, distances, assignments, label, metric)
+
+    dist = distance_method(traj, new_center)
+    if cache is not None:
+        cache.put(util._cache_key(cache_key), dist)
+
+    # scipy distance metrics return shape (n, 1) instead of (n),
+    # which causes breakage here.
+    assert len(dist.shape) == len(distances.shape)
+
+    inds = (dist < distances)
+    distances[inds] = dist[inds]
+    assignments[inds] = label
+
+    new_center_index = np.argmax(distances)
+    return new_center_index, distances[new_center_index]
+
+
+def _update_nearest_subset(
+        traj, distance_method, new_center, label, distances, assignments,
+        frames):
+    """`_update_nearest` for only the observations `frames`, which are
+    read in place by libdist's kernels where it can, rather than copied
+    out of `traj`.
+    """
+
+    metric = _in_place_metric(traj, distance_method)
+    if metric is not None:
+        return libdist.update_nearest(
+            traj, new_center, distances, assignments, label, metric,
+            frames=frames)
+
+    if len(frames) > 0:
+        dist = distance_method(traj[frames], new_center)
+        assert len(dist.shape) == len(distances.shape)
+
+        closer = dist < distances[frames]
+        distances[frames[closer]] = dist[closer]
+        assignments[frames[closer]] = label
+
+    new_center_index = np.argmax(distances)
+    return new_center_index, distances[new_center_index]
+
+
+def _update_nearest_blocks(
+        traj, distance_method, new_center, label, distances, assignments):
+    """`_update_nearest` for a CoordinateStore, which updates each
+    block's slice of `distances` and `assignments` a block at a time
+    (in parallel, for a SharedCoordinates, in which case they must be
+    its shared outputs) and reduces each block to its farthest frame.
+    """
+
+    new_center_index, max_distance = 0, -np.inf
+    for start, (i, block_max) in traj.map_blocks_into(
+            _block_update_nearest, distances.reshape(1, -1), assignments,
+            distance_method, new_center, label):
+        # blocks come in order, so ties go to the first, as np.argmax.
+        if block_max > max_distance:
+            new_center_index, max_distance = start + i, block_max
+
+    return new_center_index, max_distance
+
+
+def _block_update_nearest(block, out, labels, distance_method, center,
+                          label):
+    block = util._prepare_block(block, distance_method)
+    distances = out[0]
+
+    metric = _in_place_metric(block, distance_method)
+    if metric is not None:
+        return libdist.update_nearest(
+            block, center, distances, labels, label, metric)
+
+    dist = distance_method(block, center)
+    inds = dist < distances
+    distances[inds] = dist[inds]
+    labels[inds] = label
+
+    i = np.argmax(distances)
+    return i, distances[i]
+
+
+def _in_place_metric(traj, distance_method):
+    """Name of the libdist metric `distance_method` can be updated in
+    place with, given data `traj`, or None if it can't be.
+    """
+
+    if distance_method is libdist.rmsd and \
+            isinstance(traj, libdist.PreparedCoordinates):
+        return 'rmsd'
+    if distance_method is libdist.euclidean and \
+            isinstance(traj, np.ndarray) and len(traj.shape) == 2 and \
+            traj.dtype in (np.float32, np.float64) and \
+            traj.flags.c_contiguous:
+        return 'euclidean'
+
+    return None
+
+
+def _center_to_center_distances(
+        traj, distance_method, new_center, cluster_center_inds,
+        init_centers, n_init_centers):
+    """Compute the distance between `new_center` and each existing
+    center, indexed by the center's label in the assignments array.
+
+    Centers chosen from `traj` are read in place where libdist can (see
+    `_in_place_metric`), rather than gathered into a new array.
+    """
+
+    ctr_dists = []
+    if n_init_centers > 0:
+        ctr_dists.append(distance_method(init_centers, new_center))
+    if len(cluster_center_inds) > n_init_centers:
+        inds = np.array(cluster_center_inds[n_init_centers:], dtype=np.intp)
+        if _in_place_metric(traj, distance_method) is not None:
+            ctr_dists.append(distance_method(traj, new_center, frames=inds))
+        else:
+            ctr_dists.append(distance_method(traj[inds], new_center))
+
+    return np.concatenate(ctr_dists)
+
+
+def kcenters_mpi(traj, distance_method, n_clusters=np.inf, dist_cutoff=0,
+                 distance_dtype=np.float64, history=None, checkpoint=None):
     """KCenters implementation for MPI.
 
     In this function, `traj` is assumed to be only a subset of the data
@@ -244,6 +827,21 @@ def kcenters_mpi(traj, distance_method, n_clusters=np.inf, dist_cutoff=0):
             Stop finding new cluster centers when the maximum minimum
             distance between any point and a cluster center reaches this
             value.
+        distance_dtype : np.dtype, default=np.float64
+            Data type in which to store the distance from each
+            observation to its center. np.float32 halves the memory
+            footprint.
+        history : KCentersHistory, default=None
+            If given, record the order of the centers and the maximum
+            distance after each into this object, and capture the
+            clusterings it requests. Captured assignments and distances
+            are those of this worker's world; each capture is identical
+            to the result of a separate call stopping at that point.
+        checkpoint : Checkpoint, default=None
+            Periodically save this worker's centers, assignments and
+            distances to this checkpoint (which should be in `mpi_mode`).
+            If its file already exists, resume from the saved state
+            instead of starting over.
 
     Returns
     -------
@@ -275,29 +873,80 @@ def kcenters_mpi(traj, distance_method, n_clusters=np.inf, dist_cutoff=0):
 
     min_max_dist = np.inf
 
-    distances = np.full(shape=(len(traj),), fill_value=np.inf)
+    distances = np.full(shape=(len(traj),), fill_value=np.inf,
+                        dtype=distance_dtype)
     assignments = np.zeros(shape=(len(traj),), dtype=np.int32) - 1
     ctr_inds = []
+    local_max = None
+    n_local_max = mpi.MPI.COMM_WORLD.allreduce(len(traj), op=mpi.MPI.MAX)
+
+    state = checkpoint.load() if checkpoint is not None else None
+
+    if state is not None:
+        ctr_inds, assignments, distances = ckpt.restore_clustering(
+            state, len(traj), ckpt.KCENTERS_STAGE)
+        ckpt.check_criteria(state, n_clusters, dist_cutoff)
+        assignments = assignments.astype(np.int32, copy=False)
+        distances = distances.astype(distance_dtype, copy=False)
+        min_max_dist = ckpt.scalar(state, 'max_distance')
+
+        if history is not None:
+            history._restore(ctr_inds, state)
+
+        if mpi.MPI_RANK == 0:
+            logger.info("Resuming kcenters from checkpoint with %s "
+                        "centers.", len(ctr_inds))
 
     while (len(ctr_inds) < n_clusters) and (min_max_dist > dist_cutoff):
 
-        min_max_dist, distances, assignments, center_inds = \
+        min_max_dist, distances, assignments, center_inds, local_max = \
             _kcenters_iteration_mpi(traj, distance_method, distances,
-                                    assignments, ctr_inds)
+                                    assignments, ctr_inds,
+                                    local_max=local_max,
+                                    n_local_max=n_local_max)
+
+        if history is not None:
+            # min_max_dist is the max distance _before_ the center just
+            # added, which is also what the loop condition tests.
+            history.add_center(ctr_inds[-1])
+            if len(ctr_inds) > 1:
+                history.add_max_distance(min_max_dist)
+            history.checkpoint(min_max_dist, assignments, distances)
+
+        if checkpoint is not None:
+            checkpoint.step(lambda: _kcenters_state(
+                ctr_inds, assignments, distances, min_max_dist, 0, history,
+                n_clusters, dist_cutoff))
 
         if mpi.MPI_RANK == 0:
             logger.info(
                 "Center %s gives max dist of %.6f (stopping @ %.6f).",
                 len(center_inds), min_max_dist, dist_cutoff)
 
+    if history is not None and local_max is not None:
+        history.add_max_distance(mpi.MPI.COMM_WORLD.allreduce(
+            local_max[1], op=mpi.MPI.MAX))
+
+    if checkpoint is not None:
+        checkpoint.save(**_kcenters_state(
+            ctr_inds, assignments, distances, min_max_dist, 0, history,
+            n_clusters, dist_cutoff))
+
     return distances, assignments, ctr_inds
 
 
 def _kcenters_iteration_mpi(traj, distance_method, distances, assignments,
-                        center_inds=None, center_inds_mode='auto'):
+                        center_inds=None, center_inds_mode='auto',
+                        local_max=None, n_local_max=None):
     """The core inner loop of the kcenters iteration protocol. This can
     be used to start and stop doing kcenters (for example to save
     frequently or do checkpointing).
+
+    `local_max` is the (index, distance) of this rank's farthest
+    observation, as returned by the previous iteration. If it is None,
+    it is recomputed from `distances`. `n_local_max` is the length of
+    the longest rank's `traj`; if it is None, it is found with an
+    additional collective.
     """
 
     assert len(traj) == len(distances)
@@ -312,17 +961,18 @@ def _kcenters_iteration_mpi(traj, distance_method, distances, assignments,
         new_cluster_center_owner = 0
         min_max_dist = np.inf
     else:
-        with log.timed("Gathered distances in %.2f sec", logger.debug):
-            # this could likely be accomplished with mpi.reduce instead...
-            dist_locs = np.array(
-                mpi.MPI.COMM_WORLD.allgather(np.argmax(distances)))
-            dist_vals = np.array(
-                mpi.MPI.COMM_WORLD.allgather(np.max(distances)))
+        if local_max is None:
+            local_argmax = np.argmax(distances)
+            local_max = (local_argmax, distances[local_argmax])
 
-        new_cluster_center_owner = np.argmax(dist_vals)
-        new_cluster_center_index = dist_locs[new_cluster_center_owner]
+        if n_local_max is None:
+            n_local_max = mpi.MPI.COMM_WORLD.allreduce(
+                len(traj), op=mpi.MPI.MAX)
 
-        min_max_dist = np.max(dist_vals)
+        with log.timed("Reduced distances in %.2f sec", logger.debug):
+            min_max_dist, new_cluster_center_owner, \
+                new_cluster_center_index = mpi.ops.maxloc(
+                    local_max[1], local_max[0], n_local_max)
 
     with log.timed("Distributed cluster ctr in %.2f sec",
                    log_func=logger.info):
@@ -332,14 +982,11 @@ def _kcenters_iteration_mpi(traj, distance_method, distances, assignments,
             owner_rank=new_cluster_center_owner)
 
     with log.timed("Computed distance in %.2f sec", log_func=logger.info):
-        new_dists = distance_method(traj, new_center)
-
-    inds = (new_dists < distances)
-
-    distances[inds] = new_dists[inds]
-    assignments[inds] = len(center_inds)
+        local_max = _update_nearest(
+            traj, distance_method, new_center, len(center_inds),
+            distances, assignments)
 
     center_inds.append(
         (new_cluster_center_owner, new_cluster_center_index))
 
-    return min_max_dist, distances, assignments, center_inds
+    return min_max_dist, distances, assignments, center_inds, local_max
@@ -11,10 +11,13 @@ from __future__ import print_function, division, absolute_import
 import logging
 
 import numpy as np
+import scipy.sparse
 
 from sklearn.utils import check_random_state
 
+from ..geometry import libdist
 from ..util.log import timed
+from ..util.store import CoordinateStore, SharedCoordinates
 from .. import mpi
 
 from . import util
@@ -22,7 +25,8 @@ from . import util
 logger = logging.getLogger(__name__)
 
 
-def kmedoids(X, distance_method, n_clusters, n_iters=5):
+def kmedoids(X, distance_method, n_clusters, n_iters=5, batch_size=None,
+             n_procs=1):
     """K-Medoids clustering.
 
     K-Medoids is a clustering algorithm similar to the k-means algorithm
@@ -45,6 +49,13 @@ def kmedoids(X, distance_method, n_clusters, n_iters=5):
         cluster center.
     n_iters : int, default=5
         Number of rounds of new proposed centers to run.
+    batch_size : int, default=None
+        If given, propose new centers for this many clusters at a time
+        (see `_kmedoids_pam_update`).
+    n_procs : int, default=1
+        Number of processes to compute distances in. `X` is copied into
+        a SharedCoordinates store, and each process computes the
+        distances for its share of the frames.
 
     Returns
     -------
@@ -59,6 +70,14 @@ def kmedoids(X, distance_method, n_clusters, n_iters=5):
 
     distance_method = util._get_distance_method(distance_method)
 
+    if n_procs > 1 and not isinstance(X, CoordinateStore):
+        with SharedCoordinates(
+                X, n_procs=n_procs,
+                prepare=distance_method is libdist.rmsd) as shared:
+            result = kmedoids(shared, distance_method, n_clusters,
+                              n_iters=n_iters, batch_size=batch_size)
+        return result._replace(centers=X[result.center_indices])
+
     n_frames = len(X)
 
     # for short lists, np.random.random_integers sometimes forgets to assign
@@ -75,7 +94,7 @@ def kmedoids(X, distance_method, n_clusters, n_iters=5):
     for i in range(n_iters):
         cluster_center_inds, distances, assignments = _kmedoids_pam_update(
             X, distance_method, cluster_center_inds, assignments,
-            distances)
+            distances, batch_size=batch_size)
         logger.info("KMedoids update %s", i)
 
     return util.ClusterResult(
@@ -110,13 +129,12 @@ def _propose_new_center_amongst(X, state_inds, mpi_mode, random_state):
     # TODO: make it impossible to choose the current center
     if mpi_mode:
         r, idx = mpi.ops.randind(state_inds, random_state)
-        if mpi.MPI_RANK == r:
-            i = mpi.MPI.COMM_WORLD.bcast(state_inds[idx], root=r)
-        else:
-            i = mpi.MPI.COMM_WORLD.bcast(None, root=r)
-        proposed_center = mpi.ops.distribute_frame(
-            data=X, owner_rank=r, world_index=i)
-        proposed_center_ind = (r, i)
+
+        # the owner sends the frame and its index in one collective.
+        frames, world_inds = mpi.ops.distribute_frames(
+            X, [state_inds[idx] if mpi.MPI_RANK == r else None], [r])
+        proposed_center = frames[0]
+        proposed_center_ind = (r, world_inds[0])
 
         logger.debug(
             "Proposing new center %s, at %s.",
@@ -130,7 +148,8 @@ def _propose_new_center_amongst(X, state_inds, mpi_mode, random_state):
 
 def _kmedoids_pam_update(
         X, metric, medoid_inds, assignments, distances, proposals=None,
-        cost=_msq, random_state=None):
+        cost=_msq, random_state=None, batch_size=None, cluster_ids=None,
+        bounds=None, distance_cache=None):
     """Compute a kmedoids update using Partitioning Around Medoids (PAM)
 
     PAM iteratively proposes a new cluster center from among the points
@@ -163,9 +182,36 @@ def _kmedoids_pam_update(
     cost : callable, default='meansquare'
         Function computing the cost of a particular clustering. Should
         take a vector of distances and returning a number. This value is
-        minimzed.
+        minimzed. The mean square (`_msq`) and maximum (`np.max`) costs
+        are kept up to date incrementally, so that each proposal only
+        costs work proportional to the frames it changes; any other
+        function is recomputed over all distances for each proposal.
     random_state : numpy.RandomState
         RandomState object used to indentify new centers.
+    batch_size : int, default=None
+        If given, propose new centers for this many clusters at a time,
+        computing their distances to the data in a single pass, and
+        accept together the proposals that don't interact (see
+        `_batched_pam_sweep`). This needs far fewer passes over the data
+        and, in MPI mode, far fewer collectives than proposing one
+        center at a time.
+    cluster_ids : array-like, default=None
+        If given, only propose new centers for these clusters (e.g. the
+        clusters affected by new data), rather than for every cluster.
+    bounds : AssignmentBounds, default=None
+        Lower bounds on the distance from each frame to the medoids it
+        isn't assigned to. A frame whose distance to its own medoid
+        grows is only compared to every other medoid if it exceeds this
+        bound. The bounds are tightened as medoids are compared to, and
+        updated in place to describe the result, so that passing the
+        same bounds to successive sweeps makes each cheaper.
+    distance_cache : DistanceCache, default=None
+        Cache of the distance from medoids to every frame, keyed by the
+        medoid's index (e.g. filled by `kcenters`). Frames reassigned
+        amongst all the medoids read their distances to cached medoids
+        from it, and a proposal's distances are read from it if cached.
+        The vector of an accepted proposal replaces that of the medoid
+        it replaces; those of rejected proposals aren't kept.
 
     Returns
     -------
@@ -206,9 +252,40 @@ def _kmedoids_pam_update(
     else:
         medoid_coords = [X[i] for i in medoid_inds]
 
+    # index of the frames in each cluster, so that finding the members
+    # of each cluster doesn't cost a pass over `assignments`.
+    members = util.ClusterMembership(assignments, n_clusters=len(medoid_inds))
+
+    # work on copies, which are updated in place as proposals are
+    # accepted, and keep the cost current as they are.
+    distances = np.array(distances)
+    assignments = np.array(assignments)
+    lower = None if bounds is None else bounds.lower
+    running_cost = _running_cost(
+        cost, distances, mpi_mode=hasattr(medoid_inds[0], '__len__'))
+
+    if cluster_ids is None:
+        cluster_ids = range(len(medoid_inds))
+    cluster_ids = [int(cid) for cid in cluster_ids]
+
+    if batch_size is not None:
+        acceptances = _batched_pam_sweep(
+            X, metric, medoid_inds, medoid_coords, assignments, distances,
+            members, running_cost, proposals, batch_size,
+            mpi_mode=hasattr(medoid_inds[0], '__len__'),
+            random_state=random_state, cluster_ids=cluster_ids,
+            lower=lower, distance_cache=distance_cache)
+
+        logger.info(
+            "Kmedoid sweep reduced cost to %.7f (%.2f%% acceptance)",
+            running_cost.value, acceptances/max(len(cluster_ids), 1)*100)
+
+        _set_bounds(bounds, assignments, distances)
+        return medoid_inds, distances, assignments
+
     acceptances = 0
-    for cid in range(len(medoid_inds)):
-        state_inds = np.where(assignments == cid)[0]
+    for cid in cluster_ids:
+        state_inds = members[cid]
 
         # first, we propose a new center. This works a bit differently
         # if we're running with MPI, because we want to make a choice
@@ -234,54 +311,33 @@ def _kmedoids_pam_update(
         # the distance from this center to every point. Depending on if
         # the distance goes up or down, and which old center it was
         # assigned to (this or other), we update distances and assignents.
-        new_ctr_dist = metric(X, proposed_center)
-
-        new_dist = np.zeros_like(distances) - 1
-        new_assig = np.zeros_like(assignments) - 1
-
-        # if the new center decreases the distance below whatever it is
-        # to its current medoid (cid or not cid), assign it to cid
-        dst_dn = (distances > new_ctr_dist)
-        new_assig[dst_dn] = cid
-        new_dist[dst_dn] = new_ctr_dist[dst_dn]
-
-        # if the new center increases the distance, we have to think
-        # harder. If it's assigned to some other medoid, we just copy
-        # the old assignments into the new assignments array.
-        dst_up_assig_other = (distances <= new_ctr_dist) & (assignments != cid)
-        new_assig[dst_up_assig_other] = assignments[dst_up_assig_other]
-        new_dist[dst_up_assig_other] = distances[dst_up_assig_other]
-
-        # if the new center increases the distance to cid and it was
-        # previously assigned to cid, then we have to compute the
-        # distance to _all_ other medoids :(
-        dst_up_assig_this = (distances <= new_ctr_dist) & (assignments == cid)
-
-        new_medoids = medoid_coords.copy()
-        new_medoids[cid] = proposed_center
+        new_ctr_dist = _cached_distances(distance_cache, proposed_center_ind)
+        if new_ctr_dist is None:
+            new_ctr_dist = _distances_to_centers(
+                X, metric, [proposed_center])[0]
 
-        with timed("Recomputed nearest medoid for {n} points in %.2f sec.".\
-                   format(n=np.count_nonzero(dst_up_assig_this)),
-                   logger.debug):
-            ambig_assigs, ambig_dists = util.assign_to_nearest_center(
-                X[dst_up_assig_this], new_medoids, metric)
-
-        new_assig[dst_up_assig_this] = ambig_assigs
-        new_dist[dst_up_assig_this] = ambig_dists
+        changes = _proposal_changes(
+            X, metric, cid, proposed_center, new_ctr_dist, medoid_coords,
+            assignments, distances, state_inds, lower,
+            _cached_medoids(distance_cache, medoid_inds))
+        changed, changed_assigs, changed_dists = changes[:3]
 
-        # every element of new_dist and new_assig should have been touched
-        assert np.all(new_assig >= 0)
-        assert np.all(new_dist >= 0)
-
-        old_cost = cost(distances)
-        new_cost = cost(new_dist)
+        old_cost = running_cost.value
+        new_cost = running_cost.propose(
+            changed, distances[changed], changed_dists)
 
         if new_cost < old_cost:
             logger.debug(
                 "Accepted proposed center for k=%s: cost %.5f -> %.5f).",
                 cid, old_cost, new_cost)
-            distances, assignments = new_dist, new_assig
-            medoid_coords = new_medoids
+            running_cost.accept(new_cost)
+            members.update(changed, assignments[changed], changed_assigs)
+            distances[changed] = changed_dists
+            assignments[changed] = changed_assigs
+            _accept_bounds(lower, new_ctr_dist, changed, changes[6])
+            _accept_cached(distance_cache, medoid_inds[cid],
+                           proposed_center_ind, new_ctr_dist)
+            medoid_coords[cid] = proposed_center
             medoid_inds[cid] = proposed_center_ind
             acceptances += 1
         else:
@@ -290,6 +346,604 @@ def _kmedoids_pam_update(
                 cid, old_cost, new_cost)
 
     logger.info("Kmedoid sweep reduced cost to %.7f (%.2f%% acceptance)",
-                min(old_cost, new_cost), acceptances/len(medoid_inds)*100)
+                running_cost.value, acceptances/max(len(cluster_ids), 1)*100)
 
+    _set_bounds(bounds, assignments, distances)
     return medoid_inds, distances, assignments
+
+
+def _accept_bounds(lower, new_ctr_dist, changed, changed_lower):
+    """Update the lower bounds after accepting a proposal whose distance
+    to every frame is `new_ctr_dist`. For frames it doesn't change, the
+    new medoid is one of the others; frames it does change get the
+    bounds computed with the proposal.
+    """
+
+    if lower is None:
+        return
+
+    np.minimum(lower, new_ctr_dist, out=lower)
+    lower[changed] = changed_lower
+
+
+def _cached_distances(distance_cache, center_ind):
+    if distance_cache is None:
+        return None
+    return distance_cache.get(util._cache_key(center_ind))
+
+
+def _cached_medoids(distance_cache, medoid_inds):
+    """The cached distance vector of each medoid, or None if the cache
+    is None.
+    """
+
+    if distance_cache is None:
+        return None
+    return [_cached_distances(distance_cache, i) for i in medoid_inds]
+
+
+def _accept_cached(distance_cache, old_ind, new_ind, new_ctr_dist):
+    if distance_cache is None:
+        return
+    distance_cache.discard(util._cache_key(old_ind))
+    distance_cache.put(util._cache_key(new_ind), new_ctr_dist)
+
+
+def _set_bounds(bounds, assignments, distances):
+    """Make `bounds` describe the clustering at the end of a sweep.
+    """
+
+    if bounds is None:
+        return
+
+    bounds.assignments = assignments.copy()
+    bounds.upper = distances.copy()
+    bounds.exact = np.ones(len(distances), dtype=bool)
+
+
+
+def _proposal_changes(X, metric, cid, proposed_center, new_ctr_dist,
+                      medoid_coords, assignments, distances, state_inds,
+                      lower=None, cached=None):
+    """Find the frames whose assignment or distance would change if the
+    medoid of cluster `cid` moved to `proposed_center`.
+
+    If `lower` (lower bounds on the distance from each frame to the
+    medoids it isn't assigned to) is given, frames that move farther
+    from `cid` but no farther than their bound stay with `cid` without
+    being compared to every medoid. If `cached` (the cached distance
+    vector of each medoid, or None) is given, those that move farther
+    look up their distance to the cached medoids rather than compute
+    it.
+
+    Returns
+    -------
+    changed : ndarray
+        Indices of the frames that would change.
+    changed_assigs : ndarray
+        The new assignment of each frame in `changed`.
+    changed_dists : ndarray
+        The new distance of each frame in `changed`.
+    ambig_frames : ndarray
+        The subset of `changed` that was assigned to `cid` and moves
+        farther from it, and so was reassigned amongst all the medoids.
+    ambig_assigs : ndarray
+        The new assignment of each frame in `ambig_frames`.
+    ambig_dists : ndarray
+        The new distance of each frame in `ambig_frames`.
+    changed_lower : ndarray or None
+        The new lower bound of each frame in `changed`, if `lower` is
+        given.
+    """
+
+    # if the new center decreases the distance below whatever it is
+    # to its current medoid (cid or not cid), assign it to cid. If
+    # the new center increases the distance to a point assigned to
+    # some other medoid, nothing changes for that point.
+    dst_dn = np.flatnonzero(distances > new_ctr_dist)
+
+    # if the new center increases the distance to cid and it was
+    # previously assigned to cid, then we have to compute the
+    # distance to _all_ other medoids :(
+    dst_up_assig_this = state_inds[
+        distances[state_inds] <= new_ctr_dist[state_inds]]
+
+    new_medoids = list(medoid_coords)
+    new_medoids[cid] = proposed_center
+
+    if lower is None and cached is None:
+        with timed("Recomputed nearest medoid for {n} points in %.2f sec.".\
+                   format(n=len(dst_up_assig_this)),
+                   logger.debug):
+            ambig_assigs, ambig_dists = util.assign_to_nearest_center(
+                X[dst_up_assig_this], new_medoids, metric)
+    else:
+        # a frame no farther from cid than from any other medoid stays.
+        ambig_assigs = np.full(len(dst_up_assig_this), cid,
+                               dtype=assignments.dtype)
+        ambig_dists = new_ctr_dist[dst_up_assig_this]
+        if lower is None:
+            ambig_lower = np.zeros(len(dst_up_assig_this))
+        else:
+            ambig_lower = lower[dst_up_assig_this]
+
+        # the bounds often rule out every frame, and metrics like
+        # libdist.rmsd can't be called on no frames at all.
+        search = ambig_dists > ambig_lower
+        if np.any(search):
+            with timed("Recomputed nearest medoid for {n} points in "
+                       "%.2f sec.".format(n=np.count_nonzero(search)),
+                       logger.debug):
+                if cached is None:
+                    nearest = util._nearest_two_centers(
+                        X[dst_up_assig_this[search]], new_medoids, metric)
+                else:
+                    nearest = _nearest_medoids(
+                        X, dst_up_assig_this[search], metric, new_medoids,
+                        cid, new_ctr_dist, cached)
+                ambig_assigs[search], ambig_dists[search], \
+                    ambig_lower[search] = nearest
+
+    if lower is None:
+        changed_lower = None
+    else:
+        # frames moving to cid from another medoid are bounded by their
+        # distance to that medoid; others assigned to cid keep theirs.
+        dn_lower = lower[dst_dn]
+        from_other = assignments[dst_dn] != cid
+        dn_lower[from_other] = np.minimum(
+            dn_lower[from_other], distances[dst_dn[from_other]])
+        changed_lower = np.concatenate([dn_lower, ambig_lower])
+
+    # only these frames are touched by the proposal, so only they
+    # are needed to compute the change in cost.
+    changed = np.concatenate([dst_dn, dst_up_assig_this])
+    changed_assigs = np.concatenate(
+        [np.full(len(dst_dn), cid, dtype=assignments.dtype), ambig_assigs])
+    changed_dists = np.concatenate([new_ctr_dist[dst_dn], ambig_dists])
+
+    return (changed, changed_assigs, changed_dists,
+            dst_up_assig_this, ambig_assigs, ambig_dists, changed_lower)
+
+
+def _nearest_medoids(X, frames, metric, medoid_coords, cid, new_ctr_dist,
+                     cached):
+    """Find the nearest and second-nearest medoid to each of `frames`,
+    as `util._nearest_two_centers` does, but taking the distances to
+    medoid `cid` from `new_ctr_dist` and to the other medoids from their
+    `cached` distance vectors where they have one.
+    """
+
+    dists = np.empty((len(medoid_coords), len(frames)))
+
+    uncached = []
+    for j in range(len(medoid_coords)):
+        if j == cid:
+            dists[j] = new_ctr_dist[frames]
+        elif cached[j] is not None:
+            dists[j] = cached[j][frames]
+        else:
+            uncached.append(j)
+
+    if uncached and len(frames) > 0:
+        dists[uncached] = _distances_to_centers(
+            X[frames], metric, [medoid_coords[j] for j in uncached])
+
+    assignments = np.argmin(dists, axis=0)
+    if len(medoid_coords) == 1:
+        return assignments, dists[0], np.full(len(frames), np.inf)
+
+    nearest_two = np.partition(dists, 1, axis=0)
+    return assignments, nearest_two[0], nearest_two[1]
+
+
+def _batched_pam_sweep(
+        X, metric, medoid_inds, medoid_coords, assignments, distances,
+        members, running_cost, proposals, batch_size, mpi_mode,
+        random_state, cluster_ids, lower=None, distance_cache=None):
+    """Run one PAM sweep, proposing new medoids for up to `batch_size`
+    clusters at a time.
+
+    Each pass draws proposals for a batch of clusters at once (with a
+    fixed number of collectives in MPI mode) and computes their
+    distances to every frame in one pass over the data. Proposals are
+    then considered in order, as in the sequential sweep, except that a
+    proposal that interacts with one already accepted in the same pass
+    is deferred to the next pass. Two proposals interact if they change
+    any of the same frames, or if either reassigns frames to the other's
+    cluster or would have reassigned them to the other's proposed
+    medoid. Accepting non-interacting proposals together gives the same
+    result as accepting them one after the other.
+
+    Only the clusters in `cluster_ids` are swept. `medoid_inds`,
+    `medoid_coords`, `assignments`, `distances`, `members`,
+    `running_cost` and the lower bounds `lower`, if given, are updated
+    in place, as is `distance_cache`.
+
+    Returns
+    -------
+    acceptances : int
+        The number of proposals accepted.
+    """
+
+    fused_cost = mpi_mode and isinstance(running_cost, _MeanSquareCost)
+
+    # proposals and their distances to every frame are kept until they
+    # are accepted or rejected, so deferred proposals aren't recomputed.
+    drawn = {}
+    queue = list(cluster_ids)
+    acceptances = 0
+    n_passes = 0
+
+    while queue:
+        batch, queue = queue[:batch_size], queue[batch_size:]
+        n_passes += 1
+
+        new_cids = [cid for cid in batch if cid not in drawn]
+        if new_cids:
+            centers, center_inds = _propose_new_centers(
+                X, [members[cid] for cid in new_cids],
+                None if proposals is None else
+                [proposals[cid] for cid in new_cids],
+                mpi_mode, random_state)
+            with timed("Computed distances to {n} proposed medoids in "
+                       "%.2f sec.".format(n=len(new_cids)), logger.debug):
+                ctr_dists = _distances_to_centers(X, metric, centers)
+            for cid, ctr, ind, d in zip(
+                    new_cids, centers, center_inds, ctr_dists):
+                drawn[cid] = (ctr, ind, d)
+
+        cached = _cached_medoids(distance_cache, medoid_inds)
+        changes = [_proposal_changes(
+            X, metric, cid, drawn[cid][0], drawn[cid][2], medoid_coords,
+            assignments, distances, members[cid], lower, cached)
+            for cid in batch]
+
+        conflicts = _proposal_conflicts(
+            batch, changes, np.array([drawn[cid][2] for cid in batch]),
+            len(X))
+
+        # in MPI mode, proposals interact if they do on any node. For
+        # the mean-square cost, the change in cost for each proposal is
+        # reduced along with the interactions.
+        deltas = None
+        if fused_cost:
+            deltas = np.array([running_cost.local_delta(
+                distances[c[0]], c[2]) for c in changes])
+        if mpi_mode:
+            reduced = mpi.MPI.COMM_WORLD.allreduce(
+                np.concatenate([conflicts.ravel().astype(np.float64),
+                                deltas if fused_cost else []]),
+                op=mpi.MPI.SUM)
+            conflicts = reduced[:conflicts.size].reshape(
+                conflicts.shape) > 0
+            if fused_cost:
+                deltas = reduced[conflicts.size:]
+
+        accepted = []
+        accepted_dists = []
+        deferred = []
+        for i, cid in enumerate(batch):
+            if np.any(conflicts[i, accepted]):
+                deferred.append(cid)
+                continue
+
+            proposed_center, proposed_center_ind, ctr_dist = drawn.pop(cid)
+            changed, changed_assigs, changed_dists = changes[i][:3]
+
+            old_cost = running_cost.value
+            if fused_cost:
+                new_cost = running_cost.propose_delta(deltas[i])
+            else:
+                new_cost = running_cost.propose(
+                    changed, distances[changed], changed_dists)
+
+            if new_cost < old_cost:
+                logger.debug(
+                    "Accepted proposed center for k=%s: cost %.5f -> %.5f).",
+                    cid, old_cost, new_cost)
+                running_cost.accept(new_cost)
+                members.update(changed, assignments[changed], changed_assigs)
+                distances[changed] = changed_dists
+                assignments[changed] = changed_assigs
+                _accept_bounds(lower, ctr_dist, changed, changes[i][6])
+                _accept_cached(distance_cache, medoid_inds[cid],
+                               proposed_center_ind, ctr_dist)
+                if lower is not None:
+                    # the bounds of the changed frames were computed
+                    # before this pass's earlier acceptances.
+                    for d in accepted_dists:
+                        lower[changed] = np.minimum(lower[changed],
+                                                    d[changed])
+                    accepted_dists.append(ctr_dist)
+                medoid_coords[cid] = proposed_center
+                medoid_inds[cid] = proposed_center_ind
+                accepted.append(i)
+                acceptances += 1
+            else:
+                logger.debug(
+                    "Rejected proposed center for k=%s: cost %.5f -> %.5f).",
+                    cid, old_cost, new_cost)
+
+        logger.debug("Kmedoids pass %s deferred %s of %s proposals.",
+                     n_passes, len(deferred), len(batch))
+        queue = deferred + queue
+
+    logger.debug("Batched kmedoids sweep took %s passes.", n_passes)
+
+    return acceptances
+
+
+def _propose_new_centers(X, state_inds, proposals, mpi_mode, random_state):
+    """Propose new centers amongst each of several lists of indices, as
+    `_propose_new_center_amongst` does for one. In MPI mode, this uses a
+    fixed number of collectives regardless of the number of lists.
+
+    Returns
+    -------
+    proposed_centers : list
+        The coordinates of each proposed center.
+    proposed_center_inds : list
+        The index, or (rank, index), of each proposed center.
+    """
+
+    if proposals is None and not mpi_mode:
+        proposed = [_propose_new_center_amongst(
+            X, inds, mpi_mode=False, random_state=random_state)
+            for inds in state_inds]
+        return [p[0] for p in proposed], [p[1] for p in proposed]
+
+    if proposals is None:
+        locations = mpi.ops.randinds(state_inds, random_state)
+        owner_ranks = [r for r, _ in locations]
+        world_inds = [inds[idx] if r == mpi.MPI_RANK else None
+                      for inds, (r, idx) in zip(state_inds, locations)]
+    elif mpi_mode:
+        owner_ranks = [r for r, _ in proposals]
+        world_inds = [i for _, i in proposals]
+    else:
+        return [X[i] for i in proposals], list(proposals)
+
+    centers, world_inds = mpi.ops.distribute_frames(
+        X, world_inds, owner_ranks)
+
+    return centers, list(zip(owner_ranks, world_inds))
+
+
+def _distances_to_centers(X, metric, centers):
+    """Compute the distance from each of `centers` to every frame in
+    `X`, as an array of shape (len(centers), len(X)).
+
+    For libdist's euclidean and RMSD metrics, this is a single
+    thread-parallel pass over `X`. A CoordinateStore `X` is streamed a
+    block at a time, so it is read once for all of `centers`, and a
+    SharedCoordinates `X` computes its blocks in parallel, into its
+    shared outputs, `n_outputs` centers at a time.
+    """
+
+    if isinstance(X, CoordinateStore):
+        out = np.empty((len(centers), len(X)), dtype=float)
+        step = max(int(min(len(centers), X.n_outputs)), 1)
+        for i in range(0, len(centers), step):
+            rows, labels = X.empty_outputs(len(centers[i:i+step]))
+            for _ in X.map_blocks_into(
+                    _block_distances_to_centers, rows, labels, metric,
+                    centers[i:i+step]):
+                pass
+            out[i:i+step] = rows
+        return out
+
+    if metric is libdist.euclidean and isinstance(X, np.ndarray) and \
+            len(X.shape) == 2:
+        return libdist.distance_matrix(X, np.array(centers), 'euclidean')
+    elif metric is libdist.rmsd:
+        if all(isinstance(c, libdist.PreparedCoordinates) for c in centers):
+            Y = libdist.PreparedCoordinates._from_prepared(
+                np.concatenate([c.xyz for c in centers]),
+                np.concatenate([c.traces for c in centers]))
+        else:
+            xyz = [np.asarray(c.xyz if hasattr(c, 'xyz') else c)
+                   for c in centers]
+            Y = np.concatenate([x.reshape((-1,) + x.shape[-2:])
+                                for x in xyz])
+        return libdist.distance_matrix(X, Y, 'rmsd')
+    else:
+        return np.array([metric(X, c) for c in centers])
+
+
+def _block_distances_to_centers(block, out, labels, metric, centers):
+    out[:] = _distances_to_centers(
+        util._prepare_block(block, metric), metric, centers)
+
+
+def _proposal_conflicts(batch, changes, ctr_dists, n_frames):
+    """Find which of a batch of proposals interact (see
+    `_batched_pam_sweep`), as a symmetric boolean matrix.
+    """
+
+    touched = scipy.sparse.csr_matrix(
+        (np.ones(sum(len(c[0]) for c in changes)),
+         (np.concatenate([np.full(len(c[0]), i)
+                          for i, c in enumerate(changes)]),
+          np.concatenate([c[0] for c in changes]))),
+        shape=(len(batch), n_frames))
+    conflicts = touched.dot(touched.T).toarray() > 0
+
+    for i, (_, _, _, ambig_frames, ambig_assigs, ambig_dists, _) in \
+            enumerate(changes):
+        conflicts[i] |= np.isin(batch, ambig_assigs)
+        conflicts[i] |= np.any(
+            ctr_dists[:, ambig_frames] < ambig_dists, axis=1)
+
+    conflicts |= conflicts.T
+    np.fill_diagonal(conflicts, False)
+
+    return conflicts
+
+
+class _SegmentMax(object):
+    """A max segment tree over an array, which gives the maximum of the
+    array after changing some of its elements in O(n_changed*log(n))
+    without modifying the tree, and applies the change in the same time.
+    """
+
+    def __init__(self, values):
+
+        self._size = 1 << max(0, (len(values) - 1).bit_length())
+        self._tree = np.full(2*self._size, -np.inf)
+        self._tree[self._size:self._size+len(values)] = values
+
+        # fill in the internal nodes one level at a time
+        level = self._size
+        while level > 1:
+            self._tree[level//2:level] = np.maximum(
+                self._tree[level:2*level:2], self._tree[level+1:2*level:2])
+            level //= 2
+
+    def max(self):
+        return self._tree[1]
+
+    def propose(self, indices, values):
+        """Compute the maximum of the array with `values` at `indices`.
+
+        Returns
+        -------
+        new_max : float
+            The maximum of the array after the change.
+        updates : list, [(nodes, values), ...]
+            The nodes of the tree changed at each level, to pass to
+            `commit` to apply the change.
+        """
+
+        if len(indices) == 0:
+            return self.max(), []
+
+        nodes = np.asarray(indices) + self._size
+        order = np.argsort(nodes)
+        nodes, vals = nodes[order], np.asarray(values)[order]
+
+        updates = [(nodes, vals)]
+        while nodes[0] > 1:
+            parents = np.unique(nodes // 2)
+            children = [self._tree[2*parents], self._tree[2*parents+1]]
+
+            # children that changed take their new values
+            for child_vals, child_nodes in zip(
+                    children, [2*parents, 2*parents+1]):
+                pos = np.minimum(np.searchsorted(nodes, child_nodes),
+                                 len(nodes) - 1)
+                hit = nodes[pos] == child_nodes
+                child_vals[hit] = vals[pos[hit]]
+
+            nodes, vals = parents, np.maximum(*children)
+            updates.append((nodes, vals))
+
+        return vals[0], updates
+
+    def commit(self, updates):
+        for nodes, vals in updates:
+            self._tree[nodes] = vals
+
+
+class _MeanSquareCost(object):
+    """Running mean-square cost, which keeps the sum of squared
+    distances so that a proposal costs one sum over the frames it
+    changes (and, in MPI mode, one allreduce).
+    """
+
+    def __init__(self, distances, mpi_mode):
+
+        self.mpi_mode = mpi_mode
+
+        totals = np.array([np.sum(np.square(distances, dtype=np.float64)),
+                           len(distances)])
+        if mpi_mode:
+            totals = mpi.MPI.COMM_WORLD.allreduce(totals, op=mpi.MPI.SUM)
+
+        self._sum, self._n = totals
+        self._pending = None
+        self.value = self._sum / self._n
+
+    def local_delta(self, old_distances, new_distances):
+        """The change in this node's sum of squares from changing
+        `old_distances` to `new_distances`.
+        """
+        return (np.sum(np.square(new_distances, dtype=np.float64)) -
+                np.sum(np.square(old_distances, dtype=np.float64)))
+
+    def propose(self, frames, old_distances, new_distances):
+        delta = self.local_delta(old_distances, new_distances)
+        if self.mpi_mode:
+            delta = mpi.MPI.COMM_WORLD.allreduce(delta, op=mpi.MPI.SUM)
+
+        return self.propose_delta(delta)
+
+    def propose_delta(self, delta):
+        """The cost after changing the global sum of squares by `delta`.
+        """
+        self._pending = self._sum + delta
+        return self._pending / self._n
+
+    def accept(self, new_cost):
+        self._sum = self._pending
+        self.value = new_cost
+
+
+class _MaxCost(object):
+    """Running max cost, which keeps a segment tree over the distances
+    so that a proposal costs O(n_changed*log(n)) (and, in MPI mode, one
+    allreduce).
+    """
+
+    def __init__(self, distances, mpi_mode):
+
+        self.mpi_mode = mpi_mode
+        self._tree = _SegmentMax(distances)
+        self._pending = None
+        self.value = self._reduce(self._tree.max())
+
+    def _reduce(self, local_max):
+        if self.mpi_mode:
+            return mpi.MPI.COMM_WORLD.allreduce(local_max, op=mpi.MPI.MAX)
+        return local_max
+
+    def propose(self, frames, old_distances, new_distances):
+        local_max, self._pending = self._tree.propose(frames, new_distances)
+        return self._reduce(local_max)
+
+    def accept(self, new_cost):
+        self._tree.commit(self._pending)
+        self.value = new_cost
+
+
+class _FullCost(object):
+    """Cost given by an arbitrary function of all the distances, which
+    is recomputed in full for every proposal.
+    """
+
+    def __init__(self, cost, distances):
+
+        self.cost = cost
+        self._distances = distances
+        self.value = cost(distances)
+
+    def propose(self, frames, old_distances, new_distances):
+        distances = self._distances.copy()
+        distances[frames] = new_distances
+        return self.cost(distances)
+
+    def accept(self, new_cost):
+        self.value = new_cost
+
+
+def _running_cost(cost, distances, mpi_mode):
+    """Build the bookkeeping object that computes the cost of kmedoids
+    proposals for the cost function `cost` and current `distances`.
+    """
+
+    if cost is _msq:
+        return _MeanSquareCost(distances, mpi_mode)
+    elif cost is np.max or cost is np.amax:
+        return _MaxCost(distances, mpi_mode)
+    else:
+        return _FullCost(cost, distances)
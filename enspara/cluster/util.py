@@ -8,7 +8,7 @@
 # Proprietary and confidential
 
 import logging
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 import mdtraj as md
 import numpy as np
@@ -17,11 +17,13 @@ from sklearn.base import BaseEstimator, ClusterMixin
 
 from sklearn.utils import check_random_state
 
-from ..geometry.libdist import euclidean
+from ..geometry import libdist
+from ..geometry.libdist import euclidean, rmsd
 
 from ..exception import ImproperlyConfigured, DataInvalid
 from ..util import partition_list, partition_indices
 from ..util import array as ra
+from ..util.store import CoordinateStore
 
 logger = logging.getLogger(__name__)
 
@@ -43,7 +45,35 @@ class Clusterer(BaseEstimator, ClusterMixin):
     def fit(self, X):
         raise NotImplementedError("All Clusterers should implement fit().")
 
-    def predict(self, X):
+    def _extend_clustering(self, X):
+        """Extend the current clustering to `X`, the data previously fit
+        followed by new observations, by assigning the new observations
+        to the existing centers.
+
+        Returns
+        -------
+        n_fit : int
+            The number of observations previously fit.
+        clustering : tuple
+            The center indices, assignments and distances for all of
+            `X`.
+        """
+
+        n_fit = len(self.labels_)
+        if len(X) < n_fit:
+            raise DataInvalid(
+                "Data has %s observations, but %s were already fit. Data "
+                "should be the data previously fit followed by new "
+                "observations." % (len(X), n_fit))
+
+        new_assigs, new_dists = assign_to_nearest_center(
+            X[n_fit:], self.centers_, self.metric)
+
+        return n_fit, (list(self.center_indices_),
+                       np.concatenate([self.labels_, new_assigs]),
+                       np.concatenate([self.distances_, new_dists]))
+
+    def predict(self, X, bounds=None):
         """Use an existing clustring fit to predict the assignments,
         distances, and center indices of on new data.new
 
@@ -53,6 +83,12 @@ class Clusterer(BaseEstimator, ClusterMixin):
         ----------
         X : array-like, shape=(n_states, n_features)
             New data to predict.
+        bounds : AssignmentBounds, default=None
+            Bounds from assigning `X` to earlier centers (e.g. those of
+            a previous fit, or from `AssignmentBounds.from_centers`).
+            Only frames the bounds can't rule out are reassigned, and
+            the bounds are updated for the current centers. The metric
+            must obey the triangle inequality.
 
         Returns
         -------
@@ -66,10 +102,14 @@ class Clusterer(BaseEstimator, ClusterMixin):
                 "To predict the clustering result for new data, the "
                 "clusterer first must have fit some data.")
 
-        pred_assigs, pred_dists = assign_to_nearest_center(
-            trajectory=X,
-            cluster_centers=self.centers_,
-            distance_method=self.metric)
+        if bounds is not None:
+            pred_assigs, pred_dists = bounds.update(
+                X, self.centers_, self.metric)
+        else:
+            pred_assigs, pred_dists = assign_to_nearest_center(
+                trajectory=X,
+                cluster_centers=self.centers_,
+                distance_method=self.metric)
         pred_centers = find_cluster_centers(pred_assigs, pred_dists)
 
         result = ClusterResult(
@@ -167,6 +207,12 @@ def assign_to_nearest_center(trajectory, cluster_centers, distance_method):
         The distance method to use for assigning each observation in
         trajectorys to one of the cluster_centers. Must take the entire
         trajectory and one item from cluster_centers as parameters.
+        If `trajectory` is a CoordinateStore, it is instead given one
+        block of the store at a time (see
+        `CoordinateStore.map_blocks_into`).
+        If this is `libdist.euclidean` and both `trajectory` and
+        `cluster_centers` are 2d arrays, the blocked many-to-many
+        kernel `libdist.assign_to_nearest_center` is used instead.
 
     Returns
     ----------
@@ -178,6 +224,25 @@ def assign_to_nearest_center(trajectory, cluster_centers, distance_method):
         frame in cluster_centers.
     """
 
+    # stream disk-backed data a block at a time.
+    if isinstance(trajectory, CoordinateStore):
+        out, labels = trajectory.empty_outputs(1)
+        for _ in trajectory.map_blocks_into(
+                _assign_block, out, labels, cluster_centers,
+                distance_method):
+            pass
+        return labels.astype(int), np.array(out[0])
+
+    # for plain feature vectors, a single blocked kernel is much faster
+    # than looping over centers in python, especially for many centers.
+    if distance_method is euclidean and isinstance(trajectory, np.ndarray) \
+            and len(trajectory.shape) == 2:
+        centers = np.asarray(cluster_centers)
+        if len(centers.shape) == 2 and centers.dtype != object:
+            assignments, distances = libdist.assign_to_nearest_center(
+                trajectory, centers)
+            return assignments.astype(int), distances
+
     assignments = np.zeros(len(trajectory), dtype=int)
     distances = np.empty(len(trajectory), dtype=float)
     distances.fill(np.inf)
@@ -200,6 +265,312 @@ def assign_to_nearest_center(trajectory, cluster_centers, distance_method):
     return assignments, distances
 
 
+def _nearest_two_centers(trajectory, cluster_centers, distance_method):
+    """Find the nearest and second-nearest center to each frame.
+
+    Returns
+    -------
+    assignments : ndarray, shape=(n_frames,)
+        The index of the nearest center to each frame.
+    distances : ndarray, shape=(n_frames,)
+        The distance from each frame to its nearest center.
+    second_distances : ndarray, shape=(n_frames,)
+        The distance from each frame to its second-nearest center, or
+        np.inf if there is only one center.
+    """
+
+    if distance_method is euclidean and isinstance(trajectory, np.ndarray) \
+            and len(trajectory.shape) == 2 and len(cluster_centers) > 1:
+        centers = np.asarray(cluster_centers)
+        if len(centers.shape) == 2 and centers.dtype != object:
+            dists = libdist.distance_matrix(trajectory, centers, 'euclidean')
+            assignments = np.argmin(dists, axis=0)
+            nearest_two = np.partition(dists, 1, axis=0)
+            return assignments, nearest_two[0], nearest_two[1]
+
+    assignments = np.zeros(len(trajectory), dtype=int)
+    distances = np.full(len(trajectory), np.inf)
+    second_distances = np.full(len(trajectory), np.inf)
+
+    for i, center in enumerate(cluster_centers):
+        dist = distance_method(trajectory, center)
+
+        second_distances = np.where(
+            dist < distances, distances, np.minimum(second_distances, dist))
+        inds = (dist < distances)
+        distances[inds] = dist[inds]
+        assignments[inds] = i
+
+    return assignments, distances, second_distances
+
+
+class AssignmentBounds(object):
+    """Bounds on the distance from each frame to the centers, for
+    repeatedly assigning the same frames to centers that move a little
+    between assignments.
+
+    For each frame, `upper` bounds the distance to its assigned center
+    and `lower` bounds the distance to every other center. When centers
+    move, the triangle inequality loosens the bounds by the distance
+    each center moved. A frame can only have changed center if its
+    upper bound exceeds its lower bound, so reassigning only computes
+    the distances to all centers for those frames [1, 2].
+
+    Unlike [1], a single lower bound per frame (as in [2]) is kept, so
+    that the bounds take memory proportional to the number of frames
+    rather than to frames times centers.
+
+    Parameters
+    ----------
+    assignments : array, shape=(n_frames,)
+        The assignment of each frame.
+    distances : array, shape=(n_frames,)
+        The distance from each frame to its assigned center.
+    lower : array, shape=(n_frames,), default=None
+        A lower bound on the distance from each frame to every center
+        it isn't assigned to. If not given, the bound is zero, which is
+        valid but prunes nothing until it is tightened.
+    centers : array-like, default=None
+        The centers `assignments` refer to. They are needed by `update`
+        to find how far each center has moved.
+
+    References
+    ----------
+    .. [1] Elkan, C. Using the triangle inequality to accelerate k-means. Proceedings of the 20th International Conference on Machine Learning, 147–153 (2003).
+    .. [2] Hamerly, G. Making k-means even faster. Proceedings of the 2010 SIAM International Conference on Data Mining, 130–140 (2010).
+    """
+
+    def __init__(self, assignments, distances, lower=None, centers=None):
+
+        self.assignments = np.array(assignments, dtype=int)
+        self.upper = np.array(distances, dtype=np.float64)
+
+        if lower is None:
+            self.lower = np.zeros(len(self.upper))
+        else:
+            self.lower = np.array(lower, dtype=np.float64)
+
+        # whether `upper` is the exact distance, rather than a bound
+        self.exact = np.ones(len(self.upper), dtype=bool)
+        self.centers = centers
+
+    @classmethod
+    def from_centers(cls, X, centers, distance_method):
+        """Assign `X` to `centers` and build exact bounds for it.
+        """
+
+        assignments, distances, lower = _nearest_two_centers(
+            X, centers, distance_method)
+        return cls(assignments, distances, lower, centers=centers)
+
+    def __len__(self):
+        return len(self.upper)
+
+    def move_centers(self, shifts):
+        """Loosen the bounds after each center `i` moved by `shifts[i]`.
+        """
+
+        shifts = np.asarray(shifts, dtype=np.float64)
+        if len(shifts) == 0:
+            return
+
+        moved = shifts[self.assignments] > 0
+        self.upper += shifts[self.assignments]
+        self.exact &= ~moved
+
+        # the lower bound is to the other centers, so it only needs to
+        # be loosened by the largest move amongst those.
+        if len(shifts) > 1:
+            order = np.argsort(shifts)
+            largest, second_largest = shifts[order[-1]], shifts[order[-2]]
+            self.lower -= np.where(self.assignments == order[-1],
+                                   second_largest, largest)
+        np.maximum(self.lower, 0, out=self.lower)
+
+    def update(self, X, centers, distance_method):
+        """Reassign `X` to `centers`, moved from `self.centers`, to its
+        nearest center, only recomputing the frames the bounds can't
+        rule out.
+
+        Parameters
+        ----------
+        X : array-like, shape=(n_frames, ...)
+            The frames the bounds are for.
+        centers : array-like, shape=(n_centers, ...)
+            The new centers. If there are a different number than
+            before, every frame is reassigned.
+        distance_method : callable
+            The distance metric, which must obey the triangle
+            inequality.
+
+        Returns
+        -------
+        assignments : ndarray, shape=(n_frames,)
+            The assignment of each frame to its nearest center.
+        distances : ndarray, shape=(n_frames,)
+            The distance between each frame and its nearest center.
+        """
+
+        if len(X) != len(self):
+            raise DataInvalid(
+                "Bounds are for %s frames, but data has %s frames." %
+                (len(self), len(X)))
+
+        if self.centers is None or len(centers) != len(self.centers):
+            rebuilt = AssignmentBounds.from_centers(
+                X, centers, distance_method)
+            self.__dict__.update(rebuilt.__dict__)
+            return self.assignments.copy(), self.upper.copy()
+
+        self.move_centers([distance_method(self.centers[i:i+1], centers[i])[0]
+                           for i in range(len(centers))])
+        self.centers = centers
+
+        # make the upper bounds exact, which the distances returned must
+        # be anyway; this may already rule out reassignment.
+        for i in np.unique(self.assignments[~self.exact]):
+            frames = np.flatnonzero(~self.exact & (self.assignments == i))
+            self.upper[frames] = distance_method(X[frames], centers[i])
+        self.exact[:] = True
+
+        frames = np.flatnonzero(self.upper > self.lower)
+        logger.debug("Bounds ruled out reassigning %s of %s frames.",
+                     len(self) - len(frames), len(self))
+
+        if len(frames) > 0:
+            self.assignments[frames], self.upper[frames], \
+                self.lower[frames] = _nearest_two_centers(
+                    X[frames], centers, distance_method)
+
+        return self.assignments.copy(), self.upper.copy()
+
+
+class DistanceCache(object):
+    """Least-recently-used cache of the distance from centers to every
+    frame, keyed by the center's index.
+
+    Clustering computes the distance from each new center (or proposed
+    medoid) to every frame. Keeping those vectors lets later steps look
+    up a frame's distance to a center rather than recompute it.
+
+    Parameters
+    ----------
+    max_bytes : int
+        The most memory the cached vectors may take. When a new vector
+        doesn't fit, the least recently used vectors are evicted.
+    filename : str, default=None
+        If given, vectors are stored in an np.memmap at this path rather
+        than in memory, so the budget can exceed the available RAM.
+    """
+
+    def __init__(self, max_bytes, filename=None):
+
+        if max_bytes < 0:
+            raise ImproperlyConfigured(
+                "Cache size must be non-negative, got %s." % max_bytes)
+
+        self.max_bytes = max_bytes
+        self.filename = filename
+
+        # key -> vector in memory, or key -> slot of the memmap
+        self._entries = OrderedDict()
+        self._memmap = None
+        self._free_slots = []
+        self._nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    @property
+    def nbytes(self):
+        if self._memmap is not None:
+            return len(self._entries) * self._memmap.shape[1] * \
+                self._memmap.itemsize
+        return self._nbytes
+
+    def get(self, key):
+        """Get the vector for `key`, or None if it isn't cached.
+        """
+
+        if key not in self._entries:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+
+        entry = self._entries[key]
+        if self._memmap is not None:
+            return self._memmap[entry]
+        return entry
+
+    def put(self, key, vector):
+        """Cache `vector` under `key`, evicting the least recently used
+        vectors as needed. Vectors larger than the budget aren't cached.
+        """
+
+        vector = np.asarray(vector, dtype=np.float64)
+        if vector.nbytes > self.max_bytes:
+            return
+
+        self.discard(key)
+
+        if self.filename is None:
+            while self._entries and \
+                    self._nbytes + vector.nbytes > self.max_bytes:
+                self._nbytes -= self._entries.popitem(last=False)[1].nbytes
+            self._entries[key] = vector.copy()
+            self._nbytes += vector.nbytes
+            return
+
+        if self._memmap is None:
+            self._memmap = np.memmap(
+                self.filename, dtype=np.float64, mode='w+',
+                shape=(self.max_bytes // vector.nbytes, len(vector)))
+            self._free_slots = list(range(len(self._memmap)))
+        elif len(vector) != self._memmap.shape[1]:
+            raise DataInvalid(
+                "Cached vectors have length %s, got one of length %s." %
+                (self._memmap.shape[1], len(vector)))
+
+        if not self._free_slots:
+            _, slot = self._entries.popitem(last=False)
+            self._free_slots.append(slot)
+
+        slot = self._free_slots.pop()
+        self._memmap[slot] = vector
+        self._entries[key] = slot
+
+    def discard(self, key):
+        """Remove the vector for `key`, if it is cached.
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+
+        if self._memmap is not None:
+            self._free_slots.append(entry)
+        else:
+            self._nbytes -= entry.nbytes
+
+
+def _cache_key(center_index):
+    """The DistanceCache key of a center index, which may be an int or,
+    in MPI mode, a (rank, index) pair.
+    """
+
+    if hasattr(center_index, '__len__'):
+        return tuple(int(i) for i in center_index)
+    return int(center_index)
+
+
 def find_cluster_centers(assignments, distances):
     """Given a list of distances and assignments, find the
     lowest-distance frame to each label in assignments.
@@ -225,11 +596,12 @@ def find_cluster_centers(assignments, distances):
             "Length of distances (%s) must match length of assignments "
             "(%s)." % (len(distances), len(assignments)))
 
-    unique_centers = np.unique(assignments)
+    unique_centers, labels = np.unique(assignments, return_inverse=True)
     center_inds = np.zeros_like(unique_centers)
 
-    for i, c in enumerate(unique_centers):
-        assigned_frames = np.where(assignments == c)[0]
+    members = ClusterMembership(labels, n_clusters=len(unique_centers))
+    for i in range(len(unique_centers)):
+        assigned_frames = members[i]
         ind = assigned_frames[np.argmin(distances[assigned_frames])]
 
         center_inds[i] = ind
@@ -237,6 +609,102 @@ def find_cluster_centers(assignments, distances):
     return center_inds
 
 
+class ClusterMembership(object):
+    """Index of the frames assigned to each cluster.
+
+    The index is built in CSR style with a single stable argsort and
+    bincount over the assignments, so looking up the members of a
+    cluster is a slice rather than an O(n_frames) `np.where`. When
+    assignments change, `update` touches only the clusters involved.
+
+    Parameters
+    ----------
+    assignments : array-like, shape=(n_frames,)
+        The assignment of each frame to a cluster, as integers in
+        [0, n_clusters).
+    n_clusters : int, default=None
+        The number of clusters. If not given, one more than the largest
+        assignment. Clusters with no members have an empty index.
+
+    Examples
+    --------
+    >>> members = ClusterMembership([1, 0, 1, 1])
+    >>> members[1]
+    array([0, 2, 3])
+    """
+
+    def __init__(self, assignments, n_clusters=None):
+
+        assignments = np.asarray(assignments)
+        if n_clusters is None:
+            n_clusters = assignments.max() + 1 if len(assignments) else 0
+
+        order = np.argsort(assignments, kind='mergesort')
+        offsets = np.zeros(n_clusters + 1, dtype=int)
+        np.cumsum(np.bincount(assignments, minlength=n_clusters),
+                  out=offsets[1:])
+
+        self._members = [order[offsets[i]:offsets[i+1]]
+                         for i in range(n_clusters)]
+
+    def __len__(self):
+        return len(self._members)
+
+    def __getitem__(self, cluster):
+        """The indices, in ascending order, of the frames assigned to
+        `cluster`.
+        """
+        return self._members[cluster]
+
+    def update(self, frames, old_assignments, new_assignments):
+        """Move `frames` from the clusters in `old_assignments` to the
+        clusters in `new_assignments`.
+
+        Parameters
+        ----------
+        frames : array-like, shape=(n_changed,)
+            Indices of the frames whose assignment changed.
+        old_assignments : array-like, shape=(n_changed,)
+            The cluster each frame in `frames` was assigned to.
+        new_assignments : array-like, shape=(n_changed,)
+            The cluster each frame in `frames` is now assigned to.
+        """
+
+        frames = np.asarray(frames)
+        old_assignments = np.asarray(old_assignments)
+        new_assignments = np.asarray(new_assignments)
+
+        for c in np.unique(old_assignments):
+            self._members[c] = np.setdiff1d(
+                self._members[c], frames[old_assignments == c],
+                assume_unique=True)
+
+        for c in np.unique(new_assignments):
+            self._members[c] = np.union1d(
+                self._members[c], frames[new_assignments == c])
+
+
+def _prepare_block(block, distance_method):
+    """Prepare a block of a CoordinateStore for repeated distance
+    computations with `distance_method`. Blocks are prepared in place
+    only if they own their data, so views (of an in-memory array, or of
+    a SharedCoordinates' shared memory) are never modified, and
+    blocks a SharedCoordinates prepared already are used as they are.
+    """
+
+    if distance_method is rmsd and \
+            not isinstance(block, libdist.PreparedCoordinates):
+        return libdist.PreparedCoordinates(
+            block, copy=not block.flags.owndata)
+    return block
+
+
+def _assign_block(block, out, labels, cluster_centers, distance_method):
+    labels[:], out[0] = assign_to_nearest_center(
+        _prepare_block(block, distance_method), cluster_centers,
+        distance_method)
+
+
 def load_frames(filenames, indices, **kwargs):
     """Load specific frame indices from a list of trajectory files.
 
@@ -283,7 +751,7 @@ def load_frames(filenames, indices, **kwargs):
 
 def _get_distance_method(metric):
     if metric == 'rmsd':
-        return md.rmsd
+        return rmsd
     if metric == 'euclidean':
         return euclidean
     elif isinstance(metric, str):
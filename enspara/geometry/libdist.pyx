@@ -14,9 +14,33 @@ ctypedef fused FLOAT_TYPE_T:
     np.float32_t
     np.float64_t
 
+# types for the in-place "update nearest" kernels, which support storing
+# distances at reduced precision and either width of assignment label.
+ctypedef fused REAL_T:
+    np.float32_t
+    np.float64_t
+
+ctypedef fused DIST_T:
+    np.float32_t
+    np.float64_t
+
+ctypedef fused LABEL_T:
+    np.int32_t
+    np.int64_t
+
 cdef extern from "math.h" nogil:
     double sqrt(double x)
     double abs(double x)
+    double fabs(double x)
+
+# convergence criterion and iteration cap for the Newton-Raphson solve
+# for the largest eigenvalue of the QCP key matrix (see _qcp_rmsd)
+DEF QCP_EVAL_PREC = 1e-11
+DEF QCP_MAX_ITERS = 50
+
+# number of consecutive observations per work unit in the update nearest
+# kernels; each unit reports its own max, which are then reduced serially.
+DEF UPDATE_CHUNK_SIZE = 4096
 
 def _check_is_2d(X):
     if len(X.shape) != 2:
@@ -30,6 +54,23 @@ def _check_is_1d(x):
             "Target point dimension must be one, got shape %s." %
             str(x.shape))
 
+def _check_frames(frames, n_samples):
+    """Check that `frames` are indices of observations in an array of
+    `n_samples`, and convert them for the subset kernels.
+    """
+
+    frames = np.require(frames, dtype=np.intp, requirements='C')
+    if len(frames.shape) != 1:
+        raise exception.DataInvalid(
+            "Frame indices must be one-dimensional, got shape %s." %
+            str(frames.shape))
+    if len(frames) > 0 and (frames.min() < 0 or frames.max() >= n_samples):
+        raise exception.DataInvalid(
+            "Frame indices must be in [0, %s), got indices in [%s, %s]." %
+            (n_samples, frames.min(), frames.max()))
+
+    return frames
+
 def _prepare_for_2d_to_1d_distance(X, y, out):
 
     _check_is_2d(X)
@@ -111,7 +152,33 @@ def _euclidean(np.ndarray[FLOAT_TYPE_T, ndim=2] X,
     return out.reshape(-1, 1)
 
 
-def euclidean(X, y, out=None):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _euclidean_subset(np.ndarray[FLOAT_TYPE_T, ndim=2] X,
+                      np.ndarray[np.intp_t, ndim=1] frames,
+                      np.ndarray[FLOAT_TYPE_T, ndim=1] y,
+                      np.ndarray[np.float64_t, ndim=1] out):
+
+    cdef long n_samples = len(out)
+    cdef long n_features = len(y)
+    assert len(frames) == n_samples
+    assert n_features == X.shape[1]
+
+    cdef long i, j, f
+
+    # the same operations as `_euclidean`, so that the distances are
+    # bitwise identical to those of X[frames].
+    for i in prange(n_samples, nogil=True):
+        out[i] = 0
+        f = frames[i]
+        for j in range(n_features):
+            out[i] += (X[f, j] - y[j])**2
+        out[i] = sqrt(out[i])
+
+    return out
+
+
+def euclidean(X, y, out=None, frames=None):
     """Compute the euclidean distance between a point, `y`, and a group
     of points `X`. Uses thread-parallelism with OpenMP.
 
@@ -124,9 +191,21 @@ def euclidean(X, y, out=None):
     out: array, shape=(n_samples), default=None
         If provided, the array to place the distances in. If not provided,
         an array will be allocated for you.
+    frames : array, shape=(n_frames,), default=None
+        If provided, compute the distances for only these rows of `X`,
+        as though for `X[frames]` but without copying them. `out` then
+        has shape (n_frames,).
     """
-    out = _prepare_for_2d_to_1d_distance(X, y, out)
-    _euclidean(X, y, out)
+
+    if frames is None:
+        out = _prepare_for_2d_to_1d_distance(X, y, out)
+        _euclidean(X, y, out)
+        return out
+
+    frames = _check_frames(frames, len(X))
+    out = _prepare_for_2d_to_1d_distance(
+        np.broadcast_to(X[:1], (len(frames), X.shape[1])), y, out)
+    _euclidean_subset(X, frames, y, out)
     return out
 
 def manhattan(X, y, out=None):
@@ -147,3 +226,841 @@ def manhattan(X, y, out=None):
     out = _prepare_for_2d_to_1d_distance(X, y, out)
     _manhattan(X, y, out)
     return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef inline double _qcp_rmsd(
+        float[:, :, ::1] X, long i, float[:, ::1] y, double x_trace,
+        double y_trace) nogil:
+    """RMSD between precentered frame `X[i]` and precentered frame `y`
+    after optimal superposition, by the Quaternion Characteristic
+    Polynomial method [1]. The rotation itself is never computed.
+
+    References
+    ----------
+    .. [1] Theobald, D. L. Rapid calculation of RMSDs using a
+       quaternion-based characteristic polynomial. Acta Cryst. A61,
+       478–480 (2005).
+    """
+
+    cdef long k
+    cdef long n_atoms = y.shape[0]
+    cdef double x0, x1, x2, y0, y1, y2
+    cdef double sxx = 0, sxy = 0, sxz = 0
+    cdef double syx = 0, syy = 0, syz = 0
+    cdef double szx = 0, szy = 0, szz = 0
+
+    for k in range(n_atoms):
+        x0 = X[i, k, 0]
+        x1 = X[i, k, 1]
+        x2 = X[i, k, 2]
+        y0 = y[k, 0]
+        y1 = y[k, 1]
+        y2 = y[k, 2]
+
+        sxx = sxx + x0 * y0
+        sxy = sxy + x0 * y1
+        sxz = sxz + x0 * y2
+        syx = syx + x1 * y0
+        syy = syy + x1 * y1
+        syz = syz + x1 * y2
+        szx = szx + x2 * y0
+        szy = szy + x2 * y1
+        szz = szz + x2 * y2
+
+    cdef double sxx2 = sxx * sxx
+    cdef double syy2 = syy * syy
+    cdef double szz2 = szz * szz
+    cdef double sxy2 = sxy * sxy
+    cdef double syz2 = syz * syz
+    cdef double sxz2 = sxz * sxz
+    cdef double syx2 = syx * syx
+    cdef double szy2 = szy * szy
+    cdef double szx2 = szx * szx
+
+    cdef double syzszymsyyszz2 = 2.0 * (syz * szy - syy * szz)
+    cdef double sxx2syy2szz2syz2szy2 = syy2 + szz2 - sxx2 + syz2 + szy2
+
+    cdef double c2 = -2.0 * (sxx2 + syy2 + szz2 + sxy2 + syx2 + sxz2 +
+                             szx2 + syz2 + szy2)
+    cdef double c1 = 8.0 * (sxx * syz * szy + syy * szx * sxz +
+                            szz * sxy * syx - sxx * syy * szz -
+                            syz * szx * sxy - szy * syx * sxz)
+
+    cdef double sxzpszx = sxz + szx
+    cdef double syzpszy = syz + szy
+    cdef double sxypsyx = sxy + syx
+    cdef double syzmszy = syz - szy
+    cdef double sxzmszx = sxz - szx
+    cdef double sxymsyx = sxy - syx
+    cdef double sxxpsyy = sxx + syy
+    cdef double sxxmsyy = sxx - syy
+    cdef double sxy2sxz2syx2szx2 = sxy2 + sxz2 - syx2 - szx2
+
+    cdef double c0 = (
+        sxy2sxz2syx2szx2 * sxy2sxz2syx2szx2 +
+        (sxx2syy2szz2syz2szy2 + syzszymsyyszz2) *
+        (sxx2syy2szz2syz2szy2 - syzszymsyyszz2) +
+        (-sxzpszx * syzmszy + sxymsyx * (sxxmsyy - szz)) *
+        (-sxzmszx * syzpszy + sxymsyx * (sxxmsyy + szz)) +
+        (-sxzpszx * syzpszy - sxypsyx * (sxxpsyy - szz)) *
+        (-sxzmszx * syzmszy - sxypsyx * (sxxpsyy + szz)) +
+        (sxypsyx * syzpszy + sxzpszx * (sxxmsyy + szz)) *
+        (-sxymsyx * syzmszy + sxzpszx * (sxxpsyy + szz)) +
+        (sxypsyx * syzmszy + sxzmszx * (sxxmsyy - szz)) *
+        (-sxymsyx * syzpszy + sxzmszx * (sxxpsyy - szz)))
+
+    # the largest eigenvalue is bounded above by E0 and below by the
+    # value of the key matrix's quadratic form at each axis quaternion.
+    cdef double e0 = (x_trace + y_trace) / 2.0
+    cdef double lower = max(max(sxx + syy + szz, sxx - syy - szz),
+                            max(syy - sxx - szz, szz - sxx - syy))
+    cdef double eig = e0
+    cdef double prev_eig = e0
+    cdef double eig2, a, b, step
+    cdef double last_step = e0 - lower
+
+    # Newton-Raphson from E0 descends monotonically, with shrinking
+    # steps, to the largest root. A step that grows or reverses means
+    # the previous step was already dominated by rounding error, which
+    # for degenerate structures (e.g. two atoms) sitting on a repeated
+    # root can be large, so we back it out and stop.
+    for k in range(QCP_MAX_ITERS):
+        eig2 = eig * eig
+        b = (eig2 + c2) * eig
+        a = b + c1
+        step = (a * eig + c0) / (2.0 * eig2 * eig + b + a)
+
+        if not (0 <= step <= last_step):
+            eig = prev_eig
+            break
+
+        prev_eig = eig
+        eig = max(eig - step, lower)
+        last_step = step
+
+        if step < fabs(QCP_EVAL_PREC * eig):
+            break
+
+    return sqrt(fabs(2.0 * (e0 - eig) / n_atoms))
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _rmsd(float[:, :, ::1] X, float[:, ::1] y, double[::1] x_traces,
+          double y_trace, double[::1] out):
+
+    cdef long n_samples = out.shape[0]
+    assert X.shape[0] == n_samples
+    assert x_traces.shape[0] == n_samples
+    assert X.shape[1] == y.shape[0]
+
+    cdef long i
+    for i in prange(n_samples, nogil=True):
+        out[i] = _qcp_rmsd(X, i, y, x_traces[i], y_trace)
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _rmsd_subset(float[:, :, ::1] X, np.intp_t[::1] frames,
+                 float[:, ::1] y, double[::1] x_traces, double y_trace,
+                 double[::1] out):
+
+    cdef long n_samples = out.shape[0]
+    assert frames.shape[0] == n_samples
+    assert X.shape[1] == y.shape[0]
+
+    cdef long i
+    for i in prange(n_samples, nogil=True):
+        out[i] = _qcp_rmsd(X, frames[i], y, x_traces[frames[i]], y_trace)
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def _center_and_trace(float[:, :, ::1] X, double[::1] traces):
+    """Center each frame of `X` on its centroid in place and store the
+    trace of its inner product matrix (sum of squared coordinates) in
+    `traces`.
+    """
+
+    cdef long n_frames = X.shape[0]
+    cdef long n_atoms = X.shape[1]
+    cdef long i, k
+    cdef double cx, cy, cz, g
+
+    for i in prange(n_frames, nogil=True):
+        cx = 0
+        cy = 0
+        cz = 0
+        for k in range(n_atoms):
+            cx = cx + X[i, k, 0]
+            cy = cy + X[i, k, 1]
+            cz = cz + X[i, k, 2]
+        cx = cx / n_atoms
+        cy = cy / n_atoms
+        cz = cz / n_atoms
+
+        # the trace must be accumulated from the stored (float32)
+        # coordinates, but in double precision, or self-RMSDs are
+        # dominated by rounding error.
+        g = 0
+        for k in range(n_atoms):
+            X[i, k, 0] = <float>(X[i, k, 0] - cx)
+            X[i, k, 1] = <float>(X[i, k, 1] - cy)
+            X[i, k, 2] = <float>(X[i, k, 2] - cz)
+            g = g + (<double>X[i, k, 0] * X[i, k, 0] +
+                     <double>X[i, k, 1] * X[i, k, 1] +
+                     <double>X[i, k, 2] * X[i, k, 2])
+        traces[i] = g
+
+    return traces
+
+
+class PreparedCoordinates(object):
+    """Coordinates prepared for repeated RMSD calculations.
+
+    Each frame is centered on its centroid and the trace of its inner
+    product matrix is computed exactly once, at construction, so that
+    subsequent calls to `rmsd` do no per-call preprocessing. Indexing
+    and slicing behave like an `md.Trajectory`; integer indices return
+    a single-frame `PreparedCoordinates`, and subsets carry their
+    precomputed traces with them.
+
+    Parameters
+    ----------
+    xyz : array, shape=(n_frames, n_atoms, 3), or md.Trajectory
+        Coordinates to prepare. Anything with an `xyz` attribute (like
+        an `md.Trajectory`) is accepted.
+    copy : bool, default=True
+        If False and `xyz` is already a C-contiguous float32 array, it
+        is centered in place rather than copied. This halves the
+        memory required for large data sets, but modifies the input.
+    """
+
+    def __init__(self, xyz, copy=True):
+        if hasattr(xyz, 'xyz'):
+            xyz = xyz.xyz
+
+        self.xyz = np.array(xyz, dtype=np.float32, order='C', copy=copy)
+
+    @classmethod
+    def _from_prepared(cls, xyz, traces):
+        prepared = cls.__new__(cls)
+        prepared._xyz = np.ascontiguousarray(xyz)
+        prepared._traces = np.ascontiguousarray(traces)
+        return prepared
+
+    @property
+    def xyz(self):
+        return self._xyz
+
+    @xyz.setter
+    def xyz(self, value):
+        value = np.asarray(value)
+
+        if len(value.shape) == 2:
+            value = value.reshape(1, *value.shape)
+        if len(value.shape) != 3 or value.shape[2] != 3:
+            raise exception.DataInvalid(
+                "Coordinates must have shape (n_frames, n_atoms, 3), got "
+                "shape %s." % str(value.shape))
+
+        self._xyz = np.require(value, dtype=np.float32, requirements='C')
+        self._traces = np.zeros(self._xyz.shape[0], dtype=np.float64)
+        _center_and_trace(self._xyz, self._traces)
+
+    @property
+    def traces(self):
+        return self._traces
+
+    @property
+    def n_frames(self):
+        return self._xyz.shape[0]
+
+    @property
+    def n_atoms(self):
+        return self._xyz.shape[1]
+
+    def __len__(self):
+        return self.n_frames
+
+    def __getitem__(self, key):
+        if np.issubdtype(type(key), np.integer):
+            if key < -self.n_frames or key >= self.n_frames:
+                raise IndexError(
+                    "index %s is out of bounds for %s frames." %
+                    (key, self.n_frames))
+            key = slice(key, (key + 1) or None)
+
+        return PreparedCoordinates._from_prepared(
+            self._xyz[key], self._traces[key])
+
+    def __iter__(self):
+        for i in range(self.n_frames):
+            yield self[i]
+
+
+def _as_single_frame(y):
+    """Get the coordinates and trace of a single prepared frame.
+    """
+
+    if not isinstance(y, PreparedCoordinates):
+        y = PreparedCoordinates(y)
+
+    if y.n_frames != 1:
+        raise exception.DataInvalid(
+            "Target must be a single frame, got %s frames." % y.n_frames)
+
+    return y.xyz[0], y.traces[0]
+
+
+def rmsd(X, y, out=None, frames=None):
+    """Compute the minimal root-mean-square deviation (after optimal
+    superposition) between a structure `y` and each frame in `X` using
+    the QCP method. Uses thread-parallelism with OpenMP.
+
+    For repeated calculations against the same data, pass
+    `PreparedCoordinates` so centering and traces are computed once
+    rather than on every call.
+
+    Parameters
+    ----------
+    X : PreparedCoordinates, md.Trajectory or array, shape=(n_frames, n_atoms, 3)
+        The group of frames for which to compute the RMSD to `y`.
+    y: PreparedCoordinates, md.Trajectory or array, shape=(n_atoms, 3)
+        The frame to compute the RMSD to.
+    out: array, shape=(n_frames), default=None
+        If provided, the array to place the distances in. If not provided,
+        an array will be allocated for you.
+    frames : array, shape=(n_subset,), default=None
+        If provided, compute the RMSD for only these frames of `X`, as
+        though for `X[frames]` but without copying them. `out` then has
+        shape (n_subset,). Most useful with `PreparedCoordinates`, which
+        aren't copied or prepared again.
+
+    Returns
+    -------
+    out : array, shape=(n_frames,)
+        The RMSD between each frame in `X` and `y`.
+    """
+
+    if not isinstance(X, PreparedCoordinates):
+        X = PreparedCoordinates(X)
+
+    y_xyz, y_trace = _as_single_frame(y)
+
+    if X.n_atoms != y_xyz.shape[0]:
+        raise exception.DataInvalid(
+            ("Target frame atom count (%s) must match data array atom "
+             "count (%s)") % (y_xyz.shape[0], X.n_atoms))
+
+    if frames is None:
+        out = _prepare_for_2d_to_1d_distance(
+            X.xyz.reshape(X.n_frames, -1), y_xyz.reshape(-1), out)
+        _rmsd(X.xyz, y_xyz, X.traces, y_trace, out)
+    else:
+        frames = _check_frames(frames, X.n_frames)
+        out = _prepare_for_2d_to_1d_distance(
+            np.broadcast_to(y_xyz.reshape(1, -1), (len(frames), y_xyz.size)),
+            y_xyz.reshape(-1), out)
+        _rmsd_subset(X.xyz, frames, y_xyz, X.traces, y_trace, out)
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _update_nearest_sqeuclidean(
+        double[:, ::1] cross, double[::1] x_sqnorms, double[::1] c_sqnorms,
+        long c_offset, double[::1] min_dists, np.intp_t[::1] min_inds):
+    """Fold one tile of the squared euclidean distance matrix, given as
+    cross products `cross[i, j] = <x_i, c_j>`, into the running minimum
+    (`min_dists`) and argmin (`min_inds`) for each row.
+    """
+
+    cdef long n_rows = cross.shape[0]
+    cdef long n_cols = cross.shape[1]
+    assert x_sqnorms.shape[0] == n_rows
+    assert c_sqnorms.shape[0] == n_cols
+    assert min_dists.shape[0] == n_rows
+    assert min_inds.shape[0] == n_rows
+
+    cdef long i, j
+    cdef double d
+
+    for i in prange(n_rows, nogil=True):
+        for j in range(n_cols):
+            d = x_sqnorms[i] + c_sqnorms[j] - 2 * cross[i, j]
+            if d < min_dists[i]:
+                min_dists[i] = d
+                min_inds[i] = c_offset + j
+
+    return min_dists, min_inds
+
+
+def assign_to_nearest_center(X, centers, block_size=256):
+    """Assign each row of `X` to its nearest row in `centers` by
+    euclidean distance, without materializing the full distance matrix.
+
+    Distances are computed a tile of `block_size` rows by `block_size`
+    centers at a time using the identity |x - c|^2 = |x|^2 + |c|^2 -
+    2<x, c>, so the cross terms are a single matrix product (BLAS) per
+    tile. Only the running minimum and argmin are kept for each row.
+    The distance to the chosen center is then recomputed directly, so
+    the returned distances do not carry the cancellation error of the
+    identity.
+
+    Parameters
+    ----------
+    X : array, shape=(n_samples, n_features)
+        The points to assign.
+    centers : array, shape=(n_centers, n_features)
+        The points to assign to.
+    block_size : int, default=256
+        Number of rows and of centers in each tile. The working memory
+        is O(block_size^2) regardless of the size of `X` or `centers`.
+
+    Returns
+    -------
+    assignments : array, shape=(n_samples,)
+        The index in `centers` of the nearest center to each row of `X`.
+    distances : array, shape=(n_samples,)
+        The euclidean distance from each row of `X` to its nearest
+        center.
+    """
+
+    X = np.asarray(X)
+    centers = np.asarray(centers)
+
+    _check_is_2d(X)
+    _check_is_2d(centers)
+    if X.shape[1] != centers.shape[1]:
+        raise exception.DataInvalid(
+            ("Center dimension (%s) must match data array dimension (%s)")
+            % (centers.shape[1], X.shape[1]))
+    if block_size < 1:
+        raise exception.DataInvalid(
+            "Block size must be positive, got %s." % block_size)
+
+    n_samples = X.shape[0]
+    n_centers = centers.shape[0]
+
+    assignments = np.zeros(n_samples, dtype=np.intp)
+    distances = np.empty(n_samples, dtype=np.float64)
+    distances.fill(np.inf)
+
+    if n_samples == 0 or n_centers == 0:
+        return assignments, distances
+
+    centers = np.require(centers, dtype=np.float64, requirements='C')
+    c_sqnorms = np.einsum('ij,ij->i', centers, centers)
+
+    # a flat buffer is reused for every tile; views of its head are
+    # C-contiguous whatever the (possibly ragged, final) tile shape.
+    buf = np.empty(block_size * min(block_size, n_centers), dtype=np.float64)
+
+    for start in range(0, n_samples, block_size):
+        stop = min(start + block_size, n_samples)
+
+        # convert X a block at a time, so we never hold a float64 copy
+        # of the whole data set.
+        x = np.require(X[start:stop], dtype=np.float64, requirements='C')
+        x_sqnorms = np.einsum('ij,ij->i', x, x)
+
+        for c_start in range(0, n_centers, block_size):
+            c_stop = min(c_start + block_size, n_centers)
+
+            cross = buf[:(stop - start) * (c_stop - c_start)].reshape(
+                stop - start, c_stop - c_start)
+            np.dot(x, centers[c_start:c_stop].T, out=cross)
+
+            _update_nearest_sqeuclidean(
+                cross, x_sqnorms, c_sqnorms[c_start:c_stop], c_start,
+                distances[start:stop], assignments[start:stop])
+
+        diff = x - centers[assignments[start:stop]]
+        distances[start:stop] = np.sqrt(np.einsum('ij,ij->i', diff, diff))
+
+    return assignments, distances
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _update_nearest_euclidean(
+        REAL_T[:, ::1] X, REAL_T[::1] y, DIST_T[::1] distances,
+        LABEL_T[::1] assignments, long label, double[::1] chunk_max,
+        np.intp_t[::1] chunk_argmax):
+
+    cdef long n_samples = X.shape[0]
+    cdef long n_features = X.shape[1]
+    cdef long n_chunks = chunk_max.shape[0]
+    assert y.shape[0] == n_features
+    assert distances.shape[0] == n_samples
+    assert assignments.shape[0] == n_samples
+
+    cdef long c, i, j, start, stop, amax
+    cdef double d, dmax
+
+    # squares are taken at the data's precision, as in `_euclidean`, so
+    # that both kernels give bitwise identical distances.
+    cdef REAL_T t
+
+    for c in prange(n_chunks, nogil=True):
+        start = c * UPDATE_CHUNK_SIZE
+        stop = min(start + UPDATE_CHUNK_SIZE, n_samples)
+        dmax = -1
+        amax = start
+
+        for i in range(start, stop):
+            d = 0
+            for j in range(n_features):
+                t = X[i, j] - y[j]
+                d = d + t * t
+            d = sqrt(d)
+
+            if d < distances[i]:
+                distances[i] = <DIST_T>d
+                assignments[i] = <LABEL_T>label
+            if distances[i] > dmax:
+                dmax = distances[i]
+                amax = i
+
+        chunk_max[c] = dmax
+        chunk_argmax[c] = amax
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _update_nearest_rmsd(
+        float[:, :, ::1] X, float[:, ::1] y, double[::1] x_traces,
+        double y_trace, DIST_T[::1] distances, LABEL_T[::1] assignments,
+        long label, double[::1] chunk_max, np.intp_t[::1] chunk_argmax):
+
+    cdef long n_samples = X.shape[0]
+    cdef long n_chunks = chunk_max.shape[0]
+    assert X.shape[1] == y.shape[0]
+    assert x_traces.shape[0] == n_samples
+    assert distances.shape[0] == n_samples
+    assert assignments.shape[0] == n_samples
+
+    cdef long c, i, start, stop, amax
+    cdef double d, dmax
+
+    for c in prange(n_chunks, nogil=True):
+        start = c * UPDATE_CHUNK_SIZE
+        stop = min(start + UPDATE_CHUNK_SIZE, n_samples)
+        dmax = -1
+        amax = start
+
+        for i in range(start, stop):
+            d = _qcp_rmsd(X, i, y, x_traces[i], y_trace)
+
+            if d < distances[i]:
+                distances[i] = <DIST_T>d
+                assignments[i] = <LABEL_T>label
+            if distances[i] > dmax:
+                dmax = distances[i]
+                amax = i
+
+        chunk_max[c] = dmax
+        chunk_argmax[c] = amax
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _update_nearest_euclidean_subset(
+        REAL_T[:, ::1] X, np.intp_t[::1] frames, REAL_T[::1] y,
+        DIST_T[::1] distances, LABEL_T[::1] assignments, long label):
+
+    cdef long n_frames = frames.shape[0]
+    cdef long n_features = X.shape[1]
+    assert y.shape[0] == n_features
+
+    cdef long f, i, j
+    cdef double d
+    cdef REAL_T t
+
+    # each frame appears once, so no two threads write the same element.
+    for f in prange(n_frames, nogil=True):
+        i = frames[f]
+        d = 0
+        for j in range(n_features):
+            t = X[i, j] - y[j]
+            d = d + t * t
+        d = sqrt(d)
+
+        if d < distances[i]:
+            distances[i] = <DIST_T>d
+            assignments[i] = <LABEL_T>label
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _update_nearest_rmsd_subset(
+        float[:, :, ::1] X, np.intp_t[::1] frames, float[:, ::1] y,
+        double[::1] x_traces, double y_trace, DIST_T[::1] distances,
+        LABEL_T[::1] assignments, long label):
+
+    cdef long n_frames = frames.shape[0]
+    assert X.shape[1] == y.shape[0]
+
+    cdef long f, i
+    cdef double d
+
+    for f in prange(n_frames, nogil=True):
+        i = frames[f]
+        d = _qcp_rmsd(X, i, y, x_traces[i], y_trace)
+
+        if d < distances[i]:
+            distances[i] = <DIST_T>d
+            assignments[i] = <LABEL_T>label
+
+
+def update_nearest(X, y, distances, assignments, label, metric='euclidean',
+                   frames=None):
+    """Compute the distance between `y` and each observation in `X` and,
+    in place, reassign to `label` every observation that is closer to
+    `y` than to its current assignment. Uses thread-parallelism with
+    OpenMP.
+
+    This fuses the distance computation, the comparison against
+    `distances`, both updates and the search for the new farthest
+    observation into a single pass over the data, and allocates nothing
+    proportional to the number of observations.
+
+    Parameters
+    ----------
+    X : array, shape=(n_samples, n_features), or PreparedCoordinates
+        The observations to update. Must be a float32 or float64 array
+        for 'euclidean' and PreparedCoordinates for 'rmsd'.
+    y : array, shape=(n_features,), or frame
+        The new center.
+    distances : array, shape=(n_samples,)
+        The distance from each observation to its current assignment.
+        May be float32 (to halve its memory footprint) or float64.
+    assignments : array, shape=(n_samples,)
+        The current assignment of each observation. May be int32 or
+        int64.
+    label : int
+        The label to assign to observations that are closer to `y`.
+    metric : {'euclidean', 'rmsd'}, default='euclidean'
+        The distance metric. The functions `euclidean` and `rmsd` are
+        also accepted.
+    frames : array, shape=(n_frames,), default=None
+        If provided, only these observations (which must be distinct)
+        are compared to `y`; the rest are left as they are. They're
+        read in place, rather than copied.
+
+    Returns
+    -------
+    argmax : int
+        The index of the observation farthest from its assigned center
+        after the update (the first such index, as `np.argmax`).
+    max : float
+        The distance from that observation to its assigned center.
+    """
+
+    if metric is euclidean:
+        metric = 'euclidean'
+    elif metric is rmsd:
+        metric = 'rmsd'
+
+    if metric == 'euclidean':
+        X = np.asarray(X)
+        _check_is_2d(X)
+        if X.dtype not in (np.float32, np.float64):
+            X = X.astype(np.float64)
+        X = np.require(X, requirements='C')
+        y = np.require(y, dtype=X.dtype, requirements='C')
+        _check_is_1d(y)
+        if X.shape[1] != y.shape[0]:
+            raise exception.DataInvalid(
+                ("Target data point dimension (%s) must match data "
+                 "array dimension (%s)") % (y.shape[0], X.shape[1]))
+    elif metric == 'rmsd':
+        if not isinstance(X, PreparedCoordinates):
+            raise exception.DataInvalid(
+                "In-place RMSD updates require PreparedCoordinates, got "
+                "'%s'." % type(X).__name__)
+        y_xyz, y_trace = _as_single_frame(y)
+        if X.n_atoms != y_xyz.shape[0]:
+            raise exception.DataInvalid(
+                ("Target frame atom count (%s) must match data array atom "
+                 "count (%s)") % (y_xyz.shape[0], X.n_atoms))
+    else:
+        raise exception.DataInvalid(
+            "In-place updates support only 'euclidean' and 'rmsd', got "
+            "'%s'." % metric)
+
+    n_samples = len(X)
+    for name, arr, dtypes in [('Distance', distances,
+                               (np.float32, np.float64)),
+                              ('Assignment', assignments,
+                               (np.int32, np.int64))]:
+        if arr.dtype not in dtypes:
+            raise exception.DataInvalid(
+                "%s array must be one of %s, got '%s'." %
+                (name, [np.dtype(d).name for d in dtypes], arr.dtype))
+        if arr.shape != (n_samples,) or not arr.flags.c_contiguous:
+            raise exception.DataInvalid(
+                ("%s array must be contiguous with shape (%s,), got "
+                 "shape %s.") % (name, n_samples, arr.shape))
+
+    if n_samples == 0:
+        return 0, -np.inf
+
+    if frames is not None:
+        frames = _check_frames(frames, n_samples)
+        if metric == 'euclidean':
+            _update_nearest_euclidean_subset(
+                X, frames, y, distances, assignments, label)
+        else:
+            _update_nearest_rmsd_subset(
+                X.xyz, frames, y_xyz, X.traces, y_trace, distances,
+                assignments, label)
+
+        i = np.argmax(distances)
+        return int(i), float(distances[i])
+
+    n_chunks = (n_samples + UPDATE_CHUNK_SIZE - 1) // UPDATE_CHUNK_SIZE
+    chunk_max = np.empty(n_chunks, dtype=np.float64)
+    chunk_argmax = np.empty(n_chunks, dtype=np.intp)
+
+    if metric == 'euclidean':
+        _update_nearest_euclidean(
+            X, y, distances, assignments, label, chunk_max, chunk_argmax)
+    else:
+        _update_nearest_rmsd(
+            X.xyz, y_xyz, X.traces, y_trace, distances, assignments,
+            label, chunk_max, chunk_argmax)
+
+    c = np.argmax(chunk_max)
+    return int(chunk_argmax[c]), chunk_max[c]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _euclidean_matrix(REAL_T[:, ::1] X, REAL_T[:, ::1] Y, double[:, ::1] out):
+
+    cdef long n_samples = X.shape[0]
+    cdef long n_targets = Y.shape[0]
+    cdef long n_features = X.shape[1]
+    assert Y.shape[1] == n_features
+    assert out.shape[0] == n_targets
+    assert out.shape[1] == n_samples
+
+    cdef long i, j, k
+    cdef double d
+
+    # squares are taken at the data's precision, as in `_euclidean`, so
+    # that each row is bitwise identical to the one-to-many distance.
+    cdef REAL_T t
+
+    for i in prange(n_samples, nogil=True):
+        for k in range(n_targets):
+            d = 0
+            for j in range(n_features):
+                t = X[i, j] - Y[k, j]
+                d = d + t * t
+            out[k, i] = sqrt(d)
+
+    return out
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def _rmsd_matrix(float[:, :, ::1] X, float[:, :, ::1] Y,
+                 double[::1] x_traces, double[::1] y_traces,
+                 double[:, ::1] out):
+
+    cdef long n_samples = X.shape[0]
+    cdef long n_targets = Y.shape[0]
+    assert X.shape[1] == Y.shape[1]
+    assert x_traces.shape[0] == n_samples
+    assert y_traces.shape[0] == n_targets
+    assert out.shape[0] == n_targets
+    assert out.shape[1] == n_samples
+
+    cdef long i, k
+
+    for i in prange(n_samples, nogil=True):
+        for k in range(n_targets):
+            out[k, i] = _qcp_rmsd(X, i, Y[k], x_traces[i], y_traces[k])
+
+    return out
+
+
+def distance_matrix(X, Y, metric='euclidean'):
+    """Compute the distance between every target in `Y` and every
+    observation in `X`. Uses thread-parallelism with OpenMP.
+
+    Each observation in `X` is read once and compared to all of `Y`
+    while it is in cache, so this is much faster than calling the
+    one-to-many distance function once per target when `X` is large.
+    Row `k` of the result is identical to the distance from `Y[k]` to
+    `X`.
+
+    Parameters
+    ----------
+    X : array, shape=(n_samples, n_features), or PreparedCoordinates
+        The observations. Must be an array for 'euclidean'. For 'rmsd',
+        an md.Trajectory or array of shape (n_samples, n_atoms, 3) is
+        also accepted.
+    Y : array, shape=(n_targets, n_features), or PreparedCoordinates
+        The targets, in the same form as `X`.
+    metric : {'euclidean', 'rmsd'}, default='euclidean'
+        The distance metric. The functions `euclidean` and `rmsd` are
+        also accepted.
+
+    Returns
+    -------
+    out : array, shape=(n_targets, n_samples)
+        The distance from each target to each observation.
+    """
+
+    if metric is euclidean:
+        metric = 'euclidean'
+    elif metric is rmsd:
+        metric = 'rmsd'
+
+    if metric == 'euclidean':
+        X = np.asarray(X)
+        Y = np.asarray(Y)
+        _check_is_2d(X)
+        _check_is_2d(Y)
+        if X.shape[1] != Y.shape[1]:
+            raise exception.DataInvalid(
+                ("Target data point dimension (%s) must match data "
+                 "array dimension (%s)") % (Y.shape[1], X.shape[1]))
+        if X.dtype not in (np.float32, np.float64):
+            X = X.astype(np.float64)
+        X = np.require(X, requirements='C')
+        Y = np.require(Y, dtype=X.dtype, requirements='C')
+
+        out = np.zeros((Y.shape[0], X.shape[0]), dtype=np.float64)
+        _euclidean_matrix(X, Y, out)
+    elif metric == 'rmsd':
+        if not isinstance(X, PreparedCoordinates):
+            X = PreparedCoordinates(X)
+        if not isinstance(Y, PreparedCoordinates):
+            Y = PreparedCoordinates(Y)
+        if X.n_atoms != Y.n_atoms:
+            raise exception.DataInvalid(
+                ("Target frame atom count (%s) must match data array atom "
+                 "count (%s)") % (Y.n_atoms, X.n_atoms))
+
+        out = np.zeros((Y.n_frames, X.n_frames), dtype=np.float64)
+        _rmsd_matrix(X.xyz, Y.xyz, X.traces, Y.traces, out)
+    else:
+        raise exception.DataInvalid(
+            "Distance matrices support only 'euclidean' and 'rmsd', got "
+            "'%s'." % metric)
+
+    return out
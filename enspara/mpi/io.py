@@ -1,12 +1,16 @@
+import logging
 
 import numpy as np
 
-from ..util.load import load_as_concatenated
+from ..util.load import (load_as_concatenated, sound_trajectories,
+                         _load_frame_range)
 from .. import exception
 
 from . import MPI_RANK, MPI_SIZE
 from .ops import assemble_striped_array
 
+logger = logging.getLogger(__name__)
+
 
 def load_as_striped(filenames, *args, **kwargs):
     """Load files onto concat arrays across many nodes in an MPI swarm.
@@ -54,3 +58,152 @@ def load_as_striped(filenames, *args, **kwargs):
     global_lengths = assemble_striped_array(local_lengths)
 
     return global_lengths, my_xyz
+
+
+def load_as_balanced(filenames, lengths=None, split=False, processes=None,
+                     **kwargs):
+    """Load files onto concat arrays across many nodes in an MPI swarm,
+    giving each node about the same number of frames.
+
+    Unlike `load_as_striped`, which gives each node the same number of
+    files, the frames are divided according to the trajectories'
+    lengths (see `balanced_layout`), so that a few long trajectories
+    don't leave most nodes waiting on the ones that loaded them.
+
+    Parameters
+    ----------
+    filenames : list
+        A list of relative paths to the trajectory files to be loaded.
+    lengths : list, optional, default=None
+        List of lengths of the underlying trajectories (after striding).
+        If None, the trajectories are sounded, each node sounding a
+        share of them.
+    split : bool, default=False
+        Split trajectories between nodes, so that each gets the same
+        number of frames (to within one), rather than only assigning
+        whole trajectories.
+    processes : int, optional
+        The number of processes to spawn for loading in parallel.
+
+    Additional keyword args (e.g. `top`, `atom_indices`, `stride`) are
+    passed on to `md.load`.
+
+    Returns
+    -------
+    (global_lengths, xyz, layout) : tuple
+       The trajectory lengths (list of ints, frames), this node's
+       coordinates (ndarray, shape=(n_frames, n_atoms, 3)), and the
+       layout of the frames across nodes, which the assembly functions
+       in `mpi.ops` take to put the nodes' frames back in order.
+
+    See also
+    --------
+    load_as_striped, balanced_layout
+    """
+
+    filenames = list(filenames)
+
+    if lengths is None:
+        stride = kwargs.get('stride', 1)
+        local_lengths = np.array(sound_trajectories(
+            filenames[MPI_RANK::MPI_SIZE], stride=stride,
+            processes=processes), dtype=int)
+        lengths = assemble_striped_array(local_lengths)
+    global_lengths = np.array(lengths, dtype=int)
+
+    layout = balanced_layout(global_lengths, MPI_SIZE, split=split)
+    pieces = layout[layout[:, 0] == MPI_RANK]
+
+    logger.debug("Rank %s loading %s frames in %s pieces.", MPI_RANK,
+                 np.sum(pieces[:, 3] - pieces[:, 2]), len(pieces))
+
+    whole = (pieces[:, 2] == 0) & \
+        (pieces[:, 3] == global_lengths[pieces[:, 1]])
+
+    xyz = []
+    if np.any(whole):
+        _, whole_xyz = load_as_concatenated(
+            filenames=[filenames[i] for i in pieces[whole, 1]],
+            lengths=[int(l) for l in global_lengths[pieces[whole, 1]]],
+            processes=processes, **kwargs)
+        xyz.append(whole_xyz)
+
+    for _, file_index, start, stop in pieces[~whole]:
+        xyz.append(_load_frame_range(
+            filenames[file_index], start, stop, **kwargs))
+
+    # layouts list whole files before partial ones, so the pieces were
+    # loaded in order.
+    my_xyz = xyz[0] if len(xyz) == 1 else np.concatenate(xyz)
+
+    return global_lengths, my_xyz, layout
+
+
+def balanced_layout(lengths, n_ranks, split=False):
+    """Divide the frames of trajectories of the given lengths between
+    `n_ranks` nodes, so that each gets about the same number.
+
+    Whole trajectories are assigned greedily, longest first, to the
+    node with the fewest frames so far. If `split`, the concatenated
+    frames are instead cut into `n_ranks` contiguous ranges of equal
+    length (to within one frame), splitting trajectories at the
+    boundaries.
+
+    Parameters
+    ----------
+    lengths : array-like, shape=(n_trajectories,)
+        The length of each trajectory.
+    n_ranks : int
+        The number of nodes.
+    split : bool, default=False
+        Split trajectories between nodes.
+
+    Returns
+    -------
+    layout : np.ndarray, shape=(n_pieces, 4)
+        Rows (rank, trajectory, start, stop), each giving the frames
+        [start, stop) of a trajectory to a node. The rows are ordered by
+        rank, and each node's frames are the concatenation of its
+        pieces in order: first its whole trajectories, in order, then
+        any parts of trajectories.
+    """
+
+    lengths = np.asarray(lengths, dtype=int)
+
+    if not split and len(lengths) < n_ranks:
+        raise exception.ImproperlyConfigured(
+            "To assign whole files to MPI workers, at least 1 file per "
+            "node must be given. MPI size is %s, number of files is %s."
+            % (n_ranks, len(lengths)))
+    if split and np.sum(lengths) < n_ranks:
+        raise exception.ImproperlyConfigured(
+            "To split files between MPI workers, at least 1 frame per "
+            "node must be given. MPI size is %s, number of frames is %s."
+            % (n_ranks, np.sum(lengths)))
+
+    pieces = []
+    if split:
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        bounds = [r * offsets[-1] // n_ranks for r in range(n_ranks + 1)]
+        for rank in range(n_ranks):
+            lo, hi = bounds[rank], bounds[rank+1]
+            # the trajectories ending after lo and starting before hi
+            first = np.searchsorted(offsets[1:], lo, side='right')
+            last = np.searchsorted(offsets[:-1], hi, side='left')
+            for i in range(first, last):
+                start, stop = max(lo, offsets[i]), min(hi, offsets[i+1])
+                if start < stop:
+                    pieces.append(
+                        (rank, i, start - offsets[i], stop - offsets[i]))
+    else:
+        loads = np.zeros(n_ranks, dtype=int)
+        owners = np.zeros(len(lengths), dtype=int)
+        for i in np.argsort(-lengths, kind='mergesort'):
+            owners[i] = np.argmin(loads)
+            loads[owners[i]] += lengths[i]
+        pieces = [(owners[i], i, 0, lengths[i]) for i in range(len(lengths))]
+
+    layout = np.array(pieces, dtype=int).reshape(-1, 4)
+    partial = (layout[:, 2] != 0) | (layout[:, 3] != lengths[layout[:, 1]])
+
+    return layout[np.lexsort((layout[:, 1], partial, layout[:, 0]))]
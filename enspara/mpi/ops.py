@@ -4,7 +4,6 @@ import numpy as np
 from sklearn.utils import check_random_state
 
 from ..exception import ImproperlyConfigured, DataInvalid
-from ..util import array as ra
 
 from . import MPI, MPI_RANK, MPI_SIZE
 
@@ -12,7 +11,7 @@ COMM = MPI.COMM_WORLD
 logger = logging.getLogger(__name__)
 
 
-def convert_local_indices(local_ctr_inds, global_lengths):
+def convert_local_indices(local_ctr_inds, global_lengths, layout=None):
     """Convert indices from (rank, local_frame) to (global frame).
 
     In enspara's clustering code, we represent frames in the data set by
@@ -27,20 +26,27 @@ def convert_local_indices(local_ctr_inds, global_lengths):
     global_lengths : np.ndarray
         Array of the length of each trajectory distributed across all
         the nodes.
+    layout : np.ndarray, shape=(n_pieces, 4), default=None
+        The layout of the frames across nodes, as returned by
+        `mpi.io.load_as_balanced`. If None, trajectories are assumed to
+        be striped across nodes, as by `mpi.io.load_as_striped`.
     """
 
-    global_indexing = np.arange(np.sum(global_lengths))
-    file_origin_ra = ra.RaggedArray(global_indexing, lengths=global_lengths)
+    if layout is None:
+        layout = striped_layout(global_lengths)
 
+    rank_indices = {}
     ctr_inds = []
     for rank, local_fid in local_ctr_inds:
-        global_fid = file_origin_ra[rank::MPI_SIZE].flatten()[local_fid]
-        ctr_inds.append(global_fid)
+        if rank not in rank_indices:
+            rank_indices[rank] = layout_global_indices(
+                layout, global_lengths, rank)
+        ctr_inds.append(rank_indices[rank][local_fid])
 
     return ctr_inds
 
 
-def assemble_striped_array(local_arr):
+def assemble_striped_array(local_arr, root=None):
     """Assemble an striped array.
 
     By 'striped array', we mean an array that has element i on node
@@ -52,30 +58,86 @@ def assemble_striped_array(local_arr):
     ----------
     local_array: np.ndarray
         The array to spread across nodes.
+    root : int, default=None
+        If given, assemble the array only on this node.
 
     Returns
     -------
     global_array: np.ndarray
-        Full array that is striped across all nodes.
+        Full array that is striped across all nodes, or None on nodes
+        other than `root`.
     """
 
-    total_dim1 = COMM.allreduce(len(local_arr), op=MPI.SUM)
-    total_shape = (total_dim1,) + local_arr.shape[1:]
+    local_arr = np.asarray(local_arr)
 
     if not np.all(local_arr > 0):
         raise ImproperlyConfigured("On rank %s, a length <= 0 was found. Lengths must be strictly greater than zero." % MPI_RANK)
 
-    global_lengths = np.zeros(total_shape, dtype=local_arr.dtype) - 1
+    gathered, counts = _gatherv(local_arr, root=root)
+    if gathered is None:
+        return None
 
-    for i in range(MPI_SIZE):
-        global_lengths[i::MPI_SIZE] = COMM.bcast(local_arr, root=i)
+    # the gathered array holds each node's elements in turn, and node
+    # i's elements belong at i, i+n, i+2n, ...
+    positions = np.concatenate(
+        [np.arange(rank, np.sum(counts), MPI_SIZE)[:count]
+         for rank, count in enumerate(counts)])
 
-    assert np.all(global_lengths > 0), global_lengths
+    global_arr = np.empty_like(gathered)
+    global_arr[positions] = gathered
 
-    return global_lengths
+    assert np.all(global_arr > 0), global_arr
 
+    return global_arr
 
-def assemble_striped_ragged_array(local_array, global_lengths):
+
+def striped_layout(global_lengths, n_ranks=None):
+    """The layout (as from `mpi.io.balanced_layout`) of trajectories
+    striped across nodes, with trajectory i on node i % n.
+    """
+
+    if n_ranks is None:
+        n_ranks = MPI_SIZE
+
+    layout = np.array(
+        [(i % n_ranks, i, 0, length)
+         for i, length in enumerate(global_lengths)],
+        dtype=int).reshape(-1, 4)
+
+    return layout[np.lexsort((layout[:, 1], layout[:, 0]))]
+
+
+def layout_global_indices(layout, global_lengths, rank):
+    """The global frame index of each of `rank`'s local frames, given
+    the `layout` of frames across nodes (see `mpi.io.balanced_layout`).
+
+    Parameters
+    ----------
+    layout : np.ndarray, shape=(n_pieces, 4)
+        Rows (rank, trajectory, start, stop), in each node's local
+        order.
+    global_lengths : np.ndarray
+        Array of the length of each trajectory.
+    rank : int
+        The node to find the global indices of the frames of.
+
+    Returns
+    -------
+    global_indices : np.ndarray, shape=(n_local_frames,)
+        The global index of each of the node's local frames.
+    """
+
+    offsets = np.concatenate([[0], np.cumsum(global_lengths)])
+    pieces = layout[layout[:, 0] == rank]
+
+    return np.concatenate(
+        [np.zeros(0, dtype=int)] +
+        [np.arange(offsets[i] + start, offsets[i] + stop)
+         for _, i, start, stop in pieces])
+
+
+def assemble_striped_ragged_array(local_array, global_lengths, layout=None,
+                                  root=None):
     """Assemble an array that is striped according to the first dim of a ragged array.
 
     This is relevant because, unlike a regular striped array, the
@@ -92,28 +154,99 @@ def assemble_striped_ragged_array(local_array, global_lengths):
     global_lengths: np.ndarray
         Lengths for each row of the RA. The ultimate assembled RA will
         have this as it's lengths attribute.
+    layout : np.ndarray, shape=(n_pieces, 4), default=None
+        The layout of the frames across nodes, as returned by
+        `mpi.io.load_as_balanced`. If None, rows are assumed to be
+        striped across nodes.
+    root : int, default=None
+        If given, assemble the array only on this node (e.g. when only
+        it will write the array out).
 
     Returns
     -------
     global_ra: np.ndarray
-        Full array that is striped across all nodes.
+        Full array that is striped across all nodes, or None on nodes
+        other than `root`. Integer arrays are assembled as int, and
+        any others as float.
     """
 
     assert np.issubdtype(type(global_lengths[0]), np.integer)
 
-    global_array = np.zeros(shape=(np.sum(global_lengths),)) - 1
-    global_ra = ra.RaggedArray(global_array, lengths=global_lengths)
+    if layout is None:
+        layout = striped_layout(global_lengths)
 
-    for rank in range(MPI_SIZE):
-        rank_array = COMM.bcast(local_array, root=rank)
-        rank_ra = ra.RaggedArray(
-            rank_array, lengths=global_lengths[rank::MPI_SIZE])
+    local_array = np.asarray(local_array)
+    if np.issubdtype(local_array.dtype, np.integer):
+        local_array = local_array.astype(int, copy=False)
+    else:
+        local_array = local_array.astype(float, copy=False)
+
+    gathered, _ = _gatherv(local_array, root=root)
+    if gathered is None:
+        return None
+
+    positions = np.concatenate(
+        [layout_global_indices(layout, global_lengths, rank)
+         for rank in range(MPI_SIZE)])
 
-        global_ra[rank::MPI_SIZE] = rank_ra
+    if len(positions) != np.sum(global_lengths):
+        raise DataInvalid(
+            "Nodes held %s frames, but the trajectories have %s." %
+            (len(positions), np.sum(global_lengths)))
+
+    global_array = np.empty_like(gathered)
+    global_array[positions] = gathered
 
-    assert np.all(global_ra._data) >= 0
+    return global_array
 
-    return global_ra._data
+
+def _gatherv(local_array, root=None):
+    """Concatenate each node's `local_array` along the first axis, in
+    order of rank, with a single buffer-based collective.
+
+    Parameters
+    ----------
+    local_array : np.ndarray
+        This node's part of the array. Arrays on all nodes must have
+        the same shape beyond the first axis.
+    root : int, default=None
+        If given, gather only onto this node (with `Gatherv`), rather
+        than onto every node (with `Allgatherv`).
+
+    Returns
+    -------
+    gathered : np.ndarray
+        The concatenated array, or None on nodes other than `root`.
+    counts : np.ndarray
+        The length of each node's part, or None on nodes other than
+        `root`.
+    """
+
+    # only the lengths and dtypes are exchanged as python objects; a
+    # node with no elements may have made an array of another dtype.
+    meta = COMM.allgather((len(local_array), local_array.dtype.str))
+    counts = np.array([n for n, _ in meta], dtype=int)
+    dtype = np.result_type(*[np.dtype(d) for n, d in meta if n > 0] or
+                           [local_array.dtype])
+
+    local_array = np.ascontiguousarray(local_array, dtype=dtype)
+    row_size = int(np.prod(local_array.shape[1:]))
+
+    if root is not None and root != MPI_RANK:
+        COMM.Gatherv(local_array, None, root=root)
+        return None, None
+
+    gathered = np.empty((np.sum(counts),) + local_array.shape[1:],
+                        dtype=dtype)
+    sizes = counts * row_size
+    recv = [gathered, (sizes, np.concatenate([[0], np.cumsum(sizes)[:-1]]))]
+
+    if root is None:
+        COMM.Allgatherv(local_array, recv)
+    else:
+        COMM.Gatherv(local_array, recv, root=root)
+
+    return gathered, counts
 
 
 def mean(local_array):
@@ -135,6 +268,57 @@ def mean(local_array):
     return global_sum / global_len
 
 
+_MAXLOC_DTYPE = np.dtype([('value', np.float64), ('loc', np.int32)],
+                         align=True)
+
+
+def maxloc(local_value, local_index, n_local_max):
+    """Find the largest of each node's `local_value`, and where it is,
+    with a single `Allreduce(MAXLOC)`.
+
+    Parameters
+    ----------
+    local_value : float
+        This node's value (e.g. its largest distance).
+    local_index : int
+        Where the value is on this node (e.g. the index of that
+        distance in its local array).
+    n_local_max : int
+        An upper bound on `local_index` on every node (e.g. the length
+        of the longest local array), used to encode the rank and index
+        as one integer.
+
+    Returns
+    -------
+    value : float
+        The largest value. Ties go to the lowest rank.
+    owner_rank : int
+        The rank of the node with the largest value.
+    index : int
+        `local_index` on that node.
+    """
+
+    n_local_max = max(int(n_local_max), 1)
+
+    # MPI's (double, int) pairs only hold a C int, so the location is
+    # encoded as rank * n_local_max + index when that fits, and the
+    # pair is otherwise reduced as a python object.
+    if MPI_SIZE * n_local_max <= np.iinfo(np.int32).max:
+        send = np.array([(local_value, MPI_RANK * n_local_max +
+                          local_index)], dtype=_MAXLOC_DTYPE)
+        recv = np.empty_like(send)
+        COMM.Allreduce([send, MPI.DOUBLE_INT], [recv, MPI.DOUBLE_INT],
+                       op=MPI.MAXLOC)
+        value, loc = recv[0]
+        owner_rank, index = divmod(int(loc), n_local_max)
+    else:
+        value, (owner_rank, index) = COMM.allreduce(
+            (float(local_value), (MPI_RANK, int(local_index))),
+            op=MPI.MAXLOC)
+
+    return float(value), owner_rank, index
+
+
 def distribute_frame(data, world_index, owner_rank):
     """Distribute an element of an array to every node in an MPI swarm.
 
@@ -206,7 +390,8 @@ def randind(local_array, random_state=None):
     n_states = np.array(COMM.allgather(len(local_array)))
     assert np.all(n_states >= 0)
 
-    if sum(n_states) < 1:
+    total = int(np.sum(n_states))
+    if total < 1:
         raise DataInvalid(
             "Random choice requires a non-empty array. Got shapes: %s" %
             n_states)
@@ -215,26 +400,137 @@ def randind(local_array, random_state=None):
     if MPI_RANK == 0:
         # this is modeled after numpy.random.choice, but for some reason
         # our formulation here gives the samer results.
-        global_index = random_state.randint(sum(n_states))
+        global_index = random_state.randint(total)
     else:
         global_index = None
 
     global_index = MPI.COMM_WORLD.bcast(global_index, root=0)
 
+    # global_index is taken to be element global_index // MPI_SIZE of
+    # stripe global_index % MPI_SIZE, and the stripes are concatenated
+    # and then divided between the nodes by their lengths. This is the
+    # same as finding global_index % MPI_SIZE and global_index //
+    # MPI_SIZE iff our data are 'packed' on nodes, but not otherwise.
+    stripe_lengths = [len(range(r, total, MPI_SIZE)) for r in range(MPI_SIZE)]
+    stripe = global_index % MPI_SIZE
+    position = sum(stripe_lengths[:stripe]) + global_index // MPI_SIZE
 
-    # this computation is the same as finding global_index % MPI_SIZE and
-    # global_index // MPI_SIZE iff our data are 'packed' on nodes, but not
-    # otherwise.
-
-    a = ra.RaggedArray(
-        np.concatenate([
-            np.arange(sum(n_states))[r::MPI_SIZE]
-            for r in range(MPI_SIZE)]),
-        lengths=n_states)
-
-    owner_rank, local_index = ra.where(a == global_index)
-    owner_rank, local_index = owner_rank[0], local_index[0]
+    ends = np.cumsum(n_states)
+    owner_rank = int(np.searchsorted(ends, position, side='right'))
+    local_index = int(position - (ends[owner_rank] - n_states[owner_rank]))
 
     assert local_index >= 0
 
     return (owner_rank, local_index)
+
+
+def randinds(local_arrays, random_state=None):
+    """Given the local fragments of several assumed-larger arrays, give
+    the location of a randomly chosen element of each (uniformly
+    distributed).
+
+    This is a batched `randind`, which uses a fixed number of
+    collectives regardless of the number of arrays.
+
+    Parameters
+    ----------
+    local_arrays : list of ndarray
+        Arrays that are each striped across multiple nodes in an MPI
+        swarm.
+    random_state : int or np.RandomState
+        State of the RNG to use for the randomized part of the choice.
+
+    Returns
+    -------
+    locations : list, [(owner_rank, local_index), ...]
+        For each array, the rank of the node that owns the element
+        that's chosen and its index within that node's local array.
+    """
+
+    random_state = check_random_state(random_state)
+
+    # n_states[r, i] is the length of array i on rank r
+    n_states = np.array(COMM.allgather([len(a) for a in local_arrays]),
+                        dtype=int).reshape(MPI_SIZE, len(local_arrays))
+    totals = n_states.sum(axis=0)
+
+    if np.any(totals < 1):
+        raise DataInvalid(
+            "Random choice requires non-empty arrays. Got shapes: %s" %
+            n_states.T.tolist())
+
+    if MPI_RANK == 0:
+        global_inds = [random_state.randint(t) for t in totals]
+    else:
+        global_inds = None
+    global_inds = COMM.bcast(global_inds, root=0)
+
+    # each array is indexed as the concatenation of its fragments in
+    # rank order.
+    ends = np.cumsum(n_states, axis=0)
+
+    locations = []
+    for i, global_index in enumerate(global_inds):
+        owner_rank = int(np.searchsorted(ends[:, i], global_index,
+                                         side='right'))
+        local_index = global_index - (ends[owner_rank, i] -
+                                      n_states[owner_rank, i])
+        locations.append((owner_rank, int(local_index)))
+
+    return locations
+
+
+def distribute_frames(data, world_indices, owner_ranks):
+    """Distribute several elements of an array, each owned by some
+    node, to every node in an MPI swarm with a single collective.
+
+    Parameters
+    ----------
+    data : array-like or md.Trajectory
+        Data array with frames to distribute. The frames will be taken
+        from axis 0 of the input.
+    world_indices : list
+        Position of each target frame in `data` on the node that owns
+        it. Entries for frames owned by other nodes are ignored, and
+        may be None.
+    owner_ranks : list
+        Rank of the node that owns each frame.
+
+    Returns
+    -------
+    frames : list
+        The frames, each a single slice of `data` as returned by
+        `distribute_frame`.
+    world_indices : list
+        The position of each frame on the node that owns it.
+    """
+
+    for owner_rank in owner_ranks:
+        if owner_rank >= MPI_SIZE:
+            raise ImproperlyConfigured(
+                'In MPI swarm of size %s, recieved owner rank == %s.' %
+                (MPI_SIZE, owner_rank))
+
+    mine = {}
+    for i, (owner_rank, world_index) in enumerate(
+            zip(owner_ranks, world_indices)):
+        if owner_rank == MPI_RANK:
+            frame = data[world_index]
+            if hasattr(frame, 'xyz'):
+                frame = frame.xyz
+            mine[i] = (int(world_index), frame)
+
+    gathered = {}
+    for rank_frames in COMM.allgather(mine):
+        gathered.update(rank_frames)
+
+    frames = []
+    for i in range(len(owner_ranks)):
+        if hasattr(data, 'xyz'):
+            wrapped_data = data[0]
+            wrapped_data.xyz = gathered[i][1]
+            frames.append(wrapped_data)
+        else:
+            frames.append(gathered[i][1])
+
+    return frames, [gathered[i][0] for i in range(len(owner_ranks))]
@@ -19,6 +19,7 @@ from numpy.testing import assert_array_equal, assert_allclose
 
 from ..cluster.hybrid import KHybrid, hybrid
 from ..cluster import kcenters, kmedoids, util
+from ..geometry import libdist
 from ..exception import DataInvalid, ImproperlyConfigured
 
 
@@ -174,9 +175,9 @@ class TestTrajClustering(unittest.TestCase):
         # this is simlar to asserting the distribution of distances.
         # since KCenters is deterministic, this shouldn't ever change?
         self.assertAlmostEqual(np.average(result.distances),
-                               0.074690734158752686)
+                               0.07468969702497522)
         self.assertAlmostEqual(np.std(result.distances),
-                               0.018754008455304401)
+                               0.018758146036452795)
 
     def test_kcenters_nclust(self):
         N_CLUSTERS = 3
@@ -198,6 +199,43 @@ class TestTrajClustering(unittest.TestCase):
         self.assertAlmostEqual(np.std(result.distances),
                                0.018355072790569946)
 
+    def test_kcenters_triangle_inequality(self):
+        N_CLUSTERS = 20
+
+        # md.rmsd isn't bitwise reproducible between calls, so compare
+        # exactly using a euclidean metric over the same coordinates.
+        X = self.trj.xyz.reshape(len(self.trj), -1)
+
+        r = kcenters.kcenters(X, 'euclidean', n_clusters=N_CLUSTERS)
+        pruned = kcenters.kcenters(
+            X, 'euclidean', n_clusters=N_CLUSTERS,
+            use_triangle_inequality=True)
+
+        assert_array_equal(r.center_indices, pruned.center_indices)
+        assert_array_equal(r.assignments, pruned.assignments)
+        assert_array_equal(r.distances, pruned.distances)
+
+        r = kcenters.kcenters(self.trj, md.rmsd, n_clusters=N_CLUSTERS)
+        pruned = kcenters.kcenters(
+            self.trj, md.rmsd, n_clusters=N_CLUSTERS,
+            use_triangle_inequality=True)
+
+        assert_array_equal(r.center_indices, pruned.center_indices)
+        assert_array_equal(r.assignments, pruned.assignments)
+        assert_allclose(r.distances, pruned.distances, atol=1e-6)
+
+        # prepared coordinates are updated in place, pruned or not
+        P = libdist.PreparedCoordinates(self.trj)
+        r = kcenters.kcenters(P, libdist.rmsd, n_clusters=N_CLUSTERS)
+        pruned = kcenters.kcenters(
+            P, libdist.rmsd, n_clusters=N_CLUSTERS,
+            use_triangle_inequality=True)
+
+        assert_array_equal(r.center_indices, pruned.center_indices)
+        assert_array_equal(r.assignments, pruned.assignments)
+        assert_array_equal(r.distances, pruned.distances)
+
+
 @attr('mpi')
 def test_kcenters_mpi_traj():
     from ..mpi import MPI
@@ -236,6 +274,35 @@ def test_kcenters_mpi_traj():
         assert_array_equal(mpi_ctr_inds, r.center_indices)
 
 
+@attr('mpi')
+def test_kcenters_mpi_history():
+    from ..mpi import MPI
+    MPI_RANK = MPI.COMM_WORLD.Get_rank()
+    MPI_SIZE = MPI.COMM_WORLD.Get_size()
+
+    trj = md.load(get_fn('frame0.h5')).xyz[:, :, 0].copy()
+    data = trj[MPI_RANK::MPI_SIZE]
+
+    radii = [0.5, 0.8, 0.3]
+    history = kcenters.KCentersHistory(cluster_radii=radii)
+    kcenters.kcenters_mpi(
+        data, 'euclidean', dist_cutoff=min(radii), history=history)
+
+    for r in radii:
+        ctr_inds, assigs, dists = history.clustering(cluster_radius=r)
+        expect_d, expect_a, expect_ctr_inds = kcenters.kcenters_mpi(
+            data, 'euclidean', dist_cutoff=r)
+
+        assert_array_equal(ctr_inds, expect_ctr_inds)
+        assert_array_equal(assigs, expect_a)
+        assert_array_equal(dists, expect_d)
+
+    assert_equal(len(history.max_distances), len(history.center_indices))
+    assert_equal(
+        history.max_distances[-1],
+        MPI.COMM_WORLD.allreduce(np.max(dists), op=MPI.MAX))
+
+
 @attr('mpi')
 def test_kcenters_mpi_numpy():
     from ..mpi import MPI
@@ -457,6 +524,217 @@ def test_kmedoids_pam_update_mdtraj():
     assert_allclose(dists, expect_dists, atol=1e-6)
 
 
+def test_kmedoids_segment_max():
+
+    rs = np.random.RandomState(0)
+
+    for n in [1, 2, 7, 64, 100]:
+        values = rs.uniform(size=n)
+        tree = kmedoids._SegmentMax(values)
+        assert_equal(tree.max(), values.max())
+
+        for i in range(20):
+            frames = rs.choice(n, size=rs.randint(0, n+1), replace=False)
+            new_values = rs.uniform(size=len(frames))
+
+            new_max, updates = tree.propose(frames, new_values)
+            if i % 2:
+                tree.commit(updates)
+                values[frames] = new_values
+                assert_equal(new_max, values.max())
+            else:
+                expected = values.copy()
+                expected[frames] = new_values
+                assert_equal(new_max, expected.max())
+                assert_equal(tree.max(), values.max())
+
+
+def test_kmedoids_pam_update_running_costs():
+
+    means = [(0, 0), (0, 10), (10, 0)]
+    X, y = make_blobs(centers=means, random_state=0)
+
+    r = kcenters.kcenters(X, 'euclidean', n_clusters=3)
+    orig_assig, orig_dists = r.assignments.copy(), r.distances.copy()
+
+    # the incremental costs accept the same proposals as computing each
+    # cost over all the distances.
+    for cost in [kmedoids._msq, np.max]:
+        ind, dists, assig = kmedoids._kmedoids_pam_update(
+            X, util.euclidean, list(r.center_indices), r.assignments,
+            r.distances, cost=cost, random_state=0)
+        expect_ind, expect_dists, expect_assig = \
+            kmedoids._kmedoids_pam_update(
+                X, util.euclidean, list(r.center_indices), r.assignments,
+                r.distances, cost=lambda d: cost(d), random_state=0)
+
+        assert_array_equal(ind, expect_ind)
+        assert_array_equal(assig, expect_assig)
+        assert_array_equal(dists, expect_dists)
+
+    # the update doesn't modify its inputs
+    assert_array_equal(r.assignments, orig_assig)
+    assert_array_equal(r.distances, orig_dists)
+
+
+def test_kmedoids_pam_update_batched():
+
+    means = [(0, 0), (0, 10), (10, 0), (10, 10), (5, 5)]
+    X, y = make_blobs(centers=means, random_state=0, n_samples=300)
+
+    r = kcenters.kcenters(X, 'euclidean', n_clusters=20)
+
+    for cost in [kmedoids._msq, np.max]:
+        for batch_size in [1, 4, 20]:
+            ind, dists, assig = kmedoids._kmedoids_pam_update(
+                X, util.euclidean, list(r.center_indices), r.assignments,
+                r.distances, cost=cost, random_state=0,
+                batch_size=batch_size)
+
+            # accepting proposals in batches leaves every frame assigned
+            # to its nearest medoid.
+            expect_assig, expect_dists = util.assign_to_nearest_center(
+                X, X[ind], util.euclidean)
+            assert_array_equal(assig, expect_assig)
+            assert_allclose(dists, expect_dists)
+            assert_true(cost(dists) <= cost(r.distances))
+
+    # with one proposal per batch, the sweep is the sequential one.
+    proposals = [np.where(r.assignments == i)[0][-1] for i in range(20)]
+    expect = kmedoids._kmedoids_pam_update(
+        X, util.euclidean, list(r.center_indices), r.assignments,
+        r.distances, proposals=proposals)
+    result = kmedoids._kmedoids_pam_update(
+        X, util.euclidean, list(r.center_indices), r.assignments,
+        r.distances, proposals=proposals, batch_size=1)
+
+    for a, b in zip(expect, result):
+        assert_array_equal(a, b)
+
+
+@attr('mpi')
+def test_kmedoids_pam_update_bounds():
+
+    X, _ = make_blobs(n_samples=600, n_features=2, centers=6,
+                      random_state=0)
+    result = kcenters.kcenters(X, 'euclidean', n_clusters=12)
+
+    for batch_size in [None, 4]:
+        expected = result.center_indices, result.distances, \
+            result.assignments
+        bounds = util.AssignmentBounds(result.assignments, result.distances)
+        updated = expected
+
+        for i in range(3):
+            expected = kmedoids._kmedoids_pam_update(
+                X, libdist.euclidean, list(expected[0]), expected[2],
+                expected[1], cost=np.max,
+                random_state=np.random.RandomState(i), batch_size=batch_size)
+            updated = kmedoids._kmedoids_pam_update(
+                X, libdist.euclidean, list(updated[0]), updated[2],
+                updated[1], cost=np.max,
+                random_state=np.random.RandomState(i), batch_size=batch_size,
+                bounds=bounds)
+
+            assert_array_equal(updated[0], expected[0])
+            assert_array_equal(updated[2], expected[2])
+            assert_allclose(updated[1], expected[1])
+
+        # the bounds are valid for the final medoids
+        _, _, second = util._nearest_two_centers(
+            X, X[updated[0]], libdist.euclidean)
+        assert_array_equal(bounds.assignments, updated[2])
+        assert_true(np.all(bounds.lower <= second + 1e-8))
+        assert_true(np.any(bounds.lower > 0))
+
+
+def test_kmedoids_pam_update_bounds_rmsd():
+
+    # the bounds often leave no frame of a cluster to search, which
+    # libdist.rmsd can't be called on.
+    trj = md.load(get_fn('frame0.h5'))[:200]
+    result = kcenters.kcenters(trj, 'rmsd', dist_cutoff=0.05)
+
+    expected = result.center_indices, result.distances, result.assignments
+    bounds = util.AssignmentBounds(result.assignments, result.distances)
+    updated = expected
+
+    for i in range(2):
+        expected = kmedoids._kmedoids_pam_update(
+            trj, libdist.rmsd, list(expected[0]), expected[2],
+            expected[1], cost=np.max, random_state=np.random.RandomState(i))
+        updated = kmedoids._kmedoids_pam_update(
+            trj, libdist.rmsd, list(updated[0]), updated[2],
+            updated[1], cost=np.max, random_state=np.random.RandomState(i),
+            bounds=bounds)
+
+        assert_array_equal(updated[0], expected[0])
+        assert_array_equal(updated[2], expected[2])
+        assert_allclose(updated[1], expected[1], atol=1e-5)
+
+
+def test_hybrid_distance_cache():
+
+    X, _ = make_blobs(n_samples=600, n_features=2, centers=6,
+                      random_state=0)
+
+    n_computed = []
+
+    def metric(X, y):
+        n_computed.append(len(X))
+        return np.sqrt(np.sum((X - y)**2, axis=1))
+
+    for batch_size in [None, 4]:
+        del n_computed[:]
+        expected = hybrid(X, metric, n_clusters=10, n_iters=3,
+                          random_state=np.random.RandomState(0),
+                          batch_size=batch_size)
+        n_uncached = sum(n_computed)
+
+        del n_computed[:]
+        cache = util.DistanceCache(10 * X.shape[0] * 8)
+        result = hybrid(X, metric, n_clusters=10, n_iters=3,
+                        random_state=np.random.RandomState(0),
+                        batch_size=batch_size, distance_cache=cache)
+
+        assert_array_equal(result.center_indices, expected.center_indices)
+        assert_array_equal(result.assignments, expected.assignments)
+        assert_allclose(result.distances, expected.distances)
+
+        assert_less(sum(n_computed), n_uncached)
+        assert_true(cache.hits > 0)
+        assert_equal(sorted(cache._entries), sorted(result.center_indices))
+
+
+def test_kmedoids_update_mpi_batched():
+    from ..mpi import MPI_RANK, MPI_SIZE
+
+    means = [(0, 0), (0, 10), (10, 0), (10, 10), (5, 5)]
+    X, y = make_blobs(centers=means, random_state=0, n_samples=300)
+
+    data = X[MPI_RANK::MPI_SIZE]
+
+    local_dists, local_assigs, local_ctr_inds = kcenters.kcenters_mpi(
+        data, util.euclidean, n_clusters=20)
+
+    local_ctr_inds, local_dists, local_assigs = \
+        kmedoids._kmedoids_pam_update(
+            X=data, metric=util.euclidean,
+            medoid_inds=local_ctr_inds,
+            assignments=local_assigs,
+            distances=local_dists,
+            random_state=0,
+            batch_size=8)
+
+    mpi_ctr_inds = [(i*MPI_SIZE)+r for r, i in local_ctr_inds]
+
+    true_assigs, true_dists = util.assign_to_nearest_center(
+        X, X[mpi_ctr_inds], util.euclidean)
+
+    assert_array_equal(local_assigs, true_assigs[MPI_RANK::MPI_SIZE])
+    assert_allclose(local_dists, true_dists[MPI_RANK::MPI_SIZE])
+
+
 class TestNumpyClustering(unittest.TestCase):
 
     generators = [(1, 1), (10, 10), (0, 20)]
@@ -539,6 +817,149 @@ class TestNumpyClustering(unittest.TestCase):
         # should actually be a frame
         assert_equal(len(np.where(clust.result_.distances == 0)), 1)
 
+    def test_kcenters_triangle_inequality_hot_start(self):
+
+        X = np.concatenate(self.traj_lst)
+        init_centers = np.array(self.generators[0:2], dtype=float)
+
+        r = kcenters.kcenters(
+            X, 'euclidean', dist_cutoff=1, init_centers=init_centers)
+        pruned = kcenters.kcenters(
+            X, 'euclidean', dist_cutoff=1, init_centers=init_centers,
+            use_triangle_inequality=True)
+
+        assert_array_equal(r.center_indices, pruned.center_indices)
+        assert_array_equal(r.assignments, pruned.assignments)
+        assert_array_equal(r.distances, pruned.distances)
+
+    def test_kcenters_partial_fit(self):
+
+        X = np.concatenate(self.traj_lst)
+
+        clust = kcenters.KCenters(metric='euclidean', cluster_radius=3)
+        clust.fit(X[:40])
+        old_centers = list(clust.center_indices_)
+
+        clust.partial_fit(X)
+
+        # existing centers are kept, and only new data needed new ones
+        assert_array_equal(clust.center_indices_[:len(old_centers)],
+                           old_centers)
+        assert_true(len(clust.center_indices_) > len(old_centers))
+        assert_true(
+            np.all(np.array(clust.center_indices_[len(old_centers):]) >= 40))
+        assert_true(np.all(clust.distances_ <= 3))
+
+        assigs, dists = util.assign_to_nearest_center(
+            X, clust.centers_, libdist.euclidean)
+        assert_array_equal(clust.labels_, assigs)
+        assert_allclose(clust.distances_, dists)
+
+        with assert_raises(DataInvalid):
+            clust.partial_fit(X[:10])
+
+    def test_khybrid_partial_fit(self):
+
+        X = np.concatenate(self.traj_lst)
+
+        clust = KHybrid(metric='euclidean', cluster_radius=3,
+                        kmedoids_updates=2)
+        clust.fit(X[:40])
+        old_centers = list(clust.center_indices_)
+
+        clust.partial_fit(X)
+
+        # the third blob is far from the others, so only its new
+        # clusters are affected and the old medoids don't move.
+        assert_array_equal(clust.center_indices_[:len(old_centers)],
+                           old_centers)
+        assert_true(
+            np.all(np.array(clust.center_indices_[len(old_centers):]) >= 40))
+        assert_array_equal(clust.labels_[clust.center_indices_],
+                           np.arange(len(clust.center_indices_)))
+        assert_allclose(
+            clust.distances_,
+            np.linalg.norm(X - clust.centers_[clust.labels_], axis=1))
+
+    def test_kcenters_float32_distances(self):
+
+        X = np.concatenate(self.traj_lst)
+
+        r = kcenters.kcenters(X, 'euclidean', dist_cutoff=1)
+        r32 = kcenters.kcenters(
+            X, 'euclidean', dist_cutoff=1, distance_dtype=np.float32)
+
+        assert_equal(r32.distances.dtype, np.float32)
+        assert_array_equal(r.center_indices, r32.center_indices)
+        assert_array_equal(r.assignments, r32.assignments)
+        assert_allclose(r.distances, r32.distances, rtol=1e-6)
+
+    def test_kcenters_sweep(self):
+
+        X = np.concatenate(self.traj_lst)
+
+        radii = [3, 1, 0.5, 2]
+        results = kcenters.kcenters_sweep(X, 'euclidean', cluster_radii=radii)
+
+        for r, result in zip(radii, results):
+            expected = kcenters.kcenters(X, 'euclidean', dist_cutoff=r)
+
+            assert_array_equal(result.center_indices,
+                               expected.center_indices)
+            assert_array_equal(result.assignments, expected.assignments)
+            assert_array_equal(result.distances, expected.distances)
+            assert_array_equal(result.centers, expected.centers)
+
+        ks = [5, 2, 9]
+        results = kcenters.kcenters_sweep(X, 'euclidean', n_clusters=ks)
+
+        for k, result in zip(ks, results):
+            expected = kcenters.kcenters(X, 'euclidean', n_clusters=k)
+
+            assert_array_equal(result.center_indices,
+                               expected.center_indices)
+            assert_array_equal(result.assignments, expected.assignments)
+            assert_array_equal(result.distances, expected.distances)
+
+        with assert_raises(ImproperlyConfigured):
+            kcenters.kcenters_sweep(
+                X, 'euclidean', n_clusters=ks, cluster_radii=radii)
+
+        # a larger k than there is data is never reached
+        with assert_raises(DataInvalid):
+            kcenters.kcenters_sweep(X, 'euclidean', n_clusters=[len(X)+1])
+
+    def test_kcenters_history(self):
+
+        X = np.concatenate(self.traj_lst)
+
+        clust = kcenters.KCenters(metric='euclidean', n_clusters=10)
+        clust.fit(X)
+
+        assert_array_equal(clust.history_.center_indices,
+                           clust.center_indices_)
+        assert_equal(len(clust.history_.max_distances), 10)
+        assert_equal(clust.history_.max_distances[-1],
+                     clust.distances_.max())
+
+        # the max distance at k is the radius of the clustering at k
+        for k in range(1, 10):
+            r = kcenters.kcenters(X, 'euclidean', n_clusters=k)
+            assert_equal(clust.history_.max_distances[k-1],
+                         r.distances.max())
+
+        # hot start centers come first, with unknown max distances
+        history = kcenters.KCentersHistory()
+        r = kcenters.kcenters(
+            X, 'euclidean', n_clusters=5,
+            init_centers=np.array(self.generators, dtype=float),
+            history=history)
+
+        assert_array_equal(history.center_indices, r.center_indices)
+        assert_equal(len(history.max_distances), 5)
+        assert np.all(np.isnan(history.max_distances[:2]))
+        assert_equal(history.max_distances[-1], r.distances.max())
+
     def test_numpy_hybrid(self):
         N_CLUSTERS = 3
 
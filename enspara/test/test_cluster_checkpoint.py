@@ -0,0 +1,243 @@
+import os
+import tempfile
+
+import numpy as np
+import mdtraj as md
+
+from nose.tools import assert_equal, assert_raises, assert_true
+from nose.plugins.attrib import attr
+
+from mdtraj.testing import get_fn
+from numpy.testing import assert_array_equal
+
+from ..cluster import kcenters, hybrid
+from ..cluster.checkpoint import Checkpoint
+from ..exception import DataInvalid, ImproperlyConfigured
+from ..geometry import libdist
+
+from .util import fix_np_rng
+
+
+class CountingMetric(object):
+
+    def __init__(self, metric):
+        self.metric = metric
+        self.n_calls = 0
+
+    def __call__(self, X, y):
+        self.n_calls += 1
+        return self.metric(X, y)
+
+
+def make_data():
+    return np.random.RandomState(0).normal(size=(500, 3))
+
+
+def test_checkpoint_requires_schedule():
+
+    with assert_raises(ImproperlyConfigured):
+        Checkpoint('ckpt.h5')
+
+
+def test_kcenters_checkpoint_resume():
+
+    X = make_data()
+    expected = kcenters.kcenters(X, libdist.euclidean, n_clusters=10)
+
+    with tempfile.TemporaryDirectory() as tdname:
+        ckpt = Checkpoint(os.path.join(tdname, 'ckpt.h5'), every_n=2)
+
+        kcenters.kcenters(
+            X, libdist.euclidean, n_clusters=5, checkpoint=ckpt)
+        assert_true(ckpt.exists())
+
+        # resuming doesn't recompute the distances to existing centers
+        metric = CountingMetric(libdist.euclidean)
+        history = kcenters.KCentersHistory()
+        result = kcenters.kcenters(
+            X, metric, n_clusters=10, history=history,
+            checkpoint=Checkpoint(ckpt.filename, every_n=2))
+
+        assert_equal(metric.n_calls, 5)
+        assert_array_equal(result.center_indices, expected.center_indices)
+        assert_array_equal(result.assignments, expected.assignments)
+        assert_array_equal(result.distances, expected.distances)
+        assert_array_equal(history.center_indices, expected.center_indices)
+
+        # a checkpoint can't be used with different data
+        with assert_raises(DataInvalid):
+            kcenters.kcenters(X[:-1], libdist.euclidean, n_clusters=10,
+                              checkpoint=ckpt)
+
+
+def test_kcenters_checkpoint_interval():
+
+    X = make_data()
+
+    with tempfile.TemporaryDirectory() as tdname:
+        ckpt = Checkpoint(os.path.join(tdname, 'ckpt.h5'), every_seconds=0)
+        assert_true(ckpt.step(lambda: {'distances': np.zeros(len(X))}))
+
+        ckpt = Checkpoint(
+            os.path.join(tdname, 'ckpt.h5'), every_seconds=3600)
+        assert_true(not ckpt.step(lambda: {'distances': np.zeros(len(X))}))
+        assert_true(ckpt.step(lambda: {'distances': np.zeros(len(X))},
+                              force=True))
+
+
+def test_kcenters_checkpoint_history():
+
+    X = make_data()
+    radii = [1.5, 1.0]
+
+    expected = kcenters.KCentersHistory(cluster_radii=radii)
+    kcenters.kcenters(X, libdist.euclidean, dist_cutoff=1.0,
+                      history=expected)
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'ckpt.h5')
+
+        # stop after the first radius is captured, then resume
+        history = kcenters.KCentersHistory(cluster_radii=radii)
+        kcenters.kcenters(
+            X, libdist.euclidean, dist_cutoff=1.5, history=history,
+            checkpoint=Checkpoint(fname, every_n=1))
+
+        history = kcenters.KCentersHistory(cluster_radii=radii)
+        kcenters.kcenters(
+            X, libdist.euclidean, dist_cutoff=1.0, history=history,
+            checkpoint=Checkpoint(fname, every_n=1))
+
+    assert_array_equal(history.center_indices, expected.center_indices)
+    assert_array_equal(history.max_distances, expected.max_distances)
+    for r in radii:
+        for a, b in zip(history.clustering(cluster_radius=r),
+                        expected.clustering(cluster_radius=r)):
+            assert_array_equal(a, b)
+
+
+def test_kcenters_checkpoint_criteria():
+
+    X = make_data()
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'ckpt.h5')
+        kcenters.kcenters(
+            X, libdist.euclidean, n_clusters=10,
+            checkpoint=Checkpoint(fname, every_n=2))
+
+        # fewer centers than the checkpoint has
+        with assert_raises(DataInvalid):
+            kcenters.kcenters(
+                X, libdist.euclidean, n_clusters=5,
+                checkpoint=Checkpoint(fname, every_n=2))
+
+        fname = os.path.join(tdname, 'ckpt-radius.h5')
+        kcenters.kcenters(
+            X, libdist.euclidean, dist_cutoff=1.0,
+            checkpoint=Checkpoint(fname, every_n=2))
+
+        # a larger cutoff would have stopped sooner
+        with assert_raises(DataInvalid):
+            kcenters.kcenters(
+                X, libdist.euclidean, dist_cutoff=1.5,
+                checkpoint=Checkpoint(fname, every_n=2))
+
+        # but a smaller one, or a cap on the centers that the
+        # checkpoint hasn't reached, continues from it
+        expected = kcenters.kcenters(X, libdist.euclidean, dist_cutoff=0.8)
+        result = kcenters.kcenters(
+            X, libdist.euclidean, dist_cutoff=0.8,
+            n_clusters=len(expected.center_indices),
+            checkpoint=Checkpoint(fname, every_n=2))
+        assert_array_equal(result.center_indices, expected.center_indices)
+
+
+@fix_np_rng()
+def test_hybrid_checkpoint_criteria():
+
+    X = make_data()
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'ckpt.h5')
+        hybrid.hybrid(
+            X, libdist.euclidean, n_clusters=10, n_iters=2,
+            checkpoint=Checkpoint(fname, every_n=5))
+
+        # the kcenters stage is over, so k can't change
+        with assert_raises(DataInvalid):
+            hybrid.hybrid(
+                X, libdist.euclidean, n_clusters=12, n_iters=2,
+                checkpoint=Checkpoint(fname, every_n=5))
+
+        with assert_raises(DataInvalid):
+            hybrid.hybrid(
+                X, libdist.euclidean, n_clusters=10, n_iters=1,
+                checkpoint=Checkpoint(fname, every_n=5))
+
+
+@fix_np_rng()
+def test_hybrid_checkpoint_resume():
+
+    X = make_data()
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'ckpt.h5')
+
+        result = hybrid.hybrid(
+            X, libdist.euclidean, n_clusters=10, n_iters=2,
+            checkpoint=Checkpoint(fname, every_n=5))
+
+        # the run is finished, so resuming does no work at all
+        metric = CountingMetric(libdist.euclidean)
+        resumed = hybrid.hybrid(
+            X, metric, n_clusters=10, n_iters=2,
+            checkpoint=Checkpoint(fname, every_n=5))
+
+        assert_equal(metric.n_calls, 0)
+        assert_array_equal(resumed.center_indices, result.center_indices)
+        assert_array_equal(resumed.assignments, result.assignments)
+        assert_array_equal(resumed.distances, result.distances)
+
+        # more sweeps pick up where the last run left off
+        resumed = hybrid.hybrid(
+            X, metric, n_clusters=10, n_iters=3,
+            checkpoint=Checkpoint(fname, every_n=5))
+        assert_true(metric.n_calls > 0)
+        assert_true(np.max(resumed.distances) <= np.max(result.distances))
+
+
+@attr('mpi')
+def test_kcenters_mpi_checkpoint_resume():
+    from ..mpi import MPI
+    MPI_RANK = MPI.COMM_WORLD.Get_rank()
+    MPI_SIZE = MPI.COMM_WORLD.Get_size()
+
+    trj = md.load(get_fn('frame0.h5')).xyz[:, :, 0].copy()
+    data = trj[MPI_RANK::MPI_SIZE]
+
+    expect_d, expect_a, expect_inds = kcenters.kcenters_mpi(
+        data, libdist.euclidean, n_clusters=10)
+
+    tdname = tempfile.mkdtemp() if MPI_RANK == 0 else None
+    tdname = MPI.COMM_WORLD.bcast(tdname, root=0)
+    fname = os.path.join(tdname, 'ckpt.h5')
+
+    try:
+        kcenters.kcenters_mpi(
+            data, libdist.euclidean, n_clusters=4,
+            checkpoint=Checkpoint(fname, every_n=3, mpi_mode=True))
+
+        d, a, inds = kcenters.kcenters_mpi(
+            data, libdist.euclidean, n_clusters=10,
+            checkpoint=Checkpoint(fname, every_n=3, mpi_mode=True))
+    finally:
+        MPI.COMM_WORLD.Barrier()
+        os.remove(os.path.join(tdname, 'ckpt.rank%s.h5' % MPI_RANK))
+        MPI.COMM_WORLD.Barrier()
+        if MPI_RANK == 0:
+            os.rmdir(tdname)
+
+    assert_array_equal(inds, expect_inds)
+    assert_array_equal(a, expect_a)
+    assert_array_equal(d, expect_d)
@@ -0,0 +1,90 @@
+from __future__ import print_function, division, absolute_import
+
+import numpy as np
+import mdtraj as md
+
+from mdtraj.testing import get_fn
+
+from nose.tools import assert_equal, assert_raises, assert_true
+from numpy.testing import assert_array_equal, assert_allclose
+
+from sklearn.datasets import make_blobs
+
+from ..cluster import HierarchicalKCenters
+from ..cluster.hierarchical import allocate_clusters
+from ..exception import ImproperlyConfigured
+from ..geometry import libdist
+
+
+def check_clustering(X, result, metric, atol=1e-5):
+
+    # every frame is within its coarse cluster's fine clustering, and its
+    # distance is the distance to its own center.
+    assert_equal(len(np.unique(result.assignments)),
+                 len(result.center_indices))
+    assert_array_equal(result.assignments[result.center_indices],
+                       np.arange(len(result.center_indices)))
+
+    for i, ctr in enumerate(result.center_indices):
+        frames = np.flatnonzero(result.assignments == i)
+        assert_allclose(result.distances[frames],
+                        metric(X[frames], X[ctr]), atol=atol)
+
+
+def test_hierarchical_kcenters_euclidean():
+
+    X, _ = make_blobs(n_samples=2000, n_features=3, centers=8,
+                      random_state=0)
+
+    clust = HierarchicalKCenters(
+        metric='euclidean', n_clusters=40, n_coarse_clusters=5,
+        subsample=300, random_state=0).fit(X)
+
+    assert_equal(len(clust.coarse_result_.center_indices), 5)
+    assert_equal(len(clust.center_indices_), 40)
+    check_clustering(X, clust.result_, libdist.euclidean)
+
+    # frames never leave their coarse cluster
+    coarse = clust.coarse_result_.assignments
+    assert_array_equal(coarse[clust.center_indices_][clust.labels_], coarse)
+
+    # the pool gives the same result as working serially
+    parallel = HierarchicalKCenters(
+        metric='euclidean', n_clusters=40, n_coarse_clusters=5,
+        subsample=300, n_procs=2, random_state=0).fit(X)
+
+    assert_array_equal(parallel.center_indices_, clust.center_indices_)
+    assert_array_equal(parallel.labels_, clust.labels_)
+    assert_allclose(parallel.distances_, clust.distances_)
+
+
+def test_hierarchical_khybrid_rmsd():
+
+    trj = md.load(get_fn('frame0.h5'))
+
+    clust = HierarchicalKCenters(
+        metric='rmsd', cluster_radius=0.1, n_coarse_clusters=3,
+        kmedoids_updates=2, n_procs=2, random_state=0).fit(trj)
+
+    assert_true(clust.distances_.max() <= 0.1)
+    check_clustering(trj, clust.result_, md.rmsd, atol=1e-3)
+
+
+def test_hierarchical_kcenters_config():
+
+    with assert_raises(ImproperlyConfigured):
+        HierarchicalKCenters(metric='euclidean', n_coarse_clusters=5)
+
+    with assert_raises(ImproperlyConfigured):
+        HierarchicalKCenters(metric='euclidean', n_clusters=5)
+
+
+def test_allocate_clusters():
+
+    assert_array_equal(allocate_clusters([50, 30, 20], 10), [5, 3, 2])
+    assert_array_equal(allocate_clusters([50, 31, 19], 10), [5, 3, 2])
+    assert_array_equal(allocate_clusters([97, 2, 1], 10), [8, 1, 1])
+
+    # shares are capped at the cluster size
+    assert_array_equal(allocate_clusters([10, 2, 1], 12), [9, 2, 1])
+    assert_array_equal(allocate_clusters([10, 2, 1], 20), [10, 2, 1])
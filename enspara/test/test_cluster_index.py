@@ -0,0 +1,98 @@
+from __future__ import print_function, division, absolute_import
+
+import pickle
+
+import numpy as np
+import mdtraj as md
+
+from mdtraj.testing import get_fn
+
+from nose.tools import assert_equal, assert_less, assert_raises
+from numpy.testing import assert_array_equal, assert_allclose
+
+from ..cluster.index import VPTree
+from ..cluster.util import assign_to_nearest_center
+from ..exception import DataInvalid, ImproperlyConfigured
+from ..geometry import libdist
+
+
+def test_vptree_euclidean():
+
+    rs = np.random.RandomState(0)
+    centers = rs.normal(size=(200, 3))
+    X = rs.normal(size=(1000, 3))
+
+    expect_assigs, expect_dists = assign_to_nearest_center(
+        X, centers, libdist.euclidean)
+
+    for leaf_size in [1, 8, 500]:
+        tree = VPTree(centers, metric='euclidean', leaf_size=leaf_size,
+                      random_state=0)
+        assigs, dists = tree.query(X)
+
+        assert_array_equal(assigs, expect_assigs)
+        assert_allclose(dists, expect_dists)
+
+    # metrics libdist can't compute in place on subsets of frames
+    tree = VPTree(centers, metric=lambda X, y: libdist.euclidean(X, y),
+                  random_state=0)
+    assigs, dists = tree.query(X)
+    assert_array_equal(assigs, expect_assigs)
+    assert_allclose(dists, expect_dists)
+
+    # in low dimension, most of the distances are pruned
+    tree = VPTree(centers, metric='euclidean', random_state=0)
+    tree.query(X)
+    assert_less(tree._n_computed, 0.5 * len(X) * len(centers))
+
+
+def test_vptree_rmsd():
+
+    trj = md.load(get_fn('frame0.h5'))
+    centers = trj[::10]
+
+    expect_assigs, expect_dists = assign_to_nearest_center(
+        trj, centers, libdist.rmsd)
+
+    tree = VPTree(centers, metric='rmsd', random_state=0)
+    assigs, dists = tree.query(libdist.PreparedCoordinates(trj))
+
+    assert_array_equal(assigs, expect_assigs)
+    assert_allclose(dists, expect_dists, atol=1e-5)
+
+    # trees survive being pickled
+    tree = pickle.loads(pickle.dumps(tree))
+    assert_equal(len(tree), len(centers))
+    assert_array_equal(tree.query(trj)[0], expect_assigs)
+
+
+def test_vptree_duplicates():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(300, 3))
+
+    # many centers tied at the median distance from the vantage points
+    # used to make the tree as deep as the number of centers.
+    for centers in [np.concatenate([rs.normal(size=(1200, 3)),
+                                    np.zeros((1200, 3))]),
+                    np.ones((3000, 3))]:
+        expect_assigs, expect_dists = assign_to_nearest_center(
+            X, centers, libdist.euclidean)
+
+        tree = VPTree(centers, metric='euclidean', random_state=0)
+        assigs, dists = tree.query(X)
+
+        assert_array_equal(assigs, expect_assigs)
+        assert_allclose(dists, expect_dists)
+
+        tree = pickle.loads(pickle.dumps(tree))
+        assert_array_equal(tree.query(X[:10])[0], expect_assigs[:10])
+
+
+def test_vptree_errors():
+
+    with assert_raises(DataInvalid):
+        VPTree(np.zeros((0, 3)), metric='euclidean')
+
+    with assert_raises(ImproperlyConfigured):
+        VPTree(np.zeros((5, 3)), metric='euclidean', leaf_size=0)
@@ -1,13 +1,18 @@
+import os
+import tempfile
+
 import numpy as np
 import mdtraj as md
 
-from nose.tools import assert_is, assert_is_not, assert_equal
+from nose.tools import assert_is, assert_is_not, assert_equal, assert_less
 from nose.plugins.attrib import attr
 
 from mdtraj.testing import get_fn
 from numpy.testing import assert_array_equal, assert_allclose
 
 from enspara.cluster import util
+from enspara.cluster.kcenters import KCenters
+from enspara.geometry import libdist
 from enspara.util import array as ra
 
 from .. import mpi
@@ -134,3 +139,108 @@ def test_find_cluster_centers_ndarray():
     ctrs = util.find_cluster_centers(assignments=a, distances=d)
 
     assert_array_equal(ctrs, [1, 2])
+
+
+def test_cluster_membership():
+
+    a = np.array([2, 0, 2, 1, 0, 2])
+    members = util.ClusterMembership(a, n_clusters=4)
+
+    assert_equal(len(members), 4)
+    for c in range(4):
+        assert_array_equal(members[c], np.where(a == c)[0])
+
+    # move frames 0 and 3 into cluster 0 and frame 4 into cluster 3
+    frames = np.array([0, 3, 4])
+    new_a = a.copy()
+    new_a[frames] = [0, 0, 3]
+    members.update(frames, a[frames], new_a[frames])
+
+    for c in range(4):
+        assert_array_equal(members[c], np.where(new_a == c)[0])
+
+
+def test_assignment_bounds():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(2000, 2))
+    centers = rs.normal(size=(20, 2))
+
+    n_computed = []
+
+    def metric(X, y):
+        n_computed.append(len(X))
+        return libdist.euclidean(X, y)
+
+    bounds = util.AssignmentBounds.from_centers(X, centers, metric)
+    expected = util.assign_to_nearest_center(X, centers, libdist.euclidean)
+    assert_array_equal(bounds.assignments, expected[0])
+    assert_allclose(bounds.upper, expected[1])
+
+    # move a couple of centers a little
+    new_centers = centers.copy()
+    new_centers[[3, 11]] += 0.01
+
+    n_computed.clear()
+    assigs, dists = bounds.update(X, new_centers, metric)
+    expected = util.assign_to_nearest_center(
+        X, new_centers, libdist.euclidean)
+
+    assert_array_equal(assigs, expected[0])
+    assert_allclose(dists, expected[1])
+    assert_less(sum(n_computed), len(X) * len(centers) / 2)
+
+    # a different number of centers starts over
+    assigs, dists = bounds.update(X, new_centers[:-1], metric)
+    assert_array_equal(
+        assigs, util.assign_to_nearest_center(
+            X, new_centers[:-1], libdist.euclidean)[0])
+
+
+def test_predict_with_bounds():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(500, 3))
+
+    clust = KCenters(metric='euclidean', n_clusters=10).fit(X)
+    Y = rs.normal(size=(300, 3))
+
+    bounds = util.AssignmentBounds.from_centers(
+        Y, clust.centers_, libdist.euclidean)
+
+    clust.fit(X[:-5])
+    expected = clust.predict(Y)
+    result = clust.predict(Y, bounds=bounds)
+
+    assert_array_equal(result.assignments, expected.assignments)
+    assert_allclose(result.distances, expected.distances)
+    assert_array_equal(result.center_indices, expected.center_indices)
+
+
+def test_distance_cache():
+
+    vectors = np.random.RandomState(0).normal(size=(5, 10))
+
+    with tempfile.TemporaryDirectory() as tdname:
+        for filename in [None, os.path.join(tdname, 'cache.dat')]:
+            # room for three vectors
+            cache = util.DistanceCache(3 * vectors[0].nbytes,
+                                       filename=filename)
+
+            for i in range(3):
+                cache.put(i, vectors[i])
+            assert_equal(len(cache), 3)
+            assert_array_equal(cache.get(0), vectors[0])
+
+            # 1 is now the least recently used, and is evicted
+            cache.put(3, vectors[3])
+            assert_equal(sorted(cache._entries), [0, 2, 3])
+            assert_array_equal(cache.get(3), vectors[3])
+            assert_equal(cache.nbytes, 3 * vectors[0].nbytes)
+
+            cache.discard(2)
+            cache.put((0, 4), vectors[4])
+            assert_array_equal(cache.get((0, 4)), vectors[4])
+            assert_array_equal(cache.get(0), vectors[0])
+            assert_is(cache.get(2), None)
+            assert_equal((cache.hits, cache.misses), (4, 1))
@@ -1,8 +1,10 @@
 import numpy as np
+import mdtraj as md
 from scipy.spatial.distance import cdist
 
-from nose.tools import assert_raises
-from numpy.testing import assert_array_equal
+from mdtraj.testing import get_fn
+from nose.tools import assert_raises, assert_equal
+from numpy.testing import assert_array_equal, assert_allclose
 
 from enspara import exception
 from enspara.geometry import libdist
@@ -84,3 +86,281 @@ def test_euclidean_distance_noalloc():
     assert_array_equal(
         d,
         cdist(X, y.reshape(1, -1)).flatten())
+
+
+def test_rmsd_matches_mdtraj():
+
+    trj = md.load(get_fn('frame0.h5'))
+
+    for i in [0, 17, len(trj)-1]:
+        expected = md.rmsd(trj, trj, i)
+
+        assert_allclose(libdist.rmsd(trj, trj[i]), expected, atol=1e-5)
+        assert_allclose(
+            libdist.rmsd(trj.xyz, trj.xyz[i]), expected, atol=1e-5)
+
+        prepared = libdist.PreparedCoordinates(trj)
+        d = libdist.rmsd(prepared, prepared[i])
+
+        assert_allclose(d, expected, atol=1e-5)
+        assert d[i] < 1e-6
+
+
+def test_rmsd_noalloc():
+
+    trj = md.load(get_fn('frame0.h5'))
+    prepared = libdist.PreparedCoordinates(trj)
+
+    with assert_raises(exception.DataInvalid):
+        libdist.rmsd(prepared, prepared[0],
+                     out=np.empty(len(trj), dtype='float32'))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.rmsd(prepared, prepared[0:2])
+
+    with assert_raises(exception.DataInvalid):
+        libdist.rmsd(prepared, trj.xyz[0, 1:])
+
+    out = np.empty(len(trj), dtype='float64')
+    d = libdist.rmsd(prepared, prepared[0], out=out)
+
+    assert d is out
+    assert_allclose(d, md.rmsd(trj, trj, 0), atol=1e-5)
+
+
+def test_prepared_coordinates_indexing():
+
+    trj = md.load(get_fn('frame0.h5'))
+    prepared = libdist.PreparedCoordinates(trj)
+
+    assert_equal(len(prepared), len(trj))
+    assert_equal(prepared.n_atoms, trj.n_atoms)
+
+    # input is copied by default
+    assert not np.shares_memory(prepared.xyz, trj.xyz)
+    assert_allclose(prepared.xyz.mean(axis=1), 0, atol=1e-5)
+
+    inds = [3, 1, 4, 1, 5]
+    subset = prepared[inds]
+    assert_array_equal(subset.xyz, prepared.xyz[inds])
+    assert_array_equal(subset.traces, prepared.traces[inds])
+
+    assert_equal(prepared[-1].xyz.shape, (1, trj.n_atoms, 3))
+    assert_array_equal(prepared[-1].xyz, prepared.xyz[-1:])
+    assert_equal(len(list(prepared[0:10:2])), 5)
+
+    with assert_raises(IndexError):
+        prepared[len(trj)]
+
+    # setting coordinates re-centers them and recomputes traces.
+    single = prepared[0]
+    single.xyz = trj.xyz[2]
+    assert_allclose(single.xyz, prepared.xyz[2:3], atol=1e-6)
+    assert_allclose(single.traces, prepared.traces[2:3])
+
+
+def test_prepared_coordinates_inplace():
+
+    xyz = md.load(get_fn('frame0.h5')).xyz
+    prepared = libdist.PreparedCoordinates(xyz, copy=False)
+
+    assert prepared.xyz is xyz
+    assert_allclose(xyz.mean(axis=1), 0, atol=1e-5)
+
+
+def test_rmsd_two_atoms():
+
+    # two atoms are always colinear, which makes the QCP polynomial's
+    # largest root a repeated one. The RMSD is the difference in the
+    # half-bond lengths.
+    trj = md.load(get_fn('frame0.h5'))
+    trj = trj.atom_slice([0, 1])
+
+    half_bond = np.linalg.norm(trj.xyz[:, 0] - trj.xyz[:, 1], axis=1) / 2
+
+    for i in [0, 7]:
+        assert_allclose(
+            libdist.rmsd(trj, trj[i]), np.abs(half_bond - half_bond[i]),
+            atol=1e-5)
+
+
+def test_assign_to_nearest_center():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(1000, 7))
+    centers = rs.normal(size=(300, 7))
+
+    expect_d = cdist(X, centers)
+
+    # block sizes that do and don't divide the data evenly
+    for block_size in [1, 64, 100, 4096]:
+        a, d = libdist.assign_to_nearest_center(
+            X, centers, block_size=block_size)
+
+        assert_array_equal(a, np.argmin(expect_d, axis=1))
+        assert_allclose(d, np.min(expect_d, axis=1))
+
+    # float32 and integer data are supported
+    a, d = libdist.assign_to_nearest_center(
+        X.astype(np.float32), centers.astype(np.float32))
+    assert_array_equal(a, np.argmin(expect_d, axis=1))
+
+    Xi = rs.randint(-10, 10, size=(50, 3))
+    a, d = libdist.assign_to_nearest_center(Xi, Xi[::5])
+    assert_array_equal(d[::5], 0)
+    assert_array_equal(a[::5], np.arange(10))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.assign_to_nearest_center(X, centers[:, 1:])
+
+    with assert_raises(exception.DataInvalid):
+        libdist.assign_to_nearest_center(X, centers[0])
+
+
+def test_distance_matrix():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(1000, 7))
+    Y = X[[3, 10, 999]]
+
+    d = libdist.distance_matrix(X, Y)
+    assert_equal(d.shape, (3, 1000))
+    for k, y in enumerate(Y):
+        assert_array_equal(d[k], libdist.euclidean(X, y))
+
+    # float32 data gives the same distances as euclidean as well
+    d = libdist.distance_matrix(X.astype(np.float32), Y)
+    assert_array_equal(d[1], libdist.euclidean(X.astype(np.float32),
+                                               Y[1].astype(np.float32)))
+
+    trj = md.load(get_fn('frame0.h5'))
+    d = libdist.distance_matrix(trj, trj[[0, 7]], 'rmsd')
+    assert_allclose(d[0], md.rmsd(trj, trj, 0), atol=1e-5)
+    assert_allclose(d[1], md.rmsd(trj, trj, 7), atol=1e-5)
+
+    prepared = libdist.PreparedCoordinates(trj)
+    d = libdist.distance_matrix(prepared, prepared[[7]], libdist.rmsd)
+    assert_array_equal(d[0], libdist.rmsd(prepared, prepared[7]))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.distance_matrix(X, Y[:, 1:])
+
+    with assert_raises(exception.DataInvalid):
+        libdist.distance_matrix(X, Y, 'manhattan')
+
+
+def test_update_nearest_euclidean():
+
+    rs = np.random.RandomState(0)
+    X = rs.normal(size=(10000, 5))
+
+    for dist_dtype, label_dtype in [(np.float64, np.int64),
+                                    (np.float32, np.int32)]:
+        distances = np.full(len(X), np.inf, dtype=dist_dtype)
+        assignments = np.zeros(len(X), dtype=label_dtype)
+
+        expect_d = np.full(len(X), np.inf)
+        for label, i in enumerate([0, 17, 4321]):
+            amax, dmax = libdist.update_nearest(
+                X, X[i], distances, assignments, label)
+            expect_d = np.minimum(expect_d, libdist.euclidean(X, X[i]))
+
+            assert_equal(amax, np.argmax(distances))
+            assert_equal(dmax, np.max(distances))
+
+        assert_equal(distances.dtype, dist_dtype)
+        assert_allclose(distances, expect_d, rtol=1e-6)
+        assert_array_equal(
+            assignments,
+            np.argmin(cdist(X, X[[0, 17, 4321]]), axis=1))
+
+    # distances must be bitwise identical to euclidean()
+    distances = np.full(len(X), np.inf)
+    libdist.update_nearest(
+        X, X[0], distances, np.zeros(len(X), dtype=int), 0)
+    assert_array_equal(distances, libdist.euclidean(X, X[0]))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.update_nearest(
+            X, X[0], np.zeros(len(X), dtype=int), assignments, 0)
+
+    with assert_raises(exception.DataInvalid):
+        libdist.update_nearest(
+            X, X[0], distances[1:], assignments, 0)
+
+
+def test_update_nearest_rmsd():
+
+    trj = md.load(get_fn('frame0.h5'))
+    X = libdist.PreparedCoordinates(trj)
+
+    distances = np.full(len(X), np.inf)
+    assignments = np.zeros(len(X), dtype=int)
+
+    amax, dmax = libdist.update_nearest(
+        X, X[0], distances, assignments, 3, metric=libdist.rmsd)
+
+    assert_array_equal(distances, libdist.rmsd(X, X[0]))
+    assert_array_equal(assignments, 3)
+    assert_equal(amax, np.argmax(distances))
+    assert_equal(dmax, np.max(distances))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.update_nearest(
+            trj.xyz, X[0], distances, assignments, 3, metric='rmsd')
+
+
+def test_distances_to_frames():
+
+    rs = np.random.RandomState(0)
+    frames = np.array([7, 0, 99, 7, 42])
+
+    X = rs.normal(size=(100, 5))
+    assert_array_equal(libdist.euclidean(X, X[3], frames=frames),
+                       libdist.euclidean(X[frames], X[3]))
+
+    trj = md.load(get_fn('frame0.h5'))
+    P = libdist.PreparedCoordinates(trj)
+    assert_array_equal(libdist.rmsd(P, P[3], frames=frames),
+                       libdist.rmsd(P[frames], P[3]))
+
+    out = np.zeros(len(frames))
+    libdist.rmsd(P, P[3], out=out, frames=frames)
+    assert_array_equal(out, libdist.rmsd(P[frames], P[3]))
+
+    with assert_raises(exception.DataInvalid):
+        libdist.rmsd(P, P[3], frames=[0, len(P)])
+
+    with assert_raises(exception.DataInvalid):
+        libdist.euclidean(X, X[3], frames=[-1])
+
+
+def test_update_nearest_frames():
+
+    rs = np.random.RandomState(0)
+    frames = np.array([3, 8, 500, 9999])
+
+    for X, y, metric in [
+            (rs.normal(size=(10000, 5)), None, 'euclidean'),
+            (libdist.PreparedCoordinates(md.load(get_fn('frame0.h5'))),
+             None, 'rmsd')]:
+        frames = frames[frames < len(X)]
+        y = X[1]
+
+        distances = rs.uniform(size=len(X))
+        assignments = np.zeros(len(X), dtype=int)
+        expect_d, expect_a = distances.copy(), assignments.copy()
+
+        amax, dmax = libdist.update_nearest(
+            X, y, distances, assignments, 2, metric=metric, frames=frames)
+
+        dist = getattr(libdist, metric)(X[frames], y)
+        closer = dist < expect_d[frames]
+        expect_d[frames[closer]] = dist[closer]
+        expect_a[frames[closer]] = 2
+
+        # only the given frames are updated, exactly as for X[frames]
+        assert_array_equal(distances, expect_d)
+        assert_array_equal(assignments, expect_a)
+        assert_equal(amax, np.argmax(distances))
+        assert_equal(dmax, np.max(distances))
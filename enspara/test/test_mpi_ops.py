@@ -140,3 +140,158 @@ def test_mpi_randind_uniform():
 
     distro = np.bincount(hits)
     assert_equal(distro[np.argmax(distro)], i+1)
+
+
+@attr('mpi')
+def test_mpi_randinds():
+
+    arrays = [np.arange(17), np.arange(3), np.arange(40) * 2]
+    local_arrays = [a[mpi.MPI_RANK::mpi.MPI_SIZE] for a in arrays]
+
+    hits = [set() for a in arrays]
+    for i in range(200):
+        locations = mpi.ops.randinds(local_arrays, random_state=i)
+        assert_equal(len(locations), len(arrays))
+
+        for j, (r, o) in enumerate(locations):
+            hits[j].add(int(arrays[j][r::mpi.MPI_SIZE][o]))
+
+    for a, h in zip(arrays, hits):
+        assert_equal(h, set(a))
+
+    with assert_raises(exception.DataInvalid):
+        mpi.ops.randinds([np.arange(0), np.arange(5)])
+
+
+@attr('mpi')
+def test_mpi_distribute_frames():
+
+    data = np.arange(10*100*3).reshape(10, 100, 3)
+    owners = [mpi.MPI_SIZE-1, 0, 0]
+    world_inds = [7 if mpi.MPI_RANK == r else None for r in owners]
+    world_inds[1:] = [2, 5]
+
+    frames, inds = mpi.ops.distribute_frames(data, world_inds, owners)
+
+    assert_equal(inds, [7, 2, 5])
+    for f, i in zip(frames, inds):
+        assert_array_equal(f, data[i])
+
+    trj = md.load(get_fn('frame0.h5'))
+    frames, inds = mpi.ops.distribute_frames(trj, [3], [mpi.MPI_SIZE-1])
+
+    assert_array_equal(frames[0].xyz, trj[3].xyz)
+    assert_is(type(frames[0]), type(trj))
+
+
+@attr('mpi')
+def test_mpi_balanced_layout():
+
+    lengths = [100, 10, 10, 30, 50]
+
+    layout = mpi.io.balanced_layout(lengths, 3)
+    assert_array_equal(
+        layout,
+        [[0, 0, 0, 100], [1, 4, 0, 50], [2, 1, 0, 10], [2, 2, 0, 10],
+         [2, 3, 0, 30]])
+
+    # split layouts give each rank 66 or 67 frames, whole files first
+    layout = mpi.io.balanced_layout(lengths, 3, split=True)
+    assert_array_equal(
+        layout,
+        [[0, 0, 0, 66], [1, 1, 0, 10], [1, 2, 0, 10], [1, 0, 66, 100],
+         [1, 3, 0, 13], [2, 4, 0, 50], [2, 3, 13, 30]])
+
+    # every frame is on exactly one rank
+    global_inds = np.concatenate(
+        [mpi.ops.layout_global_indices(layout, lengths, r) for r in range(3)])
+    assert_array_equal(np.sort(global_inds), np.arange(sum(lengths)))
+
+    with assert_raises(exception.ImproperlyConfigured):
+        mpi.io.balanced_layout([10, 10], 3)
+
+    # splitting can't give every rank a frame, either
+    with assert_raises(exception.ImproperlyConfigured):
+        mpi.io.balanced_layout([1], 2, split=True)
+    assert_equal(len(mpi.io.balanced_layout([1, 1], 2, split=True)), 2)
+
+
+@attr('mpi')
+def test_mpi_assemble_balanced():
+
+    lengths = np.array([23, 5, 41, 7, 2])
+    data = np.arange(lengths.sum()) + 1
+
+    for split in [False, True]:
+        if not split and len(lengths) < mpi.MPI_SIZE:
+            continue
+
+        layout = mpi.io.balanced_layout(lengths, mpi.MPI_SIZE, split=split)
+        local_inds = mpi.ops.layout_global_indices(
+            layout, lengths, mpi.MPI_RANK)
+
+        assembled = mpi.ops.assemble_striped_ragged_array(
+            data[local_inds], lengths, layout=layout)
+        assert_array_equal(assembled, data)
+
+        local_ctr_inds = [(r, 0) for r in range(mpi.MPI_SIZE)
+                          if np.any(layout[:, 0] == r)]
+        assert_array_equal(
+            mpi.ops.convert_local_indices(
+                local_ctr_inds, lengths, layout=layout),
+            [mpi.ops.layout_global_indices(layout, lengths, r)[0]
+             for r, _ in local_ctr_inds])
+
+
+@attr('mpi')
+def test_mpi_assemble_striped_root():
+
+    a = np.arange(77) + 1
+
+    b = mpi.ops.assemble_striped_array(a[mpi.MPI_RANK::mpi.MPI_SIZE], root=0)
+    if mpi.MPI_RANK == 0:
+        assert_array_equal(a, b)
+    else:
+        assert_is(b, None)
+
+    lengths = np.array([23, 5, 41, 7, 2, 11])
+    data = np.arange(lengths.sum(), dtype=np.int32) + 1
+    local = np.concatenate(
+        [np.zeros(0, dtype=np.int32)] +
+        [d for d in np.split(data, np.cumsum(lengths)[:-1])
+         [mpi.MPI_RANK::mpi.MPI_SIZE]])
+
+    for root in [None, mpi.MPI_SIZE - 1]:
+        assembled = mpi.ops.assemble_striped_ragged_array(
+            local, lengths, root=root)
+        if root is None or mpi.MPI_RANK == root:
+            assert_array_equal(assembled, data)
+            assert_equal(assembled.dtype, int)
+        else:
+            assert_is(assembled, None)
+
+    assembled = mpi.ops.assemble_striped_ragged_array(
+        local.astype(np.float32) / 2, lengths)
+    assert_array_equal(assembled, data / 2)
+    assert_equal(assembled.dtype, float)
+
+
+@attr('mpi')
+def test_mpi_maxloc():
+
+    values = np.array([3., 7., 1., 7., 5.])
+    local = values[mpi.MPI_RANK::mpi.MPI_SIZE]
+    local_index = int(np.argmax(local)) if len(local) else 0
+    local_value = local[local_index] if len(local) else -np.inf
+
+    n_local_max = len(values[::mpi.MPI_SIZE])
+
+    # ties go to the lowest rank holding the maximum
+    owners = [i % mpi.MPI_SIZE for i in np.flatnonzero(values == 7.)]
+    expected_rank = min(owners)
+    expected_index = int(np.argmax(values[expected_rank::mpi.MPI_SIZE]))
+
+    for n in [n_local_max, 2**31]:
+        value, rank, index = mpi.ops.maxloc(local_value, local_index, n)
+        assert_equal(value, 7.)
+        assert_equal((rank, index), (expected_rank, expected_index))
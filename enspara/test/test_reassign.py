@@ -12,10 +12,11 @@ import mdtraj as md
 
 from mdtraj.testing import get_fn
 
-from nose.tools import assert_less, assert_equal, assert_is
+from nose.tools import assert_less, assert_equal, assert_is, assert_raises
 from numpy.testing import assert_array_equal, assert_allclose
 
 from .. import cards
+from ..exception import DataInvalid
 from ..util import array as ra
 
 from ..apps import reassign
@@ -127,6 +128,42 @@ def test_reassignment_function_memory():
     assert_allclose(dists[0], dists[1], atol=1e-3)
 
 
+def test_reassignment_function_index():
+
+    topologies = [get_fn('native.pdb')]
+    top = md.load(topologies[0]).top
+
+    trajectories = [[get_fn('frame0.xtc')]*2]
+    atoms = '(name N or name C or name CA or name H or name O)'
+    centers = md.load(trajectories[0][0], top=topologies[0])[::50]
+    centers = centers.atom_slice(top.select(atoms))
+
+    expect_assigns, expect_dists = reassign.reassign(
+        topologies, trajectories, [atoms], centers)
+
+    with tempfile.TemporaryDirectory() as tdname:
+        index_fname = os.path.join(tdname, 'index.pkl')
+
+        # the first load builds and saves the index, the second reads it
+        for _ in range(2):
+            index = reassign.load_index(index_fname, centers)
+            assigns, dists = reassign.reassign(
+                topologies, trajectories, [atoms], centers, index=index)
+
+            assert_array_equal(assigns, expect_assigns)
+            assert_allclose(dists, expect_dists, atol=1e-5)
+
+        with assert_raises(DataInvalid):
+            reassign.load_index(index_fname, centers[:-1])
+
+        # same number of centers and atoms, but different coordinates
+        moved = centers[:]
+        moved.xyz = centers.xyz.copy()
+        moved.xyz[0] += 0.1
+        with assert_raises(DataInvalid):
+            reassign.load_index(index_fname, moved)
+
+
 def test_reassignment_function_heterogenous():
 
     xtc2 = os.path.join(TEST_DIR, 'cards_data', 'trj0.xtc')
@@ -7,14 +7,16 @@ import warnings
 import mdtraj as md
 from mdtraj.testing import get_fn
 
-from nose.tools import assert_equal
+from nose.tools import assert_equal, assert_raises
 from nose.plugins.attrib import attr
 
 import numpy as np
 from numpy.testing import assert_array_equal, assert_allclose
 
 from ..apps import rmsd_cluster_mpi
+from .. import exception
 from ..cluster.util import assign_to_nearest_center
+from ..geometry import libdist
 from ..util import array as ra
 from ..mpi import MPI, MPI_RANK, MPI_SIZE
 
@@ -139,7 +141,7 @@ def test_rmsd_cluster_mpi_basic():
 
     expect_a, expect_d = assign_to_nearest_center(
         md.join([trj_sele]*2),
-        md.join([trj_sele[i[1]] for i in expected_i]), md.rmsd)
+        md.join([trj_sele[i[1]] for i in expected_i]), libdist.rmsd)
 
     assert_array_equal(expect_a, a)
     assert_allclose(expect_d, d, atol=1e-4)
@@ -188,7 +190,169 @@ def test_rmsd_cluster_mpi_subsample():
 
     expect_a, expect_d = assign_to_nearest_center(
         md.join([trj_sele]*expected_size[0]),
-        md.join([trj_sele[i[1]] for i in inds]), md.rmsd)
+        md.join([trj_sele[i[1]] for i in inds]), libdist.rmsd)
 
     assert_array_equal(expect_a[::SUBSAMPLE_FACTOR], a)
     assert_allclose(expect_d[::SUBSAMPLE_FACTOR], d, atol=1e-4)
+
+
+@attr('mpi')
+def test_rmsd_cluster_mpi_partition():
+
+    TRJFILE = get_fn('frame0.xtc')
+    TOPFILE = get_fn('native.pdb')
+    SELECTION = '(name N or name C or name CA or name H or name O)'
+    SUBSAMPLE_FACTOR = 3
+
+    expected_size = (3, (np.ceil(501 / 3),)*3)
+
+    trj = md.load(TRJFILE, top=TOPFILE)
+    trj_sele = trj.atom_slice(trj.top.select(SELECTION))
+
+    for partition in ['files', 'frames']:
+        # only 'frames' can give ranks parts of files
+        if partition == 'files' and MPI_SIZE > expected_size[0]:
+            continue
+
+        with tempfile.TemporaryDirectory() as tdname:
+
+            tdname = MPI.COMM_WORLD.bcast(tdname, root=0)
+
+            for i in range(expected_size[0]):
+                shutil.copy(TRJFILE, os.path.join(tdname, 'frame%s.xtc' % i))
+
+            with warnings.catch_warnings():
+                warnings.filterwarnings('ignore')
+                a, d, inds, s = runhelper([
+                    '--trajectories', os.path.join(tdname, 'frame?.xtc'),
+                    '--topology', TOPFILE,
+                    '--cluster-radii', '0.1',
+                    '--subsample', str(SUBSAMPLE_FACTOR),
+                    '--selection', SELECTION,
+                    '--partition', partition,
+                    '--kmedoids-iters', str(1),
+                    ],
+                    expected_size=expected_size)
+
+        a = a.flatten()
+        d = d.flatten()
+
+        expected_s = md.join([trj[i[1]] for i in inds])
+        assert_array_equal(expected_s.xyz, md.join(s).xyz)
+
+        expect_a, expect_d = assign_to_nearest_center(
+            md.join([trj_sele]*expected_size[0]),
+            md.join([trj_sele[i[1]] for i in inds]), libdist.rmsd)
+
+        # each frame's distance is to its own center, which is at least
+        # as far as the nearest.
+        centers = md.join([trj_sele[i[1]] for i in inds])
+        own_d = np.array([
+            libdist.rmsd(trj_sele[f*SUBSAMPLE_FACTOR % 501], centers[c])[0]
+            for f, c in enumerate(a)])
+        assert_allclose(own_d, d, atol=1e-4)
+        assert np.all(d >= expect_d[::SUBSAMPLE_FACTOR] - 1e-4)
+        assert d.max() <= 0.1 + 1e-4
+
+
+@attr('mpi')
+def test_rmsd_cluster_mpi_multiple_radii():
+
+    TRJFILE = get_fn('frame0.xtc')
+    TOPFILE = get_fn('native.pdb')
+    SELECTION = '(name N or name C or name CA or name H or name O)'
+
+    with tempfile.TemporaryDirectory() as tdname:
+        tdname = MPI.COMM_WORLD.bcast(tdname, root=0)
+        shutil.copy(TRJFILE, os.path.join(tdname, 'frame0.xtc'))
+        shutil.copy(TRJFILE, os.path.join(tdname, 'frame1.xtc'))
+
+        outdir = os.path.join(tdname, 'out')
+        if MPI_RANK == 0:
+            os.mkdir(outdir)
+        MPI.COMM_WORLD.Barrier()
+
+        rmsd_cluster_mpi.main([
+            '',
+            '--trajectories', os.path.join(tdname, 'frame?.xtc'),
+            '--topology', TOPFILE,
+            '--selection', SELECTION,
+            '--cluster-radii', '0.1', '0.15',
+            '--kmedoids-iters', '0',
+            '--distances', outdir + '/dists-{cluster_radius}.h5',
+            '--assignments', outdir + '/assigs-{cluster_radius}.h5',
+            '--center-indices', outdir + '/ctr-inds-{cluster_radius}.pkl',
+            '--center-structures', outdir + '/ctrs-{cluster_radius}.pkl'])
+        MPI.COMM_WORLD.Barrier()
+
+        center_inds = {}
+        for r in ['0.1', '0.15']:
+            with open(outdir + '/ctr-inds-%s.pkl' % r, 'rb') as f:
+                center_inds[r] = pickle.load(f)
+            assigs = ra.load(outdir + '/assigs-%s.h5' % r)
+            dists = ra.load(outdir + '/dists-%s.h5' % r)
+
+            assert_equal(len(assigs), 2)
+            assert_equal(len(dists), 2)
+            assert_array_equal(
+                np.unique(np.concatenate(list(assigs))),
+                np.arange(len(center_inds[r])))
+
+        MPI.COMM_WORLD.Barrier()
+
+    # same result as a run with only that radius (see above)
+    assert_array_equal(
+        center_inds['0.1'], [[0, 0], [0, 42], [0, 430], [0, 319]])
+
+    # coarser clusterings are prefixes of the finer ones
+    n = len(center_inds['0.15'])
+    assert n < len(center_inds['0.1'])
+    assert_array_equal(center_inds['0.15'], center_inds['0.1'][:n])
+
+    with assert_raises(exception.ImproperlyConfigured):
+        rmsd_cluster_mpi.main([
+            '',
+            '--trajectories', TRJFILE,
+            '--topology', TOPFILE,
+            '--selection', SELECTION,
+            '--cluster-radii', '0.1', '0.15',
+            '--center-indices', '/tmp/ctr-inds.pkl',
+            '--center-structures', '/tmp/ctrs.pkl'])
+
+
+@attr('mpi')
+def test_rmsd_cluster_mpi_checkpoint():
+
+    TRJFILE = get_fn('frame0.xtc')
+    TOPFILE = get_fn('native.pdb')
+    SELECTION = '(name N or name C or name CA or name H or name O)'
+
+    with tempfile.TemporaryDirectory() as tdname:
+        tdname = MPI.COMM_WORLD.bcast(tdname, root=0)
+        shutil.copy(TRJFILE, os.path.join(tdname, 'frame0.xtc'))
+        shutil.copy(TRJFILE, os.path.join(tdname, 'frame1.xtc'))
+
+        args = [
+            '--trajectories', os.path.join(tdname, 'frame?.xtc'),
+            '--topology', TOPFILE,
+            '--cluster-radii', '0.1',
+            '--selection', SELECTION,
+            '--kmedoids-iters', '1',
+            '--random-state', '0',
+            '--checkpoint', os.path.join(tdname, 'ckpt.h5'),
+            '--checkpoint-every', '2',
+        ]
+
+        a, d, i, s = runhelper(args, expected_size=(2, 501))
+
+        # the second run resumes from the finished checkpoints
+        MPI.COMM_WORLD.Barrier()
+        assert os.path.isfile(
+            os.path.join(tdname, 'ckpt.rank%s.h5' % MPI_RANK))
+        ra_, rd, ri, rs = runhelper(args, expected_size=(2, 501))
+
+        MPI.COMM_WORLD.Barrier()
+
+    assert_array_equal(a, ra_)
+    assert_array_equal(d, rd)
+    assert_array_equal(i, ri)
@@ -1,6 +1,10 @@
 import unittest
 import logging
+import os
+import shutil
 import tempfile
+import tracemalloc
+import weakref
 
 import numpy as np
 import mdtraj as md
@@ -11,10 +15,17 @@ from nose.tools import assert_raises, assert_equals, assert_is, assert_true
 from numpy.testing import assert_array_equal
 
 from ..util import array as ra
-from ..util.load import load_as_concatenated, concatenate_trjs
+from ..util import load as load_module
+from ..util.load import (load_as_concatenated, concatenate_trjs,
+                         sound_trajectory, sound_trajectories,
+                         iterload_blocks, LengthIndex, LENGTH_INDEX_ENV,
+                         CoordinateCache, COORDINATE_CACHE_ENV,
+                         _plan_load_tasks)
 
 from ..exception import DataInvalid, ImproperlyConfigured
 
+from ..apps import index_lengths
+
 
 def assert_ra_equal(a, b, **kwargs):
         assert_array_equal(a._data, b._data, **kwargs)
@@ -545,6 +556,67 @@ class TestParallelLoad(unittest.TestCase):
                 top=self.top,
                 lengths=[len(t) for t in [t1, t2[::2], t3]])
 
+    def test_load_as_concatenated_no_copy(self):
+        '''The coordinates are loaded in place, not copied to the caller.
+        '''
+
+        t = md.load(self.trj_fname, top=self.top)
+
+        # numpy reports its allocations to tracemalloc, but the shared
+        # memory the workers load into isn't allocated by numpy.
+        tracemalloc.start()
+        try:
+            lengths, xyz = load_as_concatenated(
+                [self.trj_fname]*10, top=self.top, lengths=[len(t)]*10,
+                processes=2)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        assert_array_equal(xyz, np.concatenate([t.xyz]*10))
+        assert_true(peak < xyz.nbytes / 2)
+
+        # the result is an ordinary, writable array
+        assert_true(xyz.flags.writeable and xyz.flags.c_contiguous)
+        xyz[0] = 0
+        assert_array_equal(xyz[0], 0)
+
+    def test_load_as_concatenated_pieces(self):
+        '''Long trajectories are split into pieces, each loaded into
+        its own place.
+        '''
+
+        filenames = [self.trj_fname, get_fn('frame0.h5'), self.trj_fname]
+        selection = np.array([1, 3, 6])
+
+        for stride in [1, 3]:
+            expected = np.concatenate([
+                md.load(f, top=self.top, stride=stride,
+                        atom_indices=selection).xyz for f in filenames])
+
+            lengths, xyz = load_as_concatenated(
+                filenames, top=self.top, stride=stride,
+                atom_indices=selection, processes=3, piece_size=40)
+
+            assert_array_equal(lengths, [len(range(0, 501, stride))] * 3)
+            assert_array_equal(xyz, expected)
+
+    def test_plan_load_tasks(self):
+
+        args = [{}, {'frame': 2}, {}]
+        tasks = _plan_load_tasks(
+            ['a.xtc', 'b.xtc', 'c.pdb'], args, [250, 1, 300], n_procs=2,
+            piece_size=100)
+
+        # the xtc is split, the single frame and the pdb aren't, and the
+        # tasks are ordered largest first.
+        assert_equals(
+            [t[0] for t in tasks], [251, 0, 100, 200, 250])
+        assert_equals(
+            [(t[3], t[4]) for t in tasks],
+            [(None, None), (0, 100), (100, 200), (200, 250),
+             (None, None)])
+
     def test_load_as_concatenated_frame_kwarg(self):
         '''`frame` should work in the `args` param of load_as_concatenated
         '''
@@ -628,6 +700,247 @@ class TestParallelLoad(unittest.TestCase):
         self.assertTrue(np.all(expected == xyz))
 
 
+class TestIterloadBlocks(unittest.TestCase):
+
+    def setUp(self):
+        self.top = md.load(get_fn('native.pdb')).top
+        self.filenames = [get_fn('frame0.xtc'), get_fn('frame0.h5'),
+                          get_fn('frame0.xtc')]
+        self.selection = np.array([1, 3, 6])
+
+    def test_iterload_blocks(self):
+
+        trjs = [md.load(f, top=self.top, stride=2,
+                        atom_indices=self.selection)
+                for f in self.filenames]
+        offsets = np.cumsum([0] + [len(t) for t in trjs])
+
+        for prefetch, max_memory in [(0, None), (3, None), (3, 1)]:
+            blocks = list(iterload_blocks(
+                self.filenames, 100, top=self.top, stride=2,
+                atom_indices=self.selection, prefetch=prefetch,
+                max_memory=max_memory))
+
+            # blocks span files, and only the last is short
+            assert_equals([len(xyz) for _, _, xyz in blocks],
+                          [100]*7 + [53])
+            assert_array_equal(
+                np.concatenate([xyz for _, _, xyz in blocks]),
+                np.concatenate([t.xyz for t in trjs]))
+
+            for i, (traj_index, frame_offset, _) in enumerate(blocks):
+                assert_equals(offsets[traj_index] + frame_offset, 100*i)
+                assert_true(frame_offset < len(trjs[traj_index]))
+
+    def test_iterload_blocks_max_memory(self):
+
+        # blocks are 100 frames of 3 atoms, so 3600 bytes
+        block_bytes = 100 * len(self.selection) * 3 * 4
+        load_block = load_module._load_block
+        live = []
+        peak = []
+
+        def counting_load_block(*args):
+            xyz = load_block(*args)
+            live.append(weakref.ref(xyz))
+            peak.append(sum(r() is not None for r in live))
+            return xyz
+
+        load_module._load_block = counting_load_block
+        try:
+            for max_memory in [3, 5, 8]:
+                del peak[:]
+                for _, _, xyz in iterload_blocks(
+                        self.filenames, 100, top=self.top, stride=2,
+                        atom_indices=self.selection, prefetch=8,
+                        max_memory=max_memory * block_bytes):
+                    peak.append(sum(r() is not None for r in live))
+
+                # at least one block is prefetched (and two are held
+                # by the caller), however little memory there is.
+                assert_true(max(peak) <= max(max_memory, 3))
+                del xyz
+        finally:
+            load_module._load_block = load_block
+
+    def test_iterload_blocks_stop_early(self):
+
+        blocks = iterload_blocks(
+            self.filenames, 50, top=self.top, prefetch=4)
+
+        traj_index, frame_offset, xyz = next(blocks)
+        blocks.close()
+
+        assert_equals((traj_index, frame_offset), (0, 0))
+        assert_array_equal(
+            xyz, md.load(self.filenames[0], top=self.top)[:50].xyz)
+
+    def test_iterload_blocks_unseekable(self):
+
+        pdb = get_fn('native.pdb')
+        trj = md.load(pdb)
+
+        blocks = list(iterload_blocks([pdb]*3, 2, prefetch=1))
+
+        assert_equals([b[:2] for b in blocks], [(0, 0), (2, 0)])
+        assert_array_equal(np.concatenate([xyz for _, _, xyz in blocks]),
+                           np.concatenate([trj.xyz]*3))
+
+
+class TestLengthIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.mkdtemp()
+        self.trj_fname = os.path.join(self.td, 'frame0.xtc')
+        shutil.copy(get_fn('frame0.xtc'), self.trj_fname)
+        self.index_fname = os.path.join(self.td, 'lengths.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.td)
+
+    def test_length_index(self):
+
+        n_frames = len(md.load(self.trj_fname, top=get_fn('native.pdb')))
+
+        index = LengthIndex(self.index_fname)
+        assert_equals(index.lookup([self.trj_fname]), [None])
+
+        assert_equals(sound_trajectory(self.trj_fname, index=index),
+                      n_frames)
+        assert_equals(index.lookup([self.trj_fname]), [n_frames])
+
+        # lengths in the index are used without opening the file
+        index.record([self.trj_fname], [7])
+        assert_equals(
+            sound_trajectories([self.trj_fname]*2, stride=[1, 2],
+                               index=self.index_fname), [7, 4])
+
+        # ... unless the file has changed since it was indexed
+        st = os.stat(self.trj_fname)
+        os.utime(self.trj_fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        assert_equals(sound_trajectory(self.trj_fname, index=index),
+                      n_frames)
+
+    def test_length_index_environment(self):
+
+        os.environ[LENGTH_INDEX_ENV] = self.index_fname
+        try:
+            lengths, xyz = load_as_concatenated(
+                [self.trj_fname], top=get_fn('native.pdb'), stride=2)
+        finally:
+            del os.environ[LENGTH_INDEX_ENV]
+
+        # loading sounded the trajectory and recorded its full length
+        assert_equals(lengths, [251])
+        assert_equals(LengthIndex(self.index_fname).lookup(
+            [self.trj_fname]), [501])
+
+    def test_index_lengths_app(self):
+
+        index_lengths.main([
+            '', '--trajectories', self.trj_fname, get_fn('frame0.h5'),
+            '--index', self.index_fname, '--processes', '2'])
+
+        assert_equals(
+            LengthIndex(self.index_fname).lookup(
+                [self.trj_fname, get_fn('frame0.h5')]),
+            [501, 501])
+
+
+class TestCoordinateCache(unittest.TestCase):
+
+    def setUp(self):
+        self.td = tempfile.mkdtemp()
+        self.trj_fname = os.path.join(self.td, 'frame0.xtc')
+        shutil.copy(get_fn('frame0.xtc'), self.trj_fname)
+        self.cache_dir = os.path.join(self.td, 'cache')
+        self.top = md.load(get_fn('native.pdb')).top
+        self.selection = np.array([1, 3, 6])
+
+    def tearDown(self):
+        shutil.rmtree(self.td)
+
+    def load(self, **kwargs):
+        return load_as_concatenated(
+            [self.trj_fname, get_fn('frame0.h5')], top=self.top,
+            atom_indices=self.selection, stride=2, processes=2, **kwargs)
+
+    def test_coordinate_cache(self):
+
+        cache = CoordinateCache(self.cache_dir)
+        lengths, expected = self.load()
+
+        # the first load fills the cache
+        lengths, xyz = self.load(cache=cache)
+        assert_array_equal(xyz, expected)
+        assert_array_equal(
+            cache.get(self.trj_fname, self.selection, 2), expected[:251])
+        assert_is(cache.get(self.trj_fname, self.selection, 1), None)
+        assert_is(cache.get(self.trj_fname, None, 2), None)
+
+        # later loads read from it (even in pieces), so a bogus entry
+        # is read back.
+        cache.put(self.trj_fname, np.zeros_like(expected[:251]),
+                  self.selection, 2)
+        for piece_size in [None, 40]:
+            lengths, xyz = self.load(cache=cache, piece_size=piece_size)
+            assert_array_equal(xyz[:251], 0)
+            assert_array_equal(xyz[251:], expected[251:])
+
+        # ... unless the trajectory has changed since
+        st = os.stat(self.trj_fname)
+        os.utime(self.trj_fname, ns=(st.st_atime_ns, st.st_mtime_ns + 1))
+        lengths, xyz = self.load(cache=cache)
+        assert_array_equal(xyz, expected)
+
+    def test_coordinate_cache_eviction(self):
+
+        cache = CoordinateCache(self.cache_dir)
+        xyz = np.zeros((10, 3, 3), dtype=np.float32)
+
+        strides = [1, 2, 3]
+        for i, stride in enumerate(strides):
+            cache.put(self.trj_fname, xyz, self.selection, stride)
+            entry = cache._entry(self.trj_fname, self.selection, stride)
+            os.utime(entry, (1000 + i, 1000 + i))
+        entry_bytes = os.path.getsize(entry)
+
+        # reading the oldest entry makes it the most recently used
+        cache.get(self.trj_fname, self.selection, 1)
+
+        assert_equals(cache.prune(3 * entry_bytes), 0)
+        assert_equals(cache.prune(2 * entry_bytes), 1)
+        assert_true((self.trj_fname, self.selection, 1) in cache)
+        assert_true((self.trj_fname, self.selection, 2) not in cache)
+        assert_true((self.trj_fname, self.selection, 3) in cache)
+
+        assert_equals(cache.clear(), 2)
+        assert_equals(os.listdir(self.cache_dir), [])
+
+        # a capped cache evicts as entries are added
+        cache = CoordinateCache(self.cache_dir, max_bytes=2 * entry_bytes)
+        for i, stride in enumerate(strides):
+            cache.put(self.trj_fname, xyz, self.selection, stride)
+            entry = cache._entry(self.trj_fname, self.selection, stride)
+            os.utime(entry, (1000 + i, 1000 + i))
+
+        assert_true((self.trj_fname, self.selection, 1) not in cache)
+        assert_true((self.trj_fname, self.selection, 2) in cache)
+        assert_true((self.trj_fname, self.selection, 3) in cache)
+
+    def test_coordinate_cache_environment(self):
+
+        os.environ[COORDINATE_CACHE_ENV] = self.cache_dir
+        try:
+            lengths, xyz = self.load()
+        finally:
+            del os.environ[COORDINATE_CACHE_ENV]
+
+        assert_array_equal(
+            CoordinateCache(self.cache_dir).get(
+                get_fn('frame0.h5'), self.selection, 2), xyz[251:])
+
+
 class TestConcatenateTrajs(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,276 @@
+from __future__ import print_function, division, absolute_import
+
+import os
+import tempfile
+
+import numpy as np
+import mdtraj as md
+import tables
+
+from mdtraj.testing import get_fn
+
+from nose.tools import assert_equal, assert_raises
+from numpy.testing import assert_array_equal, assert_allclose
+
+from ..cluster import kcenters, kmedoids
+from ..cluster.hybrid import KHybrid, hybrid
+from ..cluster.kcenters import KCenters
+from ..exception import DataInvalid, ImproperlyConfigured
+from ..geometry import libdist
+from ..util import CoordinateStore, SharedCoordinates, TrajectoryStore
+
+
+def test_store_indexing():
+
+    X = np.random.RandomState(0).normal(size=(103, 3)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'coords.dat')
+        X.tofile(fname)
+
+        with CoordinateStore.from_memmap(fname, X.shape,
+                                         block_size=10) as store:
+            assert_equal(len(store), len(X))
+            assert_equal(store.shape, X.shape)
+            assert_equal(store.dtype, X.dtype)
+
+            assert_array_equal(store[5], X[5])
+            assert_array_equal(store[10:20], X[10:20])
+            assert_array_equal(store[[7, 3, 7, 100]], X[[7, 3, 7, 100]])
+            assert_array_equal(store[X[:, 0] > 0], X[X[:, 0] > 0])
+            assert_equal(store[[]].shape, (0, 3))
+
+            starts = []
+            for start, block in store.iter_blocks():
+                starts.append(start)
+                assert_array_equal(block, X[start:start+10])
+            assert_equal(starts, list(range(0, 103, 10)))
+
+    with assert_raises(ImproperlyConfigured):
+        CoordinateStore(X, block_size=0)
+
+
+def test_store_hdf5():
+
+    X = np.random.RandomState(0).normal(size=(50, 4, 3)).astype(np.float32)
+
+    with tempfile.TemporaryDirectory() as tdname:
+        fname = os.path.join(tdname, 'coords.h5')
+        with tables.open_file(fname, 'w') as handle:
+            handle.create_array('/', 'coordinates', obj=X)
+
+        with CoordinateStore.from_hdf5(fname, block_size=7) as store:
+            assert_array_equal(store[[49, 0, 3]], X[[49, 0, 3]])
+            assert_array_equal(
+                np.concatenate([b for _, b in store.iter_blocks()]), X)
+
+
+def test_store_kcenters_euclidean():
+
+    X = np.random.RandomState(0).normal(size=(500, 3))
+
+    expected = kcenters.kcenters(X, libdist.euclidean, n_clusters=10)
+    result = kcenters.kcenters(
+        CoordinateStore(X, block_size=64), libdist.euclidean, n_clusters=10)
+
+    assert_array_equal(result.center_indices, expected.center_indices)
+    assert_array_equal(result.assignments, expected.assignments)
+    assert_allclose(result.distances, expected.distances)
+
+
+def test_store_khybrid_rmsd():
+
+    xyz = md.load(get_fn('frame0.h5')).xyz.astype(np.float64)
+    store = CoordinateStore(xyz, block_size=100)
+
+    expected = KHybrid(metric='rmsd', n_clusters=5, kmedoids_updates=3,
+                       random_state=0).fit(xyz)
+    result = KHybrid(metric='rmsd', n_clusters=5, kmedoids_updates=3,
+                     random_state=0).fit(store)
+
+    assert_array_equal(result.center_indices_, expected.center_indices_)
+    assert_array_equal(result.labels_, expected.labels_)
+    assert_allclose(result.distances_, expected.distances_, atol=1e-5)
+    assert_allclose(result.centers_, expected.centers_)
+
+    predicted = result.predict(store)
+    expected = result.predict(xyz)
+    assert_array_equal(predicted.assignments, expected.assignments)
+    assert_allclose(predicted.distances, expected.distances, atol=1e-5)
+
+
+def test_store_kmedoids_distances_to_centers():
+
+    X = np.random.RandomState(0).normal(size=(200, 3))
+    centers = [X[0], X[10], X[20]]
+
+    assert_allclose(
+        kmedoids._distances_to_centers(
+            CoordinateStore(X, block_size=32), libdist.euclidean, centers),
+        kmedoids._distances_to_centers(X, libdist.euclidean, centers))
+
+
+def test_trajectory_store():
+
+    trj = md.load(get_fn('frame0.xtc'), top=get_fn('native.pdb'))
+    atom_indices = trj.top.select('name CA')
+    xyz = trj.atom_slice(atom_indices).xyz
+
+    store = TrajectoryStore(
+        [get_fn('frame0.xtc'), get_fn('frame0.xtc')], top=get_fn('native.pdb'),
+        atom_indices=atom_indices, block_size=150)
+    expected = np.concatenate([xyz, xyz])
+
+    assert_equal(store.shape, expected.shape)
+    assert_array_equal(store[len(xyz) + 3], expected[len(xyz) + 3])
+    assert_allclose(store[[len(xyz) + 1, 2]], expected[[len(xyz) + 1, 2]])
+
+    # frames from both files, out of order and repeated, and spanning
+    # several chunks of the first file
+    inds = [len(xyz) + 7, 400, 3, len(xyz) + 7, 160, 3]
+    assert_array_equal(store[inds], expected[inds])
+    assert_array_equal(store[len(xyz) - 2:len(xyz) + 2],
+                       expected[len(xyz) - 2:len(xyz) + 2])
+
+    blocks = list(store.iter_blocks())
+    starts = list(range(0, len(xyz), 150))
+    assert_equal([s for s, _ in blocks],
+                 starts + [len(xyz) + s for s in starts])
+    assert_array_equal(np.concatenate([b for _, b in blocks]), expected)
+
+
+def test_trajectory_store_kcenters():
+
+    trj = md.load(get_fn('frame0.xtc'), top=get_fn('native.pdb'))
+    atom_indices = trj.top.select('name CA')
+
+    expected = KCenters(metric='rmsd', n_clusters=10).fit(
+        trj.atom_slice(atom_indices))
+    result = KCenters(metric='rmsd', n_clusters=10).fit(TrajectoryStore(
+        [get_fn('frame0.xtc')], top=get_fn('native.pdb'),
+        atom_indices=atom_indices, block_size=100))
+
+    assert_array_equal(result.center_indices_, expected.center_indices_)
+    assert_array_equal(result.labels_, expected.labels_)
+    assert_allclose(result.distances_, expected.distances_, atol=1e-5)
+
+
+def _block_sum(block, offset):
+    return block.sum(axis=1) + offset
+
+
+def test_shared_coordinates():
+
+    X = np.random.RandomState(0).normal(size=(103, 3))
+
+    with SharedCoordinates(X, n_procs=3) as shared:
+        assert_equal(shared.shape, X.shape)
+        assert_equal(shared.block_size, 35)
+        assert_array_equal(shared[[7, 3, 100]], X[[7, 3, 100]])
+
+        results = list(shared.map_blocks(_block_sum, 1))
+        assert_equal([start for start, _ in results], [0, 35, 70])
+        assert_allclose(
+            np.concatenate([sums for _, sums in results]),
+            X.sum(axis=1) + 1)
+
+    with assert_raises(ImproperlyConfigured):
+        SharedCoordinates(X, n_procs=0)
+
+
+def _block_sum_into(block, out, labels, offset):
+    out[0] = block.sum(axis=1) + offset
+    labels[:] = np.argmax(block, axis=1)
+    return out[0].max()
+
+
+def _block_rmsd(block, center):
+    assert isinstance(block, libdist.PreparedCoordinates)
+    return libdist.rmsd(block, center)
+
+
+def test_shared_coordinates_into():
+
+    X = np.random.RandomState(0).normal(size=(103, 3))
+
+    for store in [CoordinateStore(X, block_size=35),
+                  SharedCoordinates(X, n_procs=3)]:
+        with store as X_store:
+            out, labels = X_store.empty_outputs(1)
+            results = list(X_store.map_blocks_into(
+                _block_sum_into, out, labels, 1))
+
+            # only the block maxima come back
+            assert_equal([start for start, _ in results], [0, 35, 70])
+            assert_allclose([m for _, m in results],
+                            [out[0, i:i+35].max() for i in [0, 35, 70]])
+            assert_allclose(out[0], X.sum(axis=1) + 1)
+            assert_array_equal(labels, np.argmax(X, axis=1))
+
+    with SharedCoordinates(X, n_procs=2, n_outputs=2) as shared:
+        with assert_raises(ImproperlyConfigured):
+            shared.empty_outputs(3)
+
+        out, labels = shared.empty_outputs(2)
+        with assert_raises(DataInvalid):
+            list(shared.map_blocks_into(
+                _block_sum_into, np.empty_like(out), labels, 1))
+        with assert_raises(DataInvalid):
+            list(shared.map_blocks_into(_block_sum_into, out[1:], labels, 1))
+
+
+def test_shared_coordinates_prepared():
+
+    trj = md.load(get_fn('frame0.h5'))
+
+    with SharedCoordinates(trj, n_procs=2, prepare=True) as shared:
+        # the store holds the centered coordinates
+        assert_allclose(shared[10].mean(axis=0), 0, atol=1e-5)
+        assert_equal(len(shared[10]), trj.n_atoms)
+
+        dists = np.concatenate([d for _, d in shared.map_blocks(
+            _block_rmsd, libdist.PreparedCoordinates(trj[3]))])
+
+    assert_allclose(dists, md.rmsd(trj, trj, 3), atol=1e-5)
+
+
+def test_shared_coordinates_hybrid():
+
+    X = np.random.RandomState(0).normal(size=(500, 3))
+
+    expected = hybrid(X, libdist.euclidean, n_clusters=10, n_iters=2,
+                      random_state=np.random.RandomState(0), batch_size=3)
+    result = hybrid(X, libdist.euclidean, n_clusters=10, n_iters=2,
+                    random_state=np.random.RandomState(0), batch_size=3,
+                    n_procs=2)
+
+    assert_array_equal(result.center_indices, expected.center_indices)
+    assert_array_equal(result.assignments, expected.assignments)
+    assert_allclose(result.distances, expected.distances)
+    assert_array_equal(result.centers, expected.centers)
+
+    np.random.seed(0)
+    expected = kmedoids.kmedoids(X, libdist.euclidean, n_clusters=10,
+                                 n_iters=2)
+    np.random.seed(0)
+    result = kmedoids.kmedoids(X, libdist.euclidean, n_clusters=10,
+                               n_iters=2, n_procs=2)
+
+    assert_array_equal(result.center_indices, expected.center_indices)
+    assert_array_equal(result.assignments, expected.assignments)
+    assert_allclose(result.distances, expected.distances)
+
+
+def test_shared_coordinates_khybrid_rmsd():
+
+    trj = md.load(get_fn('frame0.h5'))
+
+    expected = KHybrid(metric='rmsd', n_clusters=5, kmedoids_updates=3,
+                       random_state=0).fit(trj)
+    result = KHybrid(metric='rmsd', n_clusters=5, kmedoids_updates=3,
+                     random_state=0, n_procs=2).fit(trj)
+
+    assert_array_equal(result.center_indices_, expected.center_indices_)
+    assert_array_equal(result.labels_, expected.labels_)
+    assert_allclose(result.distances_, expected.distances_, atol=1e-5)
+    assert_allclose(result.centers_.xyz, trj.xyz[result.center_indices_])
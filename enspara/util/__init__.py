@@ -1,5 +1,7 @@
 from __future__ import print_function, division, absolute_import
 
 from .array import partition_indices, partition_list
-from .load import load_as_concatenated
+from .load import (load_as_concatenated, iterload_blocks, CoordinateCache,
+                   LengthIndex)
 from .parallel import pool_dense2d, pool_sparse2d
+from .store import CoordinateStore, SharedCoordinates, TrajectoryStore
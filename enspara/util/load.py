@@ -1,10 +1,17 @@
+import errno
+import hashlib
 import logging
 import math
+import mmap
+import os
+import sqlite3
+import threading
 
 import multiprocessing as mp
-from contextlib import closing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, suppress
 from functools import partial, reduce
-import ctypes
 from operator import mul
 
 import numpy as np
@@ -18,7 +25,287 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def sound_trajectory(trj, stride=1, frame=None):
+LENGTH_INDEX_ENV = 'ENSPARA_LENGTH_INDEX'
+
+
+class LengthIndex(object):
+    """An on-disk index of trajectory lengths, so that they only need to
+    be sounded once.
+
+    The index is a small SQLite database mapping each trajectory's
+    absolute path to its length in frames. An entry is only used if the
+    file's size and modification time still match those recorded with
+    it, so trajectories that are rewritten (or still being appended to)
+    are sounded again. Many processes (e.g. MPI ranks) may read and
+    update the same index.
+
+    Parameters
+    ----------
+    path : str
+        Path to the index. It is created if it doesn't exist.
+    timeout : float, default=60
+        Seconds to wait for another process to finish updating the
+        index before giving up.
+    """
+
+    def __init__(self, path, timeout=60):
+        self.path = path
+        self.timeout = timeout
+
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS lengths ("
+                "path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                "n_frames INTEGER)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=self.timeout)
+
+    def lookup(self, filenames):
+        """Look up the lengths of trajectories.
+
+        Parameters
+        ----------
+        filenames : list
+            Paths to the trajectories.
+
+        Returns
+        -------
+        n_frames : list
+            The length in frames (without striding) of each trajectory,
+            or None for those that aren't in the index or have changed
+            since they were indexed.
+        """
+
+        n_frames = []
+        with closing(self._connect()) as conn:
+            for filename in filenames:
+                path, size, mtime = _file_signature(filename)
+                row = conn.execute(
+                    "SELECT size, mtime, n_frames FROM lengths "
+                    "WHERE path = ?", (path,)).fetchone()
+                if row is not None and row[:2] == (size, mtime):
+                    n_frames.append(row[2])
+                else:
+                    n_frames.append(None)
+
+        return n_frames
+
+    def record(self, filenames, n_frames):
+        """Record the lengths of trajectories in the index.
+
+        Parameters
+        ----------
+        filenames : list
+            Paths to the trajectories.
+        n_frames : list
+            The length in frames (without striding) of each trajectory.
+        """
+
+        rows = [_file_signature(f) + (int(n),)
+                for f, n in zip(filenames, n_frames)]
+
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO lengths VALUES (?, ?, ?, ?)", rows)
+
+
+def _file_signature(filename):
+    st = os.stat(filename)
+    return os.path.abspath(filename), st.st_size, st.st_mtime_ns
+
+
+def _get_length_index(index):
+    """Get the LengthIndex to use from `index`, which may be a
+    LengthIndex, a path to one, or None, in which case the path in the
+    ENSPARA_LENGTH_INDEX environment variable, if it is set, is used.
+    """
+
+    if index is None:
+        index = os.environ.get(LENGTH_INDEX_ENV)
+        if not index:
+            return None
+
+    if isinstance(index, LengthIndex):
+        return index
+
+    return LengthIndex(index)
+
+
+COORDINATE_CACHE_ENV = 'ENSPARA_COORDINATE_CACHE'
+
+
+class CoordinateCache(object):
+    """A directory of trajectories' coordinates, decoded and sliced to
+    a selection, so that they can be read back at disk speed.
+
+    Each entry holds the float32 coordinates of one trajectory, loaded
+    with particular `atom_indices` and `stride`, as an .npy file that
+    is memory-mapped when it is read. Entries are keyed by the
+    trajectory's absolute path, size and modification time as well as
+    the atom indices and stride, so a trajectory that is rewritten is
+    loaded from disk again.
+
+    Entries of trajectories that have changed are never read again, but
+    stay on disk until they are evicted. If `max_bytes` is given, the
+    least recently used entries are evicted whenever an entry is added
+    and the cache is over that size; otherwise, use `prune` or `clear`.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to keep the entries in. It is created if it doesn't
+        exist.
+    max_bytes : int, default=None
+        Evict the least recently used entries to keep the cache under
+        this many bytes.
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, filename, atom_indices, stride):
+        key = hashlib.sha1(repr(
+            _file_signature(filename) + (int(stride),)).encode())
+        if atom_indices is not None:
+            key.update(np.asarray(atom_indices, dtype=np.int64).tobytes())
+        else:
+            key.update(b'all atoms')
+
+        return os.path.join(self.directory, key.hexdigest() + '.npy')
+
+    def __contains__(self, key):
+        filename, atom_indices, stride = key
+        return os.path.exists(self._entry(filename, atom_indices, stride))
+
+    def get(self, filename, atom_indices=None, stride=1):
+        """Get a trajectory's coordinates from the cache.
+
+        Returns
+        -------
+        xyz : np.memmap, shape=(n_frames, n_atoms, 3) or None
+            The (read-only) coordinates, or None if they aren't cached.
+        """
+
+        entry = self._entry(filename, atom_indices, stride)
+        try:
+            xyz = np.load(entry, mmap_mode='r')
+            # the modification time of an entry is when it was last
+            # used, which is what `prune` evicts by.
+            os.utime(entry)
+        except FileNotFoundError:
+            return None
+
+        return xyz
+
+    def put(self, filename, xyz, atom_indices=None, stride=1):
+        """Add a trajectory's coordinates to the cache.
+        """
+
+        entry = self._entry(filename, atom_indices, stride)
+
+        # written under a temporary name and renamed, so other processes
+        # never read a partial entry.
+        tmp = '%s.%s.tmp' % (entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(xyz, dtype=np.float32))
+        os.replace(tmp, entry)
+
+        if self.max_bytes is not None:
+            self.prune(self.max_bytes)
+
+    def _entries(self):
+        """The path, size and last use of each entry in the cache.
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npy'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                # evicted by another process since the listing.
+                continue
+            entries.append((path, st.st_size, st.st_mtime))
+
+        return entries
+
+    def prune(self, max_bytes):
+        """Evict the least recently used entries until the cache takes
+        up at most `max_bytes`.
+
+        Entries are memory-mapped when read, so evicting one that is in
+        use doesn't affect the arrays already read from it.
+
+        Returns
+        -------
+        n_evicted : int
+            The number of entries evicted.
+        """
+
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+
+        n_evicted = 0
+        for path, size, _ in entries:
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+                n_evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        if n_evicted:
+            logger.debug("Evicted %s entries from coordinate cache %s.",
+                         n_evicted, self.directory)
+
+        return n_evicted
+
+    def clear(self):
+        """Evict every entry in the cache, and return how many there
+        were.
+        """
+
+        return self.prune(0)
+
+
+def _get_coordinate_cache(cache):
+    """Get the CoordinateCache to use from `cache`, which may be a
+    CoordinateCache, a path to one, or None, in which case the path in
+    the ENSPARA_COORDINATE_CACHE environment variable, if it is set, is
+    used.
+    """
+
+    if cache is None:
+        cache = os.environ.get(COORDINATE_CACHE_ENV)
+        if not cache:
+            return None
+
+    if isinstance(cache, CoordinateCache):
+        return cache
+
+    return CoordinateCache(cache)
+
+
+def _cache_key(filename, load_kwargs):
+    """The key of a trajectory loaded with `load_kwargs` in a
+    CoordinateCache, or None if it can't be cached.
+    """
+
+    if not set(load_kwargs) <= {'top', 'atom_indices', 'stride'}:
+        return None
+
+    return (filename, load_kwargs.get('atom_indices'),
+            load_kwargs.get('stride', 1))
+
+
+def sound_trajectory(trj, stride=1, frame=None, index=None):
     """Determine the length of a trajectory on disk.
 
     For H5 file formats, this is a trivial lookup of the shape parameter
@@ -33,6 +320,10 @@ def sound_trajectory(trj, stride=1, frame=None):
     ----------
     trj: file path
         Path to the trajectory to sound.
+    index : LengthIndex or str, default=None
+        A length index (or path to one) to look the length up in before
+        sounding the trajectory, and to record it in after. If None,
+        the index at $ENSPARA_LENGTH_INDEX is used, if that is set.
 
     Returns
     ----------
@@ -42,17 +333,81 @@ def sound_trajectory(trj, stride=1, frame=None):
 
     See Also
     ----------
-    md.load
+    md.load, sound_trajectories
     """
 
-    with md.open(trj) as f:
-        n_frames = len(f)
+    return sound_trajectories([trj], stride=stride, index=index)[0]
+
+
+def sound_trajectories(filenames, stride=1, processes=None, index=None):
+    """Determine the lengths of many trajectories on disk.
+
+    Trajectories whose lengths are in the length index are not opened,
+    and the rest are sounded in parallel and then recorded in the index
+    together.
+
+    Parameters
+    ----------
+    filenames : list
+        Paths to the trajectories to sound.
+    stride : int or list, default=1
+        The stride the trajectories will be loaded with, either for all
+        of them or for each one.
+    processes : int, default=None
+        The number of processes to sound trajectories with.
+    index : LengthIndex or str, default=None
+        A length index (or path to one) to look lengths up in and record
+        them in. If None, the index at $ENSPARA_LENGTH_INDEX is used, if
+        that is set.
+
+    Returns
+    -------
+    lengths : list
+        The length (in frames) of each trajectory, as though loaded with
+        `stride`.
+
+    See Also
+    --------
+    sound_trajectory, LengthIndex
+    """
+
+    filenames = list(filenames)
+    if np.isscalar(stride):
+        stride = [stride] * len(filenames)
+
+    index = _get_length_index(index)
+
+    if index is not None:
+        n_frames = index.lookup(filenames)
+    else:
+        n_frames = [None] * len(filenames)
+
+    missing = [i for i, n in enumerate(n_frames) if n is None]
+    logger.debug("Sounding %s of %s trajectories.", len(missing),
+                 len(filenames))
+
+    if len(missing) > 1 and processes != 1:
+        sounded = Parallel(n_jobs=processes)(
+            delayed(_count_frames)(filenames[i]) for i in missing)
+    else:
+        sounded = [_count_frames(filenames[i]) for i in missing]
+
+    for i, n in zip(missing, sounded):
+        n_frames[i] = n
+
+    if index is not None and missing:
+        index.record([filenames[i] for i in missing], sounded)
 
-    return math.ceil(n_frames / stride)
+    return [int(math.ceil(n / s)) for n, s in zip(n_frames, stride)]
+
+
+def _count_frames(trj):
+    with md.open(trj) as f:
+        return len(f)
 
 
 def load_as_concatenated(filenames, lengths=None, processes=None,
-                         args=None, **kwargs):
+                         args=None, piece_size=None, cache=None, **kwargs):
     '''Load many trajectories from disk into a single numpy array.
 
     Additional arguments to md.load are supplied as *args XOR **kwargs.
@@ -77,12 +432,28 @@ def load_as_concatenated(filenames, lengths=None, processes=None,
     args : list, optional
         A list of dictionaries, each of which corresponds to additional
         kwargs to be passed to each of filenames.
+    piece_size : int, optional
+        Trajectories longer than this many frames (after striding) are
+        split into pieces of at most this size, which are loaded
+        separately, so that a few long trajectories can be loaded by
+        many processes. Only trajectories in seekable formats that are
+        loaded with no kwargs but `top`, `atom_indices` and `stride` are
+        split. By default, the pieces are sized so that each process
+        gets several.
+    cache : CoordinateCache or str, optional
+        A coordinate cache (or path to one) to read trajectories from,
+        and to add those that aren't in it yet to. Trajectories loaded
+        with kwargs other than `top`, `atom_indices` and `stride` aren't
+        cached. If None, the cache at $ENSPARA_COORDINATE_CACHE is used,
+        if that is set.
 
     Returns
     -------
     (lengths, xyz) : tuple
        A 2-tuple of trajectory lengths (list of ints, frames) and
-       coordinates (ndarray, shape=(n_atoms, n_frames, 3)).
+       coordinates (ndarray, shape=(n_atoms, n_frames, 3)). The
+       coordinates are loaded directly into the memory of the returned
+       array, so there is no need to copy it.
 
     See Also
     --------
@@ -115,10 +486,11 @@ def load_as_concatenated(filenames, lengths=None, processes=None,
     if lengths is None:
         logger.debug("Sounding %s trajectories with %s processes.",
                      len(filenames), processes)
-        lengths = Parallel(n_jobs=processes)(
-            delayed(sound_trajectory)(f, kw.get('stride', 1))
-            for f, kw in zip(filenames, args)
-            if 'frame' not in kw) # don't sound trjs with 'frame' kw
+        lengths = sound_trajectories(
+            [f for f, kw in zip(filenames, args) if 'frame' not in kw],
+            stride=[kw.get('stride', 1) for kw in args
+                    if 'frame' not in kw],
+            processes=processes)  # don't sound trjs with 'frame' kw
 
         # trjs with frame are always length 1, add that to lengths now
         for i, kw in enumerate(args):
@@ -138,15 +510,26 @@ def load_as_concatenated(filenames, lengths=None, processes=None,
 
     logger.debug("Allocated array of shape %s", full_shape)
 
+    cache = _get_coordinate_cache(cache)
+
+    tasks = _plan_load_tasks(
+        filenames, args, lengths,
+        n_procs=processes if processes is not None else mp.cpu_count(),
+        piece_size=piece_size, cache=cache)
+
+    logger.debug("Loading %s trajectories in %s pieces.", len(filenames),
+                 len(tasks))
+
+    # tasks are handed out one at a time, largest first, as workers
+    # become free, so that no worker is left loading a long trajectory
+    # while the others sit idle.
     with closing(mp.Pool(processes=processes, initializer=_init,
                          initargs=(shared_array,))) as p:
-        proc = p.map_async(
-            partial(_load_to_position, arr_shape=full_shape),
-            zip([sum(lengths[0:i]) for i in range(len(lengths))],
-                filenames, args))
-
-    # gather exceptions.
-    shapes = proc.get()
+        # gather exceptions.
+        shapes = list(p.imap_unordered(
+            partial(_load_to_position, arr_shape=full_shape, cache=cache),
+            tasks,
+            chunksize=1))
 
     if sum(s[0] for s in shapes) != full_shape[0]:
         raise exception.DataInvalid(
@@ -162,6 +545,156 @@ def load_as_concatenated(filenames, lengths=None, processes=None,
     return lengths, xyz
 
 
+def iterload_blocks(filenames, block_size, top=None, atom_indices=None,
+                    stride=1, lengths=None, prefetch=2, max_memory=None):
+    """Iterate over the frames of many trajectories in blocks of a fixed
+    number of frames.
+
+    The trajectories are treated as one concatenated trajectory, so a
+    block may span several files; only the last block is smaller than
+    `block_size`. The next `prefetch` blocks are loaded in background
+    threads while the current one is being processed, so that reading
+    overlaps with computing.
+
+    Parameters
+    ----------
+    filenames : list
+        Paths to the trajectory files, in order.
+    block_size : int
+        The number of frames in each block.
+    top : str or md.Topology, optional
+        Topology of the trajectories, if their format doesn't include
+        one.
+    atom_indices : array-like, optional
+        Load only these atoms (e.g. an atom selection).
+    stride : int, default=1
+        Load only every stride-th frame of each trajectory.
+    lengths : list, optional
+        The lengths of the trajectories (after striding). If None, they
+        are sounded with `sound_trajectories`.
+    prefetch : int, default=2
+        The number of blocks loading (or loaded, and waiting) in
+        background threads at once, including the next one to be
+        yielded, so `prefetch` - 1 blocks load while the caller
+        processes one. If 0, each block is loaded only when it's
+        requested.
+    max_memory : int, optional
+        Load fewer blocks at once if needed to keep the blocks in
+        memory under this many bytes. These are the ones loading, the
+        one being processed, and the one processed before it, which is
+        still referenced while the next is requested. At least one
+        block is always loaded in the background if `prefetch` > 0.
+
+    Yields
+    ------
+    traj_index : int
+        The index in `filenames` of the trajectory of the block's first
+        frame.
+    frame_offset : int
+        The index of the block's first frame in that trajectory (after
+        striding). The rest of the block's frames follow it through the
+        end of that trajectory and into the next ones.
+    xyz : np.ndarray, shape=(<=block_size, n_atoms, 3)
+        The coordinates of the block's frames.
+
+    See Also
+    --------
+    load_as_concatenated, enspara.util.store.TrajectoryStore
+    """
+
+    filenames = list(filenames)
+
+    if block_size < 1:
+        raise exception.ImproperlyConfigured(
+            "Block size must be positive, got %s." % block_size)
+
+    if lengths is None:
+        lengths = sound_trajectories(filenames, stride=stride)
+    elif len(lengths) != len(filenames):
+        raise exception.ImproperlyConfigured(
+            "Lengths list (len %s) didn't match length of filenames list "
+            "(len %s)" % (len(lengths), len(filenames)))
+
+    blocks = _plan_blocks(lengths, block_size)
+    load_kwargs = {'atom_indices': atom_indices, 'stride': stride}
+    if top is not None:
+        load_kwargs['top'] = top
+
+    if prefetch > 0 and max_memory is not None and blocks:
+        n_atoms = len(md.load(filenames[0], frame=0, top=top,
+                              atom_indices=atom_indices).xyz[0])
+        block_bytes = block_size * n_atoms * 3 * np.dtype(np.float32).itemsize
+        prefetch = min(prefetch, max(1, max_memory // block_bytes - 2))
+
+    if prefetch < 1:
+        for pieces in blocks:
+            yield (pieces[0][0], pieces[0][1],
+                   _load_block(filenames, pieces, load_kwargs))
+        return
+
+    # each block is loaded in a thread of its own, and at most
+    # `prefetch` are loading (or loaded, and waiting) at once.
+    with ThreadPoolExecutor(max_workers=prefetch) as executor:
+        pending = deque()
+        try:
+            for pieces in blocks:
+                pending.append((pieces[0], executor.submit(
+                    _load_block, filenames, pieces, load_kwargs)))
+                if len(pending) >= prefetch:
+                    yield _next_block(pending)
+            while pending:
+                yield _next_block(pending)
+        finally:
+            # don't load blocks no one will ask for, if the caller
+            # stopped early.
+            for _, future in pending:
+                future.cancel()
+
+
+def _next_block(pending):
+    (traj_index, frame_offset, _), future = pending.popleft()
+    return traj_index, frame_offset, future.result()
+
+
+def _plan_blocks(lengths, block_size):
+    """Divide trajectories of the given lengths into blocks of
+    `block_size` frames.
+
+    Returns
+    -------
+    blocks : list
+        For each block, a list of the pieces (traj_index, start, stop)
+        of trajectories it consists of, in order.
+    """
+
+    blocks = []
+    pieces, n_frames = [], 0
+    for traj_index, length in enumerate(lengths):
+        start = 0
+        while start < length:
+            stop = min(length, start + block_size - n_frames)
+            pieces.append((traj_index, start, stop))
+            n_frames += stop - start
+            start = stop
+            if n_frames == block_size:
+                blocks.append(pieces)
+                pieces, n_frames = [], 0
+
+    if pieces:
+        blocks.append(pieces)
+
+    return blocks
+
+
+def _load_block(filenames, pieces, load_kwargs):
+    """Load the frames of a block, as planned by `_plan_blocks`.
+    """
+
+    return np.concatenate([
+        _load_frame_range(filenames[traj_index], start, stop, **load_kwargs)
+        for traj_index, start, stop in pieces])
+
+
 def concatenate_trjs(trj_list, atoms=None, n_procs=None):
     """Convert a list of trajectories into a single trajectory building
     a concatenated array in parallel.
@@ -205,30 +738,49 @@ def concatenate_trjs(trj_list, atoms=None, n_procs=None):
 
 
 def shared_array_like_trj(lengths, example_trj):
+    """Allocate memory, shared with forked worker processes, for the
+    concatenated coordinates of trajectories with `lengths` frames.
+
+    The memory is an anonymous shared mapping rather than an mp.Array,
+    whose heap is a zero-filled file in the temporary directory. An
+    array viewing it (see `_tonumpyarray`) is an ordinary, writable
+    ndarray that keeps the mapping alive, and the mapping is released
+    when the last array viewing it is, so it can be returned to the
+    caller as is, without copying it out.
+
+    Parameters
+    ----------
+    lengths : list
+        The lengths of the trajectories, in frames.
+    example_trj : md.Trajectory
+        A trajectory with the atoms of the trajectories.
+
+    Returns
+    -------
+    full_shape : tuple, shape=(3,)
+        The shape of the concatenated coordinates.
+    shared_array : mmap.mmap
+        The shared memory, sized for `full_shape` float32s.
+    """
 
-    # when we allocate the shared array below, we expect a float32
-    # c_double seems to work with trajectories that use float32s. Why?
-    # I have no idea.
     assert example_trj.xyz.dtype == np.float32
     shape = example_trj.xyz.shape
 
     # TODO: check all inputs against root
 
     full_shape = (sum(lengths), shape[1], shape[2])
+    arr_bytes = reduce(mul, full_shape, 1) * np.dtype(np.float32).itemsize
 
-    # mp.Arrays are one-dimensional, so multiply the shape together for size
+    # the mapping is private to this process tree, and inherited (not
+    # pickled) by the pool's workers.
     try:
-        dtype = ctypes.c_float
-        shared_array = mp.Array(dtype, reduce(mul, full_shape, 1),
-                                lock=False)
+        shared_array = mmap.mmap(-1, max(arr_bytes, 1))
     except OSError as e:
-        if e.args[0] != 28:
+        if e.errno not in (errno.ENOMEM, errno.ENOSPC):
             raise
-        arr_bytes = reduce(mul, full_shape, 1) * ctypes.sizeof(dtype)
         raise exception.InsufficientResourceError(
-            ("Couldn't allocate array of size %.2f GB. Run df -h to "
-             "ensure that shared memory (/tmp/shm or similar) can "
-             "accommodate an array of this size.") % (arr_bytes / 1024**3))
+            "Couldn't allocate array of size %.2f GB." %
+            (arr_bytes / 1024**3))
 
     return full_shape, shared_array
 
@@ -275,24 +827,147 @@ def _init(shared_array_):
     shared_array = shared_array_
 
 
-def _tonumpyarray(mp_arr, dtype='float32'):
-    # mp_arr.get_obj if Array is locking, otherwise mp_arr.
-    return np.frombuffer(mp_arr, dtype=dtype)
+def _tonumpyarray(shared_array, dtype='float32'):
+    # a view of the whole mapping, which may be a byte longer than the
+    # array if it's empty.
+    count = len(shared_array) // np.dtype(dtype).itemsize
+    return np.frombuffer(shared_array, dtype=dtype, count=count)
+
+
+def _plan_load_tasks(filenames, args, lengths, n_procs, piece_size=None,
+                     cache=None):
+    """Divide loading trajectories into tasks for `_load_to_position`.
+
+    Trajectories longer than `piece_size` frames are split into pieces
+    if they can be (see `_splittable`). With a `cache`, trajectories
+    that can be cached are split only if they are in it already, since
+    only whole trajectories are added to it. By default, pieces are
+    sized so
+    that there are about four per process, but no smaller than
+    _MIN_PIECE_FRAMES, below which seeking costs more than it saves.
+
+    Returns
+    -------
+    tasks : list
+        Specs (position, filename, load_kwargs, start, stop), largest
+        first. `start` and `stop` are None for whole trajectories.
+    """
+
+    offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(int)
+
+    if piece_size is None:
+        piece_size = max(_MIN_PIECE_FRAMES,
+                         int(math.ceil(offsets[-1] / (4 * n_procs))))
+
+    tasks, sizes = [], []
+    for offset, filename, kw, length in zip(
+            offsets, filenames, args, lengths):
+        key = _cache_key(filename, kw) if cache is not None else None
+        if key is not None:
+            split = key in cache
+        else:
+            split = _splittable(filename, kw)
+
+        if length > piece_size and split:
+            for start in range(0, length, piece_size):
+                stop = min(start + piece_size, length)
+                tasks.append((offset + start, filename, kw, start, stop))
+                sizes.append(stop - start)
+        else:
+            tasks.append((offset, filename, kw, None, None))
+            sizes.append(length)
+
+    # every trajectory has the same atoms, so frames are a fair measure
+    # of the work in a task.
+    order = np.argsort(-np.array(sizes), kind='mergesort')
+
+    return [tasks[i] for i in order]
+
+
+_MIN_PIECE_FRAMES = 1000
 
+# formats mdtraj can seek in without reading the frames before
+_SEEKABLE_EXTS = ('.xtc', '.trr', '.dcd', '.h5', '.nc', '.binpos')
 
-def _load_to_position(spec, arr_shape):
+
+_HDF5_LOCK = threading.Lock()
+_NO_LOCK = suppress()
+
+
+def _splittable(filename, load_kwargs):
+    """Can this trajectory be loaded in pieces by `_load_frame_range`?
+    """
+
+    return (os.path.splitext(filename)[1] in _SEEKABLE_EXTS and
+            set(load_kwargs) <= {'top', 'atom_indices', 'stride'})
+
+
+def _load_to_position(spec, arr_shape, cache=None):
     '''
-    Load a specified file into a specified position by spec. The
-    arr_shape parameter lets us know how big the final array should be.
+    Load a specified file (or frames [start, stop) of it) into a
+    specified position by spec. The arr_shape parameter lets us know how
+    big the final array should be. If the file is in the cache, it's
+    read from there, and if it can be cached, it's added.
     '''
-    (position, filename, load_kwargs) = spec
+    (position, filename, load_kwargs, start, stop) = spec
+
+    key = _cache_key(filename, load_kwargs) if cache is not None else None
+    cached = cache.get(*key) if key is not None else None
 
-    xyz = md.load(filename, **load_kwargs).xyz
+    if cached is not None:
+        xyz = cached[start:stop]
+    elif start is None:
+        xyz = md.load(filename, **load_kwargs).xyz
+        if key is not None:
+            cache.put(key[0], xyz, *key[1:])
+    else:
+        xyz = _load_frame_range(filename, start, stop, **load_kwargs)
 
-    # mp.Array must be converted to numpy array and reshaped
+    # the shared memory must be converted to numpy array and reshaped
     arr = _tonumpyarray(shared_array).reshape(arr_shape)
 
     # dump coordinates in.
     arr[position:position+len(xyz)] = xyz
 
     return xyz.shape
+
+
+def _load_frame_range(filename, start, stop, stride=1, chunk=1000,
+                      **kwargs):
+    """Load the coordinates of frames [start, stop) of a trajectory
+    strided by `stride`.
+
+    Additional keyword args are passed on to `md.iterload`, which seeks
+    to the first frame rather than reading the frames before it. Files
+    in other formats are loaded whole, and sliced.
+    """
+
+    if os.path.splitext(filename)[1] not in _SEEKABLE_EXTS:
+        xyz = md.load(filename, stride=stride, **kwargs).xyz[start:stop]
+        if len(xyz) < stop - start:
+            raise exception.DataInvalid(
+                "Trajectory %s ended before frame %s (with stride %s)." %
+                (filename, stop, stride))
+        return xyz
+
+    # PyTables isn't thread-safe, so threads take turns reading HDF5.
+    lock = _HDF5_LOCK if filename.endswith('.h5') else _NO_LOCK
+
+    # iterload is given no stride, which it doesn't combine reliably
+    # with skip, so the frames are strided here.
+    n_frames = stop - start
+    xyz = []
+    with lock:
+        for trj in md.iterload(filename, chunk=chunk * stride,
+                               skip=start * stride, **kwargs):
+            xyz.append(trj.xyz[::stride])
+            n_frames -= len(xyz[-1])
+            if n_frames <= 0:
+                break
+
+    if n_frames > 0:
+        raise exception.DataInvalid(
+            "Trajectory %s ended before frame %s (with stride %s)." %
+            (filename, stop, stride))
+
+    return np.concatenate(xyz)[:stop-start]
@@ -0,0 +1,595 @@
+"""Disk-backed coordinate stores for clustering data sets that don't fit
+in memory.
+
+A `CoordinateStore` wraps an array that lives on disk (an np.memmap or
+an HDF5 dataset) and reads it a block of frames at a time, prefetching
+the next block in a background thread while the current one is being
+processed. A `TrajectoryStore` does the same for a list of trajectory
+files, reading them in chunks with `md.iterload`. The clustering code in
+`enspara.cluster` accepts a store anywhere it accepts an array, and
+streams it block by block for each pass over the data, so that only the
+per-frame distances and assignments and about two blocks of coordinates
+are resident at once.
+
+A `SharedCoordinates` store instead holds its coordinates in shared
+memory, and processes its blocks in parallel in a pool of worker
+processes that read them without copying.
+"""
+
+from __future__ import print_function, division, absolute_import
+
+import ctypes
+import logging
+import threading
+import multiprocessing as mp
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import mdtraj as md
+import tables
+
+from .. import exception
+from ..geometry import libdist
+from .load import sound_trajectories
+from .parallel import auto_nprocs
+
+logger = logging.getLogger(__name__)
+
+
+class CoordinateStore(object):
+    """Coordinates kept on disk and read a block of frames at a time.
+
+    Indexing a store with an integer, slice or list of indices reads
+    those frames into memory as an ndarray. `iter_blocks` streams the
+    whole store.
+
+    Parameters
+    ----------
+    data : array-like, shape=(n_frames, ...)
+        Disk-backed array with frames along axis 0, such as an
+        np.memmap or an HDF5 dataset (PyTables or h5py).
+    block_size : int, default=65536
+        Number of frames in each block. At most two blocks (the one
+        being processed and the one being prefetched) are in memory at
+        once.
+    prefetch : bool, default=True
+        Read the next block in a background thread while the current
+        one is being processed.
+
+    Examples
+    --------
+    >>> with CoordinateStore.from_hdf5('coords.h5') as X:
+    ...     clustering = KCenters(metric='rmsd', cluster_radius=0.2).fit(X)
+    """
+
+    # the most rows `empty_outputs` can allocate.
+    n_outputs = np.inf
+
+    def __init__(self, data, block_size=65536, prefetch=True):
+
+        if block_size < 1:
+            raise exception.ImproperlyConfigured(
+                "Block size must be positive, got %s." % block_size)
+
+        self._data = data
+        self.block_size = block_size
+        self.prefetch = prefetch
+
+        # readers like PyTables aren't thread-safe, so the prefetch
+        # thread and the caller never read at the same time.
+        self._lock = threading.Lock()
+        self._handle = None
+
+    @classmethod
+    def from_hdf5(cls, filename, node='/coordinates', **kwargs):
+        """Open the array at `node` in the HDF5 file `filename` as a
+        store. The file stays open until the store is closed.
+
+        Additional keyword args are passed on to the constructor.
+        """
+
+        handle = tables.open_file(filename, mode='r')
+        try:
+            store = cls(handle.get_node(node), **kwargs)
+        except Exception:
+            handle.close()
+            raise
+
+        store._handle = handle
+        return store
+
+    @classmethod
+    def from_memmap(cls, filename, shape, dtype=np.float32, offset=0,
+                    **kwargs):
+        """Open the raw binary array in `filename`, of the given `shape`
+        and `dtype` and starting `offset` bytes in, as a read-only
+        store.
+
+        Additional keyword args are passed on to the constructor.
+        """
+
+        data = np.memmap(filename, dtype=dtype, mode='r', shape=shape,
+                         offset=offset)
+        return cls(data, **kwargs)
+
+    @property
+    def shape(self):
+        return tuple(self._data.shape)
+
+    @property
+    def dtype(self):
+        return np.dtype(self._data.dtype)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if np.issubdtype(type(key), np.integer) or isinstance(key, slice):
+            return self._read(key)
+
+        inds = np.asarray(key)
+        if inds.dtype == bool:
+            inds = np.flatnonzero(inds)
+
+        # disk-backed arrays read fastest (and HDF5 only supports
+        # reading) in increasing order without repeats. The remaining
+        # axes are given explicitly, or PyTables takes the indices as
+        # point coordinates rather than as a selection along axis 0.
+        unique_inds, inverse = np.unique(inds, return_inverse=True)
+        if len(unique_inds) == 0:
+            return np.zeros((0,) + self.shape[1:], dtype=self.dtype)
+
+        key = (unique_inds.tolist(),) + (slice(None),) * (len(self.shape) - 1)
+        return self._read(key)[inverse.reshape(inds.shape)]
+
+    def _read(self, key):
+        with self._lock:
+            return np.ascontiguousarray(self._data[key])
+
+    def iter_blocks(self):
+        """Iterate over the store a block at a time.
+
+        Yields
+        ------
+        start : int
+            The index of the first frame in the block.
+        block : np.ndarray, shape=(<=block_size, ...)
+            The frames from `start` on.
+        """
+
+        blocks = self._blocks()
+
+        if not self.prefetch:
+            for start, block in blocks:
+                yield start, block
+            return
+
+        # the generator only ever advances in the one worker thread, so
+        # reading the next block overlaps with processing this one.
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = executor.submit(next, blocks, None)
+            while True:
+                item = pending.result()
+                if item is None:
+                    break
+                pending = executor.submit(next, blocks, None)
+                yield item
+
+    def _blocks(self):
+        for start in range(0, len(self), self.block_size):
+            yield start, self._read(slice(start, start+self.block_size))
+
+    def map_blocks(self, func, *args):
+        """Apply `func(block, *args)` to each block of the store.
+
+        Yields
+        ------
+        start : int
+            The index of the first frame in the block.
+        result : object
+            The value of `func` for the block.
+        """
+
+        for start, block in self.iter_blocks():
+            yield start, func(block, *args)
+
+    def empty_outputs(self, n_rows, dtype=np.float64):
+        """Allocate arrays for `map_blocks_into` to write per-frame
+        results into.
+
+        Parameters
+        ----------
+        n_rows : int
+            Number of per-frame values (e.g. distances to different
+            centers) to compute for each frame.
+        dtype : np.dtype, default=np.float64
+            The type of the values, float32 or float64.
+
+        Returns
+        -------
+        out : np.ndarray, shape=(n_rows, n_frames)
+            Array for the values of each frame.
+        labels : np.ndarray, shape=(n_frames,)
+            Integer array for a label (e.g. an assignment) of each
+            frame.
+        """
+
+        return (np.empty((n_rows, len(self)), dtype=dtype),
+                np.empty(len(self), dtype=int))
+
+    def map_blocks_into(self, func, out, labels, *args):
+        """Apply `func(block, out_block, labels_block, *args)` to each
+        block of the store, where `out_block` and `labels_block` are
+        the block's columns of `out` and `labels`.
+
+        `func` writes its per-frame results into its slices of `out`
+        and `labels` in place, and returns only a summary (like the
+        block's maximum), so that nothing proportional to the number
+        of frames is passed back.
+
+        Parameters
+        ----------
+        func : callable
+            The function to apply to each block.
+        out : np.ndarray, shape=(n_rows, n_frames)
+            Per-frame values, from `empty_outputs`.
+        labels : np.ndarray, shape=(n_frames,)
+            Per-frame labels, from `empty_outputs`.
+
+        Yields
+        ------
+        start : int
+            The index of the first frame in the block.
+        result : object
+            The value of `func` for the block.
+        """
+
+        for start, block in self.iter_blocks():
+            stop = start + len(block)
+            yield start, func(
+                block, out[:, start:stop], labels[start:stop], *args)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TrajectoryStore(CoordinateStore):
+    """The coordinates of a list of trajectory files, read from disk a
+    chunk of frames at a time.
+
+    The frames of the trajectories are treated as one concatenated
+    array of shape (n_frames, n_atoms, 3). Each pass over the store
+    streams the files with `md.iterload`, so no more than about two
+    chunks of coordinates are ever in memory. Indexing the store reads
+    each file holding a requested frame once, a chunk at a time, up to
+    the last frame requested from it, so random access is much slower
+    than streaming.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths of the trajectory files, in order.
+    top : str or md.Topology, default=None
+        Topology of the trajectories, if their format doesn't include
+        one.
+    atom_indices : array-like, default=None
+        Read only these atoms (e.g. an atom selection).
+    stride : int, default=1
+        Read only every stride-th frame.
+    block_size : int, default=65536
+        Number of frames in each chunk. Chunks don't span files, so the
+        last chunk of each file may be smaller.
+    prefetch : bool, default=True
+        Read the next chunk in a background thread while the current
+        one is being processed.
+
+    Examples
+    --------
+    >>> X = TrajectoryStore(filenames, top='native.pdb',
+    ...                     atom_indices=top.select('name CA'))
+    >>> clustering = KCenters(metric='rmsd', cluster_radius=0.2).fit(X)
+    """
+
+    def __init__(self, filenames, top=None, atom_indices=None, stride=1,
+                 block_size=65536, prefetch=True):
+
+        super(TrajectoryStore, self).__init__(
+            None, block_size=block_size, prefetch=prefetch)
+
+        if len(filenames) == 0:
+            raise exception.ImproperlyConfigured(
+                "TrajectoryStore requires at least one file.")
+
+        self.filenames = list(filenames)
+        self.top = top
+        self.atom_indices = atom_indices
+        self.stride = stride
+
+        self.lengths = np.array(
+            sound_trajectories(self.filenames, stride=stride), dtype=int)
+        self._offsets = np.concatenate([[0], np.cumsum(self.lengths)])
+
+        n_atoms = self._load_frame(0, 0).shape[0]
+        self._shape = (int(self._offsets[-1]), n_atoms, 3)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    def __getitem__(self, key):
+        inds = np.arange(len(self))[key]
+        if np.ndim(inds) == 0:
+            return self._load_frame(*self._locate(inds))
+
+        # read each file once for all of its frames, then put them back
+        # in the order (and with the repeats) they were requested in.
+        unique_inds, inverse = np.unique(inds, return_inverse=True)
+        frames = np.zeros((len(unique_inds),) + self.shape[1:],
+                          dtype=self.dtype)
+
+        bounds = np.searchsorted(unique_inds, self._offsets)
+        for file_index in range(len(self.filenames)):
+            lo, hi = bounds[file_index], bounds[file_index+1]
+            if lo < hi:
+                frames[lo:hi] = self._load_frames(
+                    file_index, unique_inds[lo:hi] - self._offsets[file_index])
+
+        return frames[inverse.reshape(inds.shape)]
+
+    def _locate(self, index):
+        """Find the file and frame within it of the `index`th frame.
+        """
+
+        file_index = np.searchsorted(self._offsets, index, side='right') - 1
+        return file_index, index - self._offsets[file_index]
+
+    def _load_frame(self, file_index, frame):
+        trj = md.load_frame(
+            self.filenames[file_index], index=frame * self.stride,
+            top=self.top, atom_indices=self.atom_indices)
+        return trj.xyz[0]
+
+    def _load_frames(self, file_index, frames):
+        """Load the sorted, distinct `frames` of a file in one pass over
+        it, a chunk at a time.
+        """
+
+        xyz = np.zeros((len(frames),) + self.shape[1:], dtype=self.dtype)
+
+        start, n_loaded = 0, 0
+        for trj in md.iterload(self.filenames[file_index],
+                               chunk=self.block_size, top=self.top,
+                               stride=self.stride,
+                               atom_indices=self.atom_indices):
+            stop = start + len(trj)
+            n_chunk = np.searchsorted(frames, stop)
+            xyz[n_loaded:n_chunk] = trj.xyz[frames[n_loaded:n_chunk] - start]
+
+            start, n_loaded = stop, n_chunk
+            if n_loaded == len(frames):
+                break
+
+        if n_loaded != len(frames):
+            raise exception.DataInvalid(
+                "Read %s frames from %s, expected at least %s." %
+                (start, self.filenames[file_index], frames[-1] + 1))
+
+        return xyz
+
+    def _blocks(self):
+        for filename, offset, length in zip(
+                self.filenames, self._offsets, self.lengths):
+            start = offset
+            for trj in md.iterload(filename, chunk=self.block_size,
+                                   top=self.top, stride=self.stride,
+                                   atom_indices=self.atom_indices):
+                yield start, trj.xyz
+                start += len(trj)
+
+            if start - offset != length:
+                raise exception.DataInvalid(
+                    "Read %s frames from %s, expected %s." %
+                    (start - offset, filename, length))
+
+
+class SharedCoordinates(CoordinateStore):
+    """Coordinates held in shared memory and processed in parallel by a
+    pool of worker processes.
+
+    The coordinates are copied once into a shared buffer, which each
+    worker maps without copying. The store is split into one block per
+    worker (or into `block_size` blocks, if given), and `map_blocks`
+    computes the blocks' results in the workers, like the stripes of an
+    MPI run but within one process tree. Anything that streams a store
+    (e.g. the clustering code in `enspara.cluster`) is thus parallelized
+    over the workers. The functions mapped and their arguments must be
+    picklable.
+
+    Per-frame results (distances, assignments) are best written into
+    the shared arrays returned by `empty_outputs` with
+    `map_blocks_into`, so the workers pass back only small summaries
+    rather than pickling arrays as long as the store.
+
+    Parameters
+    ----------
+    X : array-like, shape=(n_frames, ...)
+        The coordinates. For an md.Trajectory, its xyz are shared.
+    n_procs : int, default=None
+        Number of worker processes. When `None`, this is
+        `enspara.util.parallel.auto_nprocs()`.
+    block_size : int, default=None
+        Number of frames in each block. When `None`, frames are split
+        evenly between the workers.
+    prepare : bool, default=False
+        Center each frame and compute its trace for `libdist.rmsd` once,
+        in shared memory, so that workers are given blocks as
+        `PreparedCoordinates` and never prepare (or copy) them. The
+        store then holds the centered coordinates, which have the same
+        RMSDs. `X` must have shape (n_frames, n_atoms, 3).
+    n_outputs : int, default=4
+        Number of rows of the shared array returned by
+        `empty_outputs`. Its memory, 8 bytes per frame per row, is
+        allocated at construction.
+
+    Examples
+    --------
+    >>> with SharedCoordinates(trj, n_procs=16, prepare=True) as X:
+    ...     clustering = KHybrid(metric='rmsd', n_clusters=500).fit(X)
+    """
+
+    def __init__(self, X, n_procs=None, block_size=None, prepare=False,
+                 n_outputs=4):
+
+        if n_procs is None:
+            n_procs = auto_nprocs()
+        if n_procs < 1:
+            raise exception.ImproperlyConfigured(
+                "Number of processes must be positive, got %s." % n_procs)
+        if n_outputs < 1:
+            raise exception.ImproperlyConfigured(
+                "Number of outputs must be positive, got %s." % n_outputs)
+
+        X = X.xyz if hasattr(X, 'xyz') else X
+        X = np.ascontiguousarray(X, dtype=np.float32 if prepare else None)
+
+        self._buffer = mp.RawArray(ctypes.c_char, max(X.nbytes, 1))
+        data = _shared_ndarray(self._buffer, X.dtype.str, X.shape)
+        data[:] = X
+
+        self._traces_buffer = None
+        if prepare:
+            self._traces_buffer = mp.RawArray(
+                ctypes.c_char, max(8 * len(X), 1))
+            traces = _shared_ndarray(self._traces_buffer, '<f8', (len(X),))
+            # centers the shared coordinates in place.
+            traces[:] = libdist.PreparedCoordinates(data, copy=False).traces
+
+        self.n_outputs = n_outputs
+        self._out_buffer = mp.RawArray(
+            ctypes.c_char, max(8 * n_outputs * len(X), 1))
+        self._labels_buffer = mp.RawArray(ctypes.c_char, max(8 * len(X), 1))
+        self._labels = _shared_ndarray(
+            self._labels_buffer, np.dtype(np.int64).str, (len(X),))
+
+        if block_size is None:
+            block_size = max(-(-len(X) // n_procs), 1)
+
+        super(SharedCoordinates, self).__init__(
+            data, block_size=block_size, prefetch=False)
+
+        self.n_procs = n_procs
+        self._pool = mp.Pool(
+            processes=n_procs, initializer=_init_shared,
+            initargs=(self._buffer, X.dtype.str, X.shape,
+                      self._traces_buffer, self._out_buffer,
+                      self._labels_buffer))
+
+    def map_blocks(self, func, *args):
+        starts = range(0, len(self), self.block_size)
+        results = self._pool.map(
+            _map_shared_block,
+            [(func, start, start + self.block_size, args)
+             for start in starts],
+            chunksize=1)
+
+        for start, result in zip(starts, results):
+            yield start, result
+
+    def empty_outputs(self, n_rows, dtype=np.float64):
+        """Get the shared arrays for `map_blocks_into` to write
+        per-frame results into.
+
+        The arrays are the same at every call, so their contents are
+        only valid until the next call; copy anything that must outlive
+        it. See `CoordinateStore.empty_outputs`.
+        """
+
+        if n_rows > self.n_outputs:
+            raise exception.ImproperlyConfigured(
+                "Store has %s shared outputs, but %s were requested." %
+                (self.n_outputs, n_rows))
+
+        out = _shared_ndarray(
+            self._out_buffer, np.dtype(dtype).str, (n_rows, len(self)))
+        return out, self._labels
+
+    def map_blocks_into(self, func, out, labels, *args):
+        # the workers find `out` at the start of the shared buffer.
+        if out.ctypes.data != ctypes.addressof(self._out_buffer) or \
+                out.shape[1:] != (len(self),) or \
+                not out.flags.c_contiguous or labels is not self._labels:
+            raise exception.DataInvalid(
+                "SharedCoordinates can only write into the arrays from "
+                "its `empty_outputs`.")
+
+        starts = range(0, len(self), self.block_size)
+        results = self._pool.map(
+            _map_shared_block_into,
+            [(func, start, start + self.block_size, out.dtype.str,
+              out.shape[0], args) for start in starts],
+            chunksize=1)
+
+        for start, result in zip(starts, results):
+            yield start, result
+
+    def _read(self, key):
+        # the parent's view of the shared buffer is only ever read.
+        return np.ascontiguousarray(self._data[key])
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def _shared_ndarray(buffer, dtype, shape):
+    return np.frombuffer(buffer, dtype=dtype,
+                         count=int(np.prod(shape))).reshape(shape)
+
+
+def _init_shared(buffer, dtype, shape, traces_buffer, out_buffer,
+                 labels_buffer):
+    # blocks are views of the shared buffer, so anything that would
+    # modify a block in place (like preparing it for RMSD) must copy it.
+    global shared_coordinates, shared_traces, shared_outputs, shared_labels
+    shared_coordinates = _shared_ndarray(buffer, dtype, shape)
+    shared_traces = None
+    if traces_buffer is not None:
+        shared_traces = _shared_ndarray(traces_buffer, '<f8', shape[:1])
+    shared_outputs = out_buffer
+    shared_labels = _shared_ndarray(
+        labels_buffer, np.dtype(np.int64).str, shape[:1])
+
+
+def _shared_block(start, stop):
+    if shared_traces is None:
+        return shared_coordinates[start:stop]
+    return libdist.PreparedCoordinates._from_prepared(
+        shared_coordinates[start:stop], shared_traces[start:stop])
+
+
+def _map_shared_block(task):
+    func, start, stop, args = task
+    return func(_shared_block(start, stop), *args)
+
+
+def _map_shared_block_into(task):
+    func, start, stop, dtype, n_rows, args = task
+    out = _shared_ndarray(
+        shared_outputs, dtype, (n_rows, len(shared_coordinates)))
+    return func(_shared_block(start, stop), out[:, start:stop],
+                shared_labels[start:stop], *args)